@@ -1,14 +1,32 @@
 # Give me a CRCON Server and I'll give you stats
 from dataclasses import dataclass
 import datetime
+import json
+import math
+import operator
 from enum import Enum
 from typing import List, Tuple, TypedDict
 
-from utilities import Team, detect_team
+import metrics
+from utilities import WEAPON_SIDE_MAP, Team, TeamAssignmentCache, detect_teams, get_player_id
 import numpy as np
-import numpy.ma as ma
 
-INITAL_DATA_ARRAY_SIZE = 200
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Running side sums are rebuilt from the player rows this often so float error can't accumulate
+INCREMENTAL_RESYNC_EVERY = 50
+# Players a side's running rows have room for before they first grow
+INITIAL_SIDE_CAPACITY = 64
+# Slice records a game has room for before its buffer first grows, about an hour at a 1 minute poll
+INITIAL_SLICE_CAPACITY = 64
+# Compressed slice storage keeps a full keyframe this often and column deltas in between
+DELTA_KEYFRAME_INTERVAL = 16
+# Bumped whenever the layout DeltaSliceStore.save writes changes
+DELTA_STORE_VERSION = 1
+DELTA_STORE_ALIGN = 8
 RCRON_TIME_STR_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 class GameState(str, Enum):
@@ -19,7 +37,7 @@ class GameState(str, Enum):
     GAMEOVER = "Game-over"
 
 
-@dataclass
+@dataclass(frozen=True)
 class HllStat:
     name : str
     rcron_name : str
@@ -30,38 +48,151 @@ class HllStat:
     compute_std : bool
     np_type : str
 
-@dataclass
-class StatData:
-    name : str
-    data : np.ndarray
-    sum : float
-    mean : float
-    median : float
-    std : float
+def make_stat(name : str,
+              rcon_name : str,
+              short_name : str=None,
+              compute_sum=True,
+              compute_mean=True,
+              compute_median=True,
+              compute_std=True,
+              np_type='<f8') -> HllStat:
+
+    if short_name is None:
+        short_name = name
+
+    return HllStat(name=name,
+                   rcron_name=rcon_name,
+                   short_name=short_name,
+                   compute_sum=compute_sum,
+                   compute_mean=compute_mean,
+                   compute_median=compute_median,
+                   compute_std=compute_std,
+                   np_type=np_type)
+
+# Every stat both sides keep, in column order. Changing this changes slice_dtype, so game stores
+# written before won't open with the new schema.
+HLL_STATS : Tuple[HllStat, ...] = (
+    make_stat('Combat', 'combat'),
+    make_stat('Offense', 'offense'),
+    make_stat('Defense', 'defense'),
+    make_stat('Support', 'support'),
+    make_stat('Kills', 'kills'),
+    make_stat('Deaths', 'deaths'),
+
+    make_stat('Teamkills', 'teamkills'),
+    make_stat('Teamkill Streak', 'teamkills_streak'),
+
+    make_stat('Kills Per Minute', 'kills_per_minute', short_name='KPM'),
+    make_stat('Deaths Per Minute', 'deaths_per_minute', short_name='DPM'),
+
+    make_stat('Kill Death Ratio', 'kill_death_ratio', short_name='KD'),
+
+    make_stat('Deaths w/o Kill Streak', 'deaths_without_kill_streak'),
+
+    make_stat('Longest Life', 'longest_life_secs'),
+    make_stat('Shortest Life', 'shortest_life_secs'),
+)
+
+# The aggregates kept per stat, in the order of HllSideStats.aggregate_values' columns
+AGGREGATES = ('sum', 'mean', 'median', 'std')
+
+# Everything about the registered stats that a side needs, worked out once per process so building
+# a slice doesn't repeat it
+class StatSchema:
+    def __init__(self, stats : Tuple[HllStat, ...]):
+        self.stats = stats
+        self.nstats = len(stats)
+        self.rcron_names = [stat.rcron_name for stat in stats]
+        self.index = {stat.rcron_name : idx for idx, stat in enumerate(stats)}
+
+        # The entries of a flattened stats x AGGREGATES array that go into a record, in record order
+        computed = np.array([[stat.compute_sum, stat.compute_mean, stat.compute_median, stat.compute_std]
+                             for stat in stats], dtype=bool)
+        self.row_index = np.flatnonzero(computed.ravel())
+
+        self._datatypes : dict[Team, List[Tuple[str, str]]] = {}
+
+    def side_datatypes(self, side : Team) -> List[Tuple[str, str]]:
+        if side not in self._datatypes:
+            dtypes = [(f'{side.name} Score', '<i4'), (f'{side.name} Players', '<i4')]
+
+            for stat in self.stats:
+                if stat.compute_sum:
+                    dtypes.append((f'{side.name} {stat.name} Total', stat.np_type))
+
+                if stat.compute_mean:
+                    dtypes.append((f'{side.name} {stat.name} Mean', '<f8'))
 
+                if stat.compute_median:
+                    dtypes.append((f'{side.name} {stat.name} Median', '<f8'))
+
+                if stat.compute_std:
+                    dtypes.append((f'{side.name} {stat.name} Std', '<f8'))
+
+            self._datatypes[side] = dtypes
+
+        return self._datatypes[side]
+
+_stat_schema : StatSchema = None
+
+def stat_schema() -> StatSchema:
+    global _stat_schema
+
+    if _stat_schema is None:
+        _stat_schema = StatSchema(HLL_STATS)
+
+    return _stat_schema
+
+
+# How many players reported each stat, i.e. the non-NaN count of every column
+def count_present(matrix : np.ndarray) -> np.ndarray:
+    return len(matrix) - np.count_nonzero(np.isnan(matrix), axis=0)
+
+# Medians of every column, skipping NaN. Columns nobody reported come out as 0.
+def column_medians(matrix : np.ndarray, counts : np.ndarray) -> np.ndarray:
+    if np.all(counts == len(matrix)):
+        return np.median(matrix, axis=0)
+
+    medians = np.zeros(matrix.shape[1])
+    present = counts > 0
+    medians[present] = np.nanmedian(matrix[:, present], axis=0)
+    return medians
+
+# Sum, mean, median and std of every column, skipping NaN. Nearly every snapshot has every stat
+# for every player, and that case takes the plain reductions.
+def reduce_columns(matrix : np.ndarray, counts : np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    if np.all(counts == len(matrix)):
+        return matrix.sum(axis=0), matrix.mean(axis=0), np.median(matrix, axis=0), matrix.std(axis=0)
+
+    sums, means, stds = np.zeros(matrix.shape[1]), np.zeros(matrix.shape[1]), np.zeros(matrix.shape[1])
+    present = counts > 0
+    values = matrix[:, present]
+    sums[present] = np.nansum(values, axis=0)
+    means[present] = np.nanmean(values, axis=0)
+    stds[present] = np.nanstd(values, axis=0)
+
+    return sums, means, column_medians(matrix, counts), stds
+
+
+# One stat of one side. Its values and aggregates live in the side's arrays; this only knows
+# which column is its own.
 class Stat:
-    def __init__(self, hllStat : HllStat):
+    def __init__(self, hllStat : HllStat, side : 'HllSideStats', idx : int):
         self.hllStat = hllStat
-        self._data = StatData(name=self.hllStat.name,
-                             data=np.ma.masked_all((INITAL_DATA_ARRAY_SIZE,)),
-                             sum=None,
-                             mean=None,
-                             median=None,
-                             std=None,
-                             )
-        self.nvalues = 0
-
-        self._data.sum = 0.0
-        self._data.mean = 0.0
-        self._data.median = 0.0
-        self._data.std = 0.0
+        self.side = side
+        self.idx = idx
 
     def __str__(self) -> str:
         return f'<Stat(Name:{self.short_name}, nValues:{self.nvalues})>'
 
+    # The values reported by the side's players
     @property
     def data(self) -> np.ndarray:
-        return self._data.data
+        return self.side.column(self.idx)
+
+    @property
+    def nvalues(self) -> int:
+        return int(self.side.counts[self.idx])
 
     @property
     def name(self) -> str:
@@ -80,194 +211,375 @@ class Stat:
         return self.hllStat.rcron_name
 
     @property
-    def sum(self) -> str:
-        return self._data.sum
+    def sum(self) -> float:
+        return self.side.aggregate_values[self.idx, 0]
 
     @property
-    def mean(self) -> str:
-        return self._data.mean
+    def mean(self) -> float:
+        return self.side.aggregate_values[self.idx, 1]
 
     @property
-    def median(self) -> str:
-        return self._data.median
+    def median(self) -> float:
+        return self.side.aggregate_values[self.idx, 2]
 
     @property
-    def std(self) -> str:
-        return self._data.std
+    def std(self) -> float:
+        return self.side.aggregate_values[self.idx, 3]
 
     def add_datum(self, datum):
-        self.data[self.nvalues] = datum
-        self.nvalues += 1
+        self.side.append_datum(self.idx, datum)
 
     def compute_stats(self):
-        if self.hllStat.compute_sum:
-            self.compute_sum()
-
-        if self.hllStat.compute_mean:
-            self.compute_mean()
-
-        if self.hllStat.compute_median:
-            self.compute_median()
-
-        if self.hllStat.compute_std:
-            self.compute_std()
-
-    def compute_sum(self):
-        self._data.sum = np.sum(self.data)
-
-    def compute_mean(self):
-        self._data.mean = np.average(self.data)
-
-    def compute_median(self):
-        self._data.median = np.ma.median(self.data)
-
-    def compute_std(self):
-        self._data.std = np.std(self.data)
+        self.side.compute_column(self.idx)
 
 
 class HllSideStats:
+    # Only reached for names that aren't attributes, which are looked up as stats by CRCON name
     def __getattr__(self, name):
-        if name == 'score' or name == 'Score':
-            return self.score 
+        idx = stat_schema().index.get(name) if not name.startswith('_') else None
+        if idx is None:
+            raise AttributeError(f"'HllSideStats' has no attribute or stat '{name}'")
 
-        return self.stats_dict[name]
+        return self.stats[idx]
 
     def __contains__(self, key):
-        return key in self.stats_dict
+        return key in stat_schema().index
 
     @property
     def nstats(self) -> int:
-        return len(self.stats)
+        return stat_schema().nstats
+
+    @property
+    def rcron_names(self) -> List[str]:
+        return stat_schema().rcron_names
 
     def __init__(self, team=Team.UNKNOWN):
         self.side : Team = team
 
-        self.stats : List[Stat] = []
-        self.stats_dict : dict = {}
-
         self.time_remaing_secs : int = 0
         self.score : int = 0
         self.nplayers : int = 0
 
-        self.create_stat('Combat', 'combat')
-        self.create_stat('Offense', 'offense')
-        self.create_stat('Defense', 'defense')
-        self.create_stat('Support', 'support')
-        self.create_stat('Kills', 'kills')
-        self.create_stat('Deaths', 'deaths')
+        # The players x stats matrix the stats were loaded from, and whose row is whose. Usually
+        # a view of one matrix the whole slice shares.
+        self.player_ids : List[str] = []
+        self.matrix : np.ndarray = None
 
-        self.create_stat('Teamkills', 'teamkills') 
-        self.create_stat('Teamkill Streak', 'teamkills_streak')
+        nstats = stat_schema().nstats
+        # stats x AGGREGATES, and how many players reported each stat. A stat nobody reported
+        # keeps zero aggregates.
+        self.aggregate_values = np.zeros((nstats, len(AGGREGATES)))
+        self.counts = np.zeros(nstats, dtype=np.int64)
 
-        self.create_stat('Kills Per Minute', 'kills_per_minute', short_name='KPM')
-        self.create_stat('Deaths Per Minute', 'deaths_per_minute', short_name='DPM')
+        # Per stat values given one at a time to add_datum, instead of a matrix
+        self._datums : List[list] = None
+        self._stats : List[Stat] = None
 
-        self.create_stat('Kill Death Ratio', 'kill_death_ratio', short_name='KD')
+    @property
+    def stats(self) -> List[Stat]:
+        if self._stats is None:
+            self._stats = [Stat(hllStat, self, idx) for idx, hllStat in enumerate(stat_schema().stats)]
 
-        self.create_stat('Deaths w/o Kill Streak', 'deaths_without_kill_streak')
+        return self._stats
 
-        self.create_stat('Longest Life', 'longest_life_secs')
-        self.create_stat('Shortest Life', 'shortest_life_secs')
+    @property
+    def stats_dict(self) -> dict:
+        return {stat.rcron_name : stat for stat in self.stats}
+
+    # Values in make_datatypes order
+    def to_row(self) -> list:
+        return [self.score, self.nplayers, *self.aggregate_values.ravel()[stat_schema().row_index].tolist()]
 
     def to_numpy(self):
-        stats = ()
-        dtypes = []
+        return tuple(self.to_row()), self.make_datatypes()
 
-        stats += (self.score,)
-        stats += (self.nplayers,)
-        dtypes += ((f'{self.side.name} Score', '<i4'),)
-        dtypes += ((f'{self.side.name} Players', '<i4'),)
+    def make_datatypes(self):
+        return list(stat_schema().side_datatypes(self.side))
 
-        for stat in self.stats:
-            if stat.hllStat.compute_sum:
-                name = f'{self.side.name} {stat.name} Total'
-                stats += (stat.sum,)
-                dtypes += ((name, stat.np_type),)
+    # The reported values of one stat
+    def column(self, idx : int) -> np.ndarray:
+        if self._datums is not None:
+            return np.array(self._datums[idx], dtype=np.float64)
 
-            if stat.hllStat.compute_mean:
-                name = f'{self.side.name} {stat.name} Mean'
-                stats += (stat.mean,)
-                dtypes += ((name, '<f8'),)
+        if self.matrix is None:
+            return np.zeros(0)
 
-            if stat.hllStat.compute_median:
-                name = f'{self.side.name} {stat.name} Median'
-                stats += (stat.median,)
-                dtypes += ((name, '<f8'),)
+        column = self.matrix[:, idx]
+        return column[~np.isnan(column)]
 
-            if stat.hllStat.compute_std:
-                name = f'{self.side.name} {stat.name} Std'
-                stats += (stat.std,)
-                dtypes += ((name, '<f8'),)
+    def compute_column(self, idx : int):
+        values = self.column(idx)
+        self.counts[idx] = len(values)
 
-        return stats, dtypes
+        if len(values) > 0:
+            self.aggregate_values[idx] = (np.sum(values), np.mean(values), np.median(values), np.std(values))
 
-    def make_datatypes(self):
-        dtypes = []
+    def compute_stats(self):
+        for idx in range(self.nstats):
+            self.compute_column(idx)
+
+    # Datums go on top of whatever the side already holds. A loaded matrix is split into its
+    # columns first, after which the rows no longer stand for whole players.
+    def append_datum(self, idx : int, datum):
+        if self._datums is None:
+            if self.matrix is not None:
+                self._datums = [self.column(i).tolist() for i in range(self.nstats)]
+                self.matrix = None
+                self.player_ids = []
+            elif self.counts.any():
+                raise ValueError(f'The {self.side.name} side was loaded from aggregates alone, there are no values to add to')
+            else:
+                self._datums = [[] for _ in range(self.nstats)]
+
+        self._datums[idx].append(datum)
 
-        dtypes.append((f'{self.side.name} Score', '<i4'))
-        dtypes.append((f'{self.side.name} Players', '<i4'))
+    def add_datum(self, name, stat):
+        if name not in self:
+            raise ValueError(f"'{name}' not in this HllSideStats object")
 
-        for stat in self.stats:
-            if stat.hllStat.compute_sum:
-                name = f'{self.side.name} {stat.name} Total'
-                dtypes.append((name, stat.np_type))
+        idx = stat_schema().index[name]
+        self.append_datum(idx, stat)
+        self.compute_column(idx)
+
+    # Load every stat from a players x stats matrix whose columns follow the schema, with NaN
+    # wherever a player didn't report a stat. Each aggregate is reduced once over the whole side.
+    def load_matrix(self, matrix : np.ndarray, player_ids : List[str] = None):
+        self.matrix = matrix
+        self.player_ids = player_ids if player_ids is not None else []
+        self._datums = None
+
+        if len(matrix) == 0:
+            return
+
+        counts = count_present(matrix)
+        self.load_aggregates(counts, *reduce_columns(matrix, counts))
+
+    # Once aggregated, the matrix is only needed to delta encode the slice, see DeltaSliceStore
+    def drop_matrix(self):
+        self.matrix = None
+        self.player_ids = []
+
+    def load_aggregates(self, counts : np.ndarray, sums, means, medians, stds):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        values = np.column_stack((sums, means, medians, stds)).astype(np.float64, copy=False)
+        self.aggregate_values = np.where((self.counts > 0)[:, None], values, 0.0)
+
+    # Sum, mean, median and std of every stat as four arrays, see load_aggregates
+    def aggregates(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        return tuple(self.aggregate_values[:, col].copy() for col in range(len(AGGREGATES)))
+
+
+# Side totals kept as running count / sum / sum of squares per stat, so an update only costs taking
+# the changed players' old rows out and putting their new ones in. The rows live in one matrix that
+# is updated in place: a player keeps their row while they stay on the side, and the rows of
+# players who left are filled from the end. Each update is applied to a side as one batch.
+class RunningSideStats:
+    def __init__(self, nstats : int, capacity=INITIAL_SIDE_CAPACITY, median_every=1):
+        self.data = np.zeros((capacity, nstats), dtype=np.float64)
+        self.player_ids : List[str] = []
+        self.index : dict[str, int] = {}
+
+        self.count = np.zeros(nstats, dtype=np.int64)
+        self.sum = np.zeros(nstats, dtype=np.float64)
+        self.sum_sq = np.zeros(nstats, dtype=np.float64)
+
+        # The median has no running form. It's recomputed when a row changed, at most every
+        # median_every loads, and reused in between.
+        self.median_every = median_every
+        self.dirty = True
+        self.nloads : int = 0
+        self._medians = None
+
+    def __len__(self) -> int:
+        return len(self.player_ids)
+
+    def _account(self, rows : np.ndarray, sign : int):
+        present = ~np.isnan(rows)
+        values = np.where(present, rows, 0.0)
+
+        self.count += sign * present.sum(axis=0)
+        self.sum += sign * values.sum(axis=0)
+        self.sum_sq += sign * (values * values).sum(axis=0)
+        self.dirty = True
+
+    def _reserve(self, nrows : int):
+        if nrows <= len(self.data):
+            return
+
+        data = np.zeros((max(nrows, 2 * len(self.data)), self.data.shape[1]), dtype=np.float64)
+        data[:len(self.player_ids)] = self.data[:len(self.player_ids)]
+        self.data = data
+
+    # Take out the rows of players who left the side, then give every player in player_ids their
+    # row from rows, replacing the one they had
+    def update(self, removed : List[str], player_ids : List[str], rows : np.ndarray):
+        if len(removed) > 0:
+            self._remove(removed)
+
+        if len(player_ids) == 0:
+            return
+
+        idx = np.fromiter((self.index.get(player_id, -1) for player_id in player_ids), dtype=np.int64, count=len(player_ids))
+        added = idx < 0
+        if not added.all():
+            self._account(self.data[idx[~added]], -1)
+
+        if added.any():
+            nrows = len(self.player_ids)
+            new_ids = [player_id for player_id, new in zip(player_ids, added.tolist()) if new]
+            self._reserve(nrows + len(new_ids))
+
+            idx[added] = np.arange(nrows, nrows + len(new_ids))
+            for row, player_id in enumerate(new_ids, nrows):
+                self.index[player_id] = row
+            self.player_ids.extend(new_ids)
+
+        self.data[idx] = rows
+        self._account(rows, 1)
+
+    def _remove(self, removed : List[str]):
+        idx = np.array([self.index.pop(player_id) for player_id in removed], dtype=np.int64)
+        self._account(self.data[idx], -1)
+
+        # The rows past the end of what's left that are staying move into the holes before it
+        nrows = len(self.player_ids) - len(idx)
+        leaving = set(idx.tolist())
+        holes = np.sort(idx[idx < nrows])
+        moved = [row for row in range(nrows, len(self.player_ids)) if row not in leaving]
+
+        if len(moved) > 0:
+            self.data[holes] = self.data[moved]
+            for hole, row in zip(holes.tolist(), moved):
+                player_id = self.player_ids[row]
+                self.player_ids[hole] = player_id
+                self.index[player_id] = hole
+        del self.player_ids[nrows:]
+
+    def resync(self):
+        matrix = self.matrix()
+        present = ~np.isnan(matrix)
+        values = np.where(present, matrix, 0.0)
+
+        self.count = present.sum(axis=0)
+        self.sum = values.sum(axis=0)
+        self.sum_sq = (values * values).sum(axis=0)
+
+    # A view of the current rows, which changes with the next update
+    def matrix(self) -> np.ndarray:
+        return self.data[:len(self.player_ids)]
+
+    def load_into(self, side : 'HllSideStats', keep_matrix=True):
+        matrix = self.matrix()
+        # The slice outlives this update, so it gets its own copy
+        if keep_matrix:
+            side.matrix = matrix.copy()
+            side.player_ids = list(self.player_ids)
+
+        if len(self.player_ids) == 0:
+            return
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = self.sum / self.count
+            variances = np.maximum(self.sum_sq / self.count - means * means, 0.0)
+
+        if self._medians is None or (self.dirty and self.nloads % self.median_every == 0):
+            self._medians = column_medians(matrix, self.count)
+            self.dirty = False
+        self.nloads += 1
+
+        side.load_aggregates(self.count.copy(), self.sum.copy(), means, self._medians, np.sqrt(variances))
+
+# Keeps every player's last row between cumulative CRCON snapshots and only touches players whose
+# stats actually moved, including leaving or switching teams. The stats include the kill, teamkill
+# and death totals that move with the weapon counts, so a team switch always shows up as a change.
+class IncrementalSliceAggregator:
+    def __init__(self, names : List[str], resync_every=INCREMENTAL_RESYNC_EVERY, team_cache : TeamAssignmentCache = None,
+                 median_every=1, keep_matrices=True):
+        self.names = names
+        self.resync_every = resync_every
+        self.team_cache = team_cache
+        # Whether each slice gets a copy of the rows, for Stat.data and a DeltaSliceStore
+        self.keep_matrices = keep_matrices
+
+        # player id -> (team, stat values) from the last snapshot
+        self.players : dict[str, Tuple[Team, tuple]] = {}
+        # Every stat of a player in one call, for players that report them all
+        self._values = operator.itemgetter(*names)
+        self.sides = {Team.AXIS : RunningSideStats(len(names), median_every=median_every),
+                      Team.ALLIES : RunningSideStats(len(names), median_every=median_every)}
+
+        self.nupdates : int = 0
+        self.nchanged : int = 0
+
+    def update(self, player_stats) -> int:
+        players = self.players
+        names = self.names
+        seen = set()
+        changed = []
 
-            if stat.hllStat.compute_mean:
-                name = f'{self.side.name} {stat.name} Mean'
-                dtypes.append((name, '<f8'))
+        for player in player_stats:
+            player_id = player.get('player_id')
+            if player_id is None:
+                player_id = get_player_id(player)
+            seen.add(player_id)
+
+            try:
+                values = self._values(player)
+            except KeyError:
+                values = tuple(map(player.get, names))
+            previous = players.get(player_id)
+            if previous is None or previous[1] != values:
+                changed.append((player_id, player, values))
+
+        changed_players = [player for _, player, _ in changed]
+        if self.team_cache is not None:
+            teams = self.team_cache.detect_teams(changed_players)
+        else:
+            teams = detect_teams(changed_players)
 
-            if stat.hllStat.compute_median:
-                name = f'{self.side.name} {stat.name} Median'
-                dtypes.append((name, '<f8'))
+        removed = {team : [] for team in self.sides}
+        updated = {team : ([], []) for team in self.sides}
+        for (player_id, player, values), (team, _) in zip(changed, teams):
+            previous = players.get(player_id)
+            if previous is not None and previous[0] != Team.UNKNOWN and previous[0] != team:
+                removed[previous[0]].append(player_id)
 
-            if stat.hllStat.compute_std:
-                name = f'{self.side.name} {stat.name} Std'
-                dtypes.append((name, '<f8'))
+            if team != Team.UNKNOWN:
+                updated[team][0].append(player_id)
+                updated[team][1].append(values)
 
-        return dtypes
+            players[player_id] = (team, values)
 
-    def create_stat(self, 
-                    name : str, 
-                    rcon_name: str,
-                    short_name : str=None,
-                    compute_sum=True,
-                    compute_mean=True,
-                    compute_median=True,
-                    compute_std=True,
-                    np_type='<f8'):
-
-        if short_name is None:
-            short_name = name
-
-        statInfo = HllStat(name=name,
-                       rcron_name=rcon_name,
-                       short_name=short_name,
-                       compute_sum=compute_sum,
-                       compute_mean=compute_mean,
-                       compute_median=compute_median,
-                       compute_std=compute_std,
-                       np_type=np_type)
-        stat = Stat(statInfo)
-        
-        self.stats.append(stat)
-        self.stats_dict[rcon_name] = stat
+        nchanged = len(changed)
 
-    def compute_stats(self):
-        for stat in self.stats:
-            stat.compute_stats()
+        # Everyone seen is in players by now, so anyone extra has left
+        if len(players) > len(seen):
+            for player_id in [player_id for player_id in players if player_id not in seen]:
+                team = players.pop(player_id)[0]
+                if team != Team.UNKNOWN:
+                    removed[team].append(player_id)
+                nchanged += 1
 
-    def add_datum(self, name, stat):
-        if name not in self:
-            raise ValueError(f"'{name}' not in this HllSideStats object")
+        for team, side in self.sides.items():
+            player_ids, rows = updated[team]
+            side.update(removed[team], player_ids, np.array(rows, dtype=np.float64).reshape(-1, len(names)))
+
+        self.nupdates += 1
+        self.nchanged += nchanged
+        if self.nupdates % self.resync_every == 0:
+            for side in self.sides.values():
+                side.resync()
+
+        return nchanged
+
+    def load_into(self, stat_slice : 'HllGameStatsSlice'):
+        for team, side in stat_slice.teams.items():
+            self.sides[team].load_into(side, keep_matrix=self.keep_matrices)
 
-        data : Stat = self.stats_dict[name]
-        data.add_datum(stat)
-        data.compute_stats()
-    
         
 
 class HllGameStatsSlice:
-    def __init__(self, stats=None, public_info=None):
+    def __init__(self, stats=None, public_info=None, team_cache : TeamAssignmentCache = None):
         self.final_score = {Team.ALLIES : 0,
                             Team.AXIS : 0}
         self.was_steamroll = False
@@ -281,24 +593,49 @@ class HllGameStatsSlice:
         self.final_duration : int = None
 
         if stats is not None and public_info is not None:
-            self.process_stats(stats, public_info)
+            self.process_stats(stats, public_info, team_cache=team_cache)
 
-    def process_stats(self, rcon_stats, public_info):
+    @metrics.timed(metrics.DIGEST_SECONDS, 'process_stats')
+    def process_stats(self, rcon_stats, public_info, team_cache : TeamAssignmentCache = None):
         self._process_public_info(public_info)
         player_stats = rcon_stats['result']['stats']
 
-        for player in player_stats:
-            team, _ = detect_team(player)
+        names = stat_schema().rcron_names
+        rows = {Team.AXIS : [], Team.ALLIES : []}
+        player_ids = {Team.AXIS : [], Team.ALLIES : []}
+
+        if team_cache is not None:
+            teams = team_cache.detect_teams(player_stats)
+        else:
+            teams = detect_teams(player_stats)
 
+        for player, (team, _) in zip(player_stats, teams):
             if team == Team.UNKNOWN:
                 continue
 
-            for stat in player:
-                if stat not in self.teams[team]:
-                    continue
-
-                self.teams[team].add_datum(stat, player[stat])
+            rows[team].append([player.get(name, np.nan) for name in names])
+            player_ids[team].append(get_player_id(player))
+
+        # One matrix sized to the players actually on a side, which each side then views its rows of
+        matrix = np.array([row for team in self.teams for row in rows[team]], dtype=np.float64).reshape(-1, len(names))
+        start = 0
+        for team, side in self.teams.items():
+            stop = start + len(rows[team])
+            side.load_matrix(matrix[start:stop], player_ids[team])
+            start = stop
+
+    # Same result as process_stats, but only the players that changed since the aggregator's last
+    # snapshot are re-digested
+    @metrics.timed(metrics.DIGEST_SECONDS, 'process_stats_incremental')
+    def process_stats_incremental(self, rcon_stats, public_info, aggregator : IncrementalSliceAggregator):
+        self._process_public_info(public_info)
+        aggregator.update(rcon_stats['result']['stats'])
+        aggregator.load_into(self)
                 
+    def drop_matrices(self):
+        for side in self.teams.values():
+            side.drop_matrix()
+
     def _process_public_info(self, public_info):
         public_info = public_info['result']
         self.time_remaining_secs = public_info['time_remaining']
@@ -319,25 +656,419 @@ class HllGameStatsSlice:
 
         return dtypes
 
+    # One record in make_datatypes order, ready to go into a structured array
+    def to_row(self) -> tuple:
+        return (self.time_remaining_secs, *self.allied.to_row(), *self.axis.to_row())
+
     def to_numpy(self):
-        stats = []
-        dtypes = []
+        return list(self.to_row()), self.make_datatypes()
+
+    def to_arrow(self) -> 'pa.RecordBatch':
+        return records_to_arrow(np.array([self.to_row()], dtype=slice_dtype()))
+
+
+_slice_dtype : np.dtype = None
+
+# The structured dtype of a slice record. It only depends on the registered stats, so it's built
+# once per process.
+def slice_dtype() -> np.dtype:
+    global _slice_dtype
+
+    if _slice_dtype is None:
+        _slice_dtype = np.dtype(HllGameStatsSlice().make_datatypes())
+
+    return _slice_dtype
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Arrow export needs pyarrow, install it with 'pip install pyarrow'")
+
+# The CRCON keys of every registered stat, in HllSideStats column order
+def stat_rcron_names() -> List[str]:
+    return stat_schema().rcron_names
+
+# Arrow schema matching slice_dtype, column for column
+def arrow_schema() -> 'pa.Schema':
+    _require_pyarrow()
+    dtype = slice_dtype()
+    return pa.schema([(name, pa.from_numpy_dtype(dtype[name])) for name in dtype.names])
+
+# Arrow is columnar while the slice records are interleaved, so each field is gathered into one
+# contiguous array that the Arrow column then wraps without a further copy
+def records_to_arrow(records : np.ndarray) -> 'pa.RecordBatch':
+    _require_pyarrow()
+    columns = [pa.array(np.ascontiguousarray(records[name])) for name in records.dtype.names]
+    return pa.RecordBatch.from_arrays(columns, schema=arrow_schema())
+
+# Writes an Arrow IPC stream of slice records, one record batch per slice, so a reader can follow
+# a live game without anything already written being serialized again
+class ArrowSliceStream:
+    def __init__(self, sink):
+        _require_pyarrow()
+        self.writer = pa.ipc.new_stream(sink, arrow_schema())
+        self.nbatches : int = 0
+
+    def write_records(self, records : np.ndarray):
+        self.writer.write_batch(records_to_arrow(records))
+        self.nbatches += 1
+
+    def close(self):
+        self.writer.close()
+
+# Slice records of one game in a contiguous structured array that doubles its capacity whenever it
+# fills up. Views handed out before a resize keep pointing at the old storage.
+class SliceBuffer:
+    def __init__(self, dtype : np.dtype, capacity=INITIAL_SLICE_CAPACITY):
+        self._data = np.zeros(capacity, dtype=dtype)
+        self.nrows : int = 0
+
+    def __len__(self) -> int:
+        return self.nrows
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    @property
+    def view(self) -> np.ndarray:
+        return self._data[:self.nrows]
+
+    def append(self, row : tuple):
+        if self.nrows == self.capacity:
+            data = np.zeros(max(1, self.capacity * 2), dtype=self.dtype)
+            data[:self.nrows] = self._data
+            self._data = data
+
+        self._data[self.nrows] = row
+        self.nrows += 1
+
+# Smallest signed integer dtype that holds every value
+def _int_dtype(values : np.ndarray) -> np.dtype:
+    if values.size == 0:
+        return np.dtype(np.int8)
+
+    return np.result_type(np.min_scalar_type(int(values.min())), np.min_scalar_type(int(values.max())), np.int8)
+
+def _integral_columns(values : np.ndarray) -> np.ndarray:
+    return np.all(np.isfinite(values) & (values == np.round(values)), axis=0)
+
+def _index_array(idx : np.ndarray, size : int) -> np.ndarray:
+    return idx.astype(np.min_scalar_type(max(size - 1, 0)))
+
+# A matrix split into its whole number columns, stored as small integers, and the rest as float64
+@dataclass
+class EncodedMatrix:
+    int_columns : np.ndarray
+    ints : np.ndarray
+    floats : np.ndarray
+
+    @property
+    def nbytes(self) -> int:
+        return self.int_columns.nbytes + self.ints.nbytes + self.floats.nbytes
+
+    @staticmethod
+    def encode(matrix : np.ndarray) -> 'EncodedMatrix':
+        int_columns = _integral_columns(matrix)
+        ints = matrix[:, int_columns]
+        return EncodedMatrix(int_columns=int_columns, ints=ints.astype(_int_dtype(ints)), floats=matrix[:, ~int_columns])
+
+    def decode(self) -> np.ndarray:
+        matrix = np.empty((self.ints.shape[0], len(self.int_columns)), dtype=np.float64)
+        matrix[:, self.int_columns] = self.ints
+        matrix[:, ~self.int_columns] = self.floats
+        return matrix
+
+# One side of a frame. A keyframe holds every player's row. A delta holds which of the previous
+# frame's rows were kept, the ids and rows of newly seen players, and only the kept entries that
+# changed: how many per column, their rows, and the change itself, as an integer delta for columns
+# where old and new are whole numbers or as the new float value otherwise.
+@dataclass
+class SideFrame:
+    player_ids : List[str] = None
+    rows : EncodedMatrix = None
+    keep : np.ndarray = None
+    change_counts : np.ndarray = None
+    change_rows : np.ndarray = None
+    int_changes : np.ndarray = None
+    deltas : np.ndarray = None
+    values : np.ndarray = None
+
+    @property
+    def is_keyframe(self) -> bool:
+        return self.keep is None
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.rows.nbytes
+        if not self.is_keyframe:
+            nbytes += sum(array.nbytes for array in (self.keep, self.change_counts, self.change_rows,
+                                                     self.int_changes, self.deltas, self.values))
+        return nbytes
+
+    @staticmethod
+    def keyframe(player_ids : List[str], matrix : np.ndarray) -> 'SideFrame':
+        return SideFrame(player_ids=player_ids, rows=EncodedMatrix.encode(matrix))
+
+    @staticmethod
+    def delta(prev_ids : List[str], prev : np.ndarray, player_ids : List[str], matrix : np.ndarray) -> Tuple['SideFrame', List[str], np.ndarray]:
+        prev_rows = {player_id : row for row, player_id in enumerate(prev_ids)}
+        kept = [row for row, player_id in enumerate(player_ids) if player_id in prev_rows]
+        added = [row for row, player_id in enumerate(player_ids) if player_id not in prev_rows]
+
+        # Kept players come first in the rebuilt matrix, so reorder the ids and rows to match
+        ordered_ids = [player_ids[row] for row in kept + added]
+        matrix = matrix[kept + added]
+
+        keep = np.array([prev_rows[player_ids[row]] for row in kept], dtype=np.int64)
+        old = prev[keep]
+        new = matrix[:len(keep)]
+
+        changed = ~((old == new) | (np.isnan(old) & np.isnan(new)))
+        change_counts = changed.sum(axis=0)
+        # Column by column, to match change_counts
+        col_rows = [np.flatnonzero(changed[:, col]) for col in range(matrix.shape[1])]
+        int_changes = np.array([_integral_columns(old[rows, col:col + 1])[0] and _integral_columns(new[rows, col:col + 1])[0]
+                                for col, rows in enumerate(col_rows)], dtype=bool)
+
+        deltas = [new[rows, col] - old[rows, col] for col, rows in enumerate(col_rows) if int_changes[col]]
+        values = [new[rows, col] for col, rows in enumerate(col_rows) if not int_changes[col]]
+        deltas = np.concatenate(deltas) if deltas else np.zeros(0)
+        values = np.concatenate(values) if values else np.zeros(0)
+
+        frame = SideFrame(player_ids=ordered_ids[len(keep):],
+                          rows=EncodedMatrix.encode(matrix[len(keep):]),
+                          keep=_index_array(keep, len(prev_ids)),
+                          change_counts=change_counts.astype(_int_dtype(change_counts)),
+                          change_rows=_index_array(np.concatenate(col_rows), len(keep)),
+                          int_changes=int_changes,
+                          deltas=deltas.astype(_int_dtype(deltas)),
+                          values=values)
+
+        return frame, ordered_ids, matrix
+
+    def apply(self, prev_ids : List[str], prev : np.ndarray) -> Tuple[List[str], np.ndarray]:
+        if self.is_keyframe:
+            return self.player_ids, self.rows.decode()
+
+        keep = self.keep.astype(np.int64)
+        kept = prev[keep]
+
+        offset = 0
+        ndeltas = 0
+        nvalues = 0
+        for col, count in enumerate(self.change_counts.tolist()):
+            rows = self.change_rows[offset:offset + count]
+            if self.int_changes[col]:
+                kept[rows, col] += self.deltas[ndeltas:ndeltas + count]
+                ndeltas += count
+            else:
+                kept[rows, col] = self.values[nvalues:nvalues + count]
+                nvalues += count
+            offset += count
+
+        player_ids = [prev_ids[row] for row in keep.tolist()] + self.player_ids
+
+        return player_ids, np.concatenate((kept, self.rows.decode()))
+
+# The SideFrame fields only a delta frame has
+SIDE_FRAME_DELTA_FIELDS = ('keep', 'change_counts', 'change_rows', 'int_changes', 'deltas', 'values')
+
+@dataclass
+class SliceFrame:
+    # time remaining, total players, then score and players of axis and allied
+    scalars : np.ndarray
+    sides : dict[Team, SideFrame]
+
+    @property
+    def is_keyframe(self) -> bool:
+        return all(side.is_keyframe for side in self.sides.values())
+
+    @property
+    def nbytes(self) -> int:
+        return self.scalars.nbytes + sum(side.nbytes for side in self.sides.values())
 
-        axis_stat, axis_dtype = self.axis.to_numpy()
-        stats.extend([self.time_remaining_secs])
-        stats.extend(axis_stat)
-        dtypes.extend(axis_dtype)
+# Holds a game's slices as a keyframe every keyframe_interval slices with column deltas in between,
+# and rebuilds HllGameStatsSlice objects on demand. Indexing replays from the closest keyframe;
+# iterating replays every frame once.
+class DeltaSliceStore:
+    def __init__(self, keyframe_interval=DELTA_KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.frames : List[SliceFrame] = []
+        self.keyframes : List[int] = []
 
-        allies_stat, _ = self.allied.to_numpy()
-        stats.extend(allies_stat)
+        # Attributes set on every rebuilt slice, see HllGame.mark_stats_with_result
+        self.slice_attrs : dict = {}
 
-        return stats, dtypes
+        self._last : dict[Team, Tuple[List[str], np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(frame.nbytes for frame in self.frames)
+
+    def append(self, stat_slice : 'HllGameStatsSlice'):
+        scalars = np.array([stat_slice.time_remaining_secs, stat_slice.total_players,
+                            stat_slice.axis.score, stat_slice.axis.nplayers,
+                            stat_slice.allied.score, stat_slice.allied.nplayers], dtype=np.int32)
+
+        is_keyframe = self._last is None or len(self.frames) - self.keyframes[-1] >= self.keyframe_interval
+
+        sides = {}
+        last = {}
+        for team, side in stat_slice.teams.items():
+            matrix = side.matrix if side.matrix is not None else np.zeros((0, side.nstats))
+
+            player_ids = list(side.player_ids)
+
+            if is_keyframe:
+                sides[team] = SideFrame.keyframe(player_ids, matrix)
+            else:
+                prev_ids, prev = self._last[team]
+                sides[team], player_ids, matrix = SideFrame.delta(prev_ids, prev, player_ids, matrix)
+
+            last[team] = (player_ids, matrix)
+
+        if is_keyframe:
+            self.keyframes.append(len(self.frames))
+
+        self.frames.append(SliceFrame(scalars=scalars, sides=sides))
+        self._last = last
+
+    def _build(self, frame : SliceFrame, state : dict[Team, Tuple[List[str], np.ndarray]]) -> 'HllGameStatsSlice':
+        stat_slice = HllGameStatsSlice()
+        (stat_slice.time_remaining_secs, stat_slice.total_players,
+         stat_slice.axis.score, stat_slice.axis.nplayers,
+         stat_slice.allied.score, stat_slice.allied.nplayers) = frame.scalars.tolist()
+
+        for team, side in stat_slice.teams.items():
+            player_ids, matrix = state[team]
+            side.load_matrix(matrix, list(player_ids))
+
+        for name, value in self.slice_attrs.items():
+            setattr(stat_slice, name, value)
+
+        return stat_slice
+
+    def _replay(self, start : int, stop : int):
+        state = None
+        for idx in range(start, stop):
+            frame = self.frames[idx]
+            state = {team : side.apply(*(state[team] if state is not None else (None, None)))
+                     for team, side in frame.sides.items()}
+            yield idx, frame, state
+
+    def __getitem__(self, idx : int) -> 'HllGameStatsSlice':
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('slice index out of range')
+
+        keyframe = max(key for key in self.keyframes if key <= idx)
+        for _, frame, state in self._replay(keyframe, idx + 1):
+            pass
+
+        return self._build(frame, state)
+
+    def __iter__(self):
+        for _, frame, state in self._replay(0, len(self)):
+            yield self._build(frame, state)
+
+    # Saved with np.savez_compressed as a JSON header and one byte buffer. The header holds the
+    # keyframes, the slice attributes, each side's player ids and, for every frame array, its dtype,
+    # shape and offset into the buffer. Nothing in the file is pickled, so loading can't run code.
+    def save(self, fname):
+        arrays = {}
+        blob = bytearray()
+
+        def put(key : str, array : np.ndarray):
+            blob.extend(b'\0' * (-len(blob) % DELTA_STORE_ALIGN))
+            arrays[key] = [array.dtype.str, list(array.shape), len(blob)]
+            blob.extend(np.ascontiguousarray(array).tobytes())
+
+        frames = []
+        for idx, frame in enumerate(self.frames):
+            put(f'{idx}.scalars', frame.scalars)
+
+            sides = {}
+            for team, side in frame.sides.items():
+                sides[team.value] = side.player_ids
+                put(f'{idx}.{team.value}.int_columns', side.rows.int_columns)
+                put(f'{idx}.{team.value}.ints', side.rows.ints)
+                put(f'{idx}.{team.value}.floats', side.rows.floats)
+                if not side.is_keyframe:
+                    for field in SIDE_FRAME_DELTA_FIELDS:
+                        put(f'{idx}.{team.value}.{field}', getattr(side, field))
+            frames.append(sides)
+
+        slice_attrs = dict(self.slice_attrs)
+        if 'final_score' in slice_attrs:
+            slice_attrs['final_score'] = {team.value : score for team, score in slice_attrs['final_score'].items()}
+
+        header = {'version' : DELTA_STORE_VERSION,
+                  'keyframe_interval' : self.keyframe_interval,
+                  'keyframes' : self.keyframes,
+                  'slice_attrs' : slice_attrs,
+                  'frames' : frames,
+                  'arrays' : arrays}
+
+        with open(fname, 'wb') as f:
+            np.savez_compressed(f, header=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+                                data=np.frombuffer(bytes(blob), dtype=np.uint8))
+
+    @staticmethod
+    def load(fname) -> 'DeltaSliceStore':
+        with np.load(fname, allow_pickle=False) as npz:
+            header = json.loads(npz['header'].tobytes())
+            data = npz['data']
+
+        if header.get('version') != DELTA_STORE_VERSION:
+            raise ValueError(f"'{fname}' is version {header.get('version')}, expected {DELTA_STORE_VERSION}")
+
+        arrays = header['arrays']
+        def get(key : str) -> np.ndarray:
+            dtype, shape, offset = arrays[key]
+            dtype = np.dtype(dtype)
+            count = math.prod(shape)
+            return np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+        frames = []
+        for idx, sides in enumerate(header['frames']):
+            frame_sides = {}
+            for team, player_ids in sides.items():
+                prefix = f'{idx}.{team}'
+                rows = EncodedMatrix(int_columns=get(f'{prefix}.int_columns'),
+                                     ints=get(f'{prefix}.ints'),
+                                     floats=get(f'{prefix}.floats'))
+                deltas = {}
+                if f'{prefix}.keep' in arrays:
+                    deltas = {field : get(f'{prefix}.{field}') for field in SIDE_FRAME_DELTA_FIELDS}
+                frame_sides[Team(team)] = SideFrame(player_ids=player_ids, rows=rows, **deltas)
+
+            frames.append(SliceFrame(scalars=get(f'{idx}.scalars'), sides=frame_sides))
+
+        slice_attrs = header['slice_attrs']
+        if 'final_score' in slice_attrs:
+            slice_attrs['final_score'] = {Team(team) : score for team, score in slice_attrs['final_score'].items()}
+
+        store = DeltaSliceStore(header['keyframe_interval'])
+        store.frames = frames
+        store.keyframes = header['keyframes']
+        store.slice_attrs = slice_attrs
+
+        return store
 
 class HllGame:
     def __str__(self) -> str:
         return f'<HllGame - {self.map} - {self.start_time_s} - SR: {self.steamroll}'
 
-    def __init__(self, server=None, map=None, start_time_s=None):
+    def __init__(self, server=None, map=None, start_time_s=None, incremental=False,
+                 compress_slices=False, keyframe_interval=DELTA_KEYFRAME_INTERVAL, steamroll_model=None):
         self.state : GameState = GameState.EMPTY
 
         self.map = None
@@ -355,6 +1086,13 @@ class HllGame:
 
         self.game_mode = None
         self.stat_slices : List[HllGameStatsSlice] = []
+        if compress_slices:
+            self.stat_slices = DeltaSliceStore(keyframe_interval)
+        self.slice_buffer = SliceBuffer(slice_dtype())
+        self.arrow_stream : ArrowSliceStream = None
+        # Set by to_numpy
+        self.all_x : np.ndarray = None
+        self.y : np.ndarray = None
         self.current_time_remaining = 0
         self.current_score = {Team.ALLIES : 0, Team.AXIS : 0}
 
@@ -363,20 +1101,106 @@ class HllGame:
         self.winner = Team.UNKNOWN
         self.loser = Team.UNKNOWN
 
+        # Kills per side as of the latest slice
+        self.slice_kills = {Team.ALLIES : 0, Team.AXIS : 0}
+        # Kills per side as they arrive from the log stream, since the latest slice
+        self.event_kills = {Team.ALLIES : 0, Team.AXIS : 0}
+        # The final score from a MATCH ENDED event, before the game history has it
+        self.event_score : dict = None
+
+        # Scores every new slice with a predictor.SteamrollModel while the game is on
+        self.predictor = steamroll_model.predictor() if steamroll_model is not None else None
+        self.steamroll_alerted = False
+
+        # Player teams carry over between slices, see TeamAssignmentCache
+        self.team_cache = TeamAssignmentCache()
+
+        self.aggregator : IncrementalSliceAggregator = None
+        if incremental:
+            self.aggregator = IncrementalSliceAggregator(stat_rcron_names(), team_cache=self.team_cache)
+
     def add_stat_slice(self, stat, public):
-        stat_slice = HllGameStatsSlice(stats=stat, public_info=public)
+        self.append_slice(self.digest_slice(stat, public))
+
+    # Turn a CRCON snapshot into a slice without adding it to the game yet. Only the team cache
+    # and incremental aggregator are touched, so this can run off the event loop as long as one
+    # game's slices are digested one at a time.
+    def digest_slice(self, stat, public) -> 'HllGameStatsSlice':
+        if self.aggregator is not None:
+            stat_slice = HllGameStatsSlice()
+            stat_slice.process_stats_incremental(stat, public, self.aggregator)
+        else:
+            stat_slice = HllGameStatsSlice(stats=stat, public_info=public, team_cache=self.team_cache)
+
+        return stat_slice
 
+    def append_slice(self, stat_slice : 'HllGameStatsSlice'):
         self.state = GameState.PLAYING
         self.time_remaining = stat_slice.time_remaining_secs
-        self.score[Team.ALLIES] = stat_slice.allied.score
-        self.score[Team.AXIS] = stat_slice.axis.score
+        # A slice polled after MATCH ENDED can still carry the score from before it
+        if self.event_score is None:
+            self.score[Team.ALLIES] = stat_slice.allied.score
+            self.score[Team.AXIS] = stat_slice.axis.score
 
         self.stat_slices.append(stat_slice)
+        self.slice_buffer.append(stat_slice.to_row())
+        # A DeltaSliceStore has encoded the rows by now and rebuilds them for every slice it gives
+        # back, so this copy isn't needed. Slices kept as they are keep their rows for Stat.data.
+        if self.keeps_matrices:
+            stat_slice.drop_matrices()
+
+        # The slice counts every kill up to now, so the streamed ones start over from it
+        record = self.slice_buffer.view[-1]
+        for team in (Team.ALLIES, Team.AXIS):
+            kills = float(record[f'{team.name} Kills Total'])
+            self.slice_kills[team] = int(kills) if math.isfinite(kills) else 0
+            self.event_kills[team] = 0
+
+        if self.predictor is not None:
+            self.predictor.update(self.slice_buffer.view[-1])
+
+        if self.arrow_stream is not None:
+            self.arrow_stream.write_records(self.slice_buffer.view[-1:])
+
+    def add_kill_event(self, weapon : str):
+        team = WEAPON_SIDE_MAP.get(weapon)
+        if team is not None:
+            self.event_kills[team] += 1
+
+    # The score from MATCH ENDED is final, so it stands until the game history says otherwise
+    def add_score_event(self, allied : int, axis : int):
+        self.event_score = {Team.ALLIES : allied, Team.AXIS : axis}
+        self.score[Team.ALLIES] = allied
+        self.score[Team.AXIS] = axis
+
+    # Kills per side as of the latest slice plus those streamed since
+    @property
+    def kills(self) -> dict:
+        return {team : self.slice_kills[team] + self.event_kills[team] for team in self.slice_kills}
+
+    # (map id, start time), which is what tells one game on a server from the next
+    @property
+    def game_id(self) -> Tuple[str, int]:
+        return self.map, self.start_time_s
+
+    # Whether the slices are delta encoded, which keeps their players x stats matrices itself
+    @property
+    def keeps_matrices(self) -> bool:
+        return isinstance(self.stat_slices, DeltaSliceStore)
 
     @property
     def nslices(self) -> int:
         return len(self.stat_slices)
 
+    # Chance the game ends in a steamroll as of the latest slice, None without a model or slices
+    @property
+    def steamroll_probability(self) -> float:
+        return self.predictor.probability if self.predictor is not None else None
+
+    @property
+    def team_cache_hit_rate(self) -> float:
+        return self.team_cache.hit_rate
+
     @property
     def score(self) -> dict:
         return self.current_score
@@ -394,10 +1218,17 @@ class HllGame:
         self.current_time_remaining = value
 
     def mark_stats_with_result(self):
+        # Compressed slices are rebuilt on every access, so the store applies the result instead
+        if isinstance(self.stat_slices, DeltaSliceStore):
+            self.stat_slices.slice_attrs.update(was_steamroll=self.steamroll,
+                                                final_score=self.score,
+                                                final_duration=self.duration.total_seconds())
+            return
+
         for stat in self.stat_slices:
             stat.was_steamroll = self.steamroll
             stat.final_score = self.score
-            stat.final_duration = self.duration.total_seconds
+            stat.final_duration = self.duration.total_seconds()
 
     def process_game_result(self, result):
         self.start_time=datetime.datetime.strptime(result['start'], RCRON_TIME_STR_FORMAT)
@@ -432,7 +1263,11 @@ class HllGame:
 
         return self.steamroll
 
+    # Only once the game has its result, see process_game_result
     def make_y_numpy(self) -> np.ndarray:
+        if self.state != GameState.GAMEOVER:
+            raise ValueError(f'Game on {self.map} has no result yet')
+
         stats = ()
         dtypes = []
 
@@ -450,18 +1285,35 @@ class HllGame:
 
         return np.array([stats], dtype=dtypes)
 
-    def to_numpy(self):
-        self.y = self.make_y_numpy()
-        dtypes = self.stat_slices[0].make_datatypes()
+    # The slice records are already in place, so this is a view rather than a copy. y is left as
+    # None while the game is still on, working it out would end the game.
+    @metrics.timed(metrics.DIGEST_SECONDS, 'to_numpy')
+    def to_numpy(self) -> np.ndarray:
+        self.all_x = self.slice_buffer.view
+        self.y = self.make_y_numpy() if self.state == GameState.GAMEOVER else None
+
+        return self.all_x
+
+    def to_arrow(self) -> 'pa.RecordBatch':
+        return records_to_arrow(self.slice_buffer.view)
+
+    def write_arrow(self, sink):
+        stream = ArrowSliceStream(sink)
+        stream.write_records(self.slice_buffer.view)
+        stream.close()
 
-        self.all_x = np.empty([self.nslices], dtype=dtypes)
+    # Stream every slice so far, then each new slice as it is added, until close_arrow_stream
+    def stream_arrow(self, sink) -> ArrowSliceStream:
+        self.arrow_stream = ArrowSliceStream(sink)
+        if self.nslices > 0:
+            self.arrow_stream.write_records(self.slice_buffer.view)
 
-        for idx, slices in enumerate(self.stat_slices):
-            slice, dtype = slices.to_numpy()
-            slice = tuple(slice)
-            self.all_x[idx]= tuple(slice)
+        return self.arrow_stream
 
-        return 1
+    def close_arrow_stream(self):
+        if self.arrow_stream is not None:
+            self.arrow_stream.close()
+            self.arrow_stream = None
 
     def save_stat_slice(self, fname):
         with open(fname, "a") as f:
@@ -1,18 +1,57 @@
+import asyncio
 import datetime
+import itertools
+import ssl
 from HLLStatsDigester import HllGame, HllGameStatsSlice 
+from cache import SingleFlightCache
+import metrics
 import httpx
 from httpx_retries import Retry, RetryTransport
 
-from typing import Tuple, Any
+from typing import Tuple, Any, List
+
+import numpy as np
 
 lobal_timeout = httpx.Timeout(15.0, read=None)
 retry = Retry(backoff_factor=2, status_forcelist=[httpx.codes.INTERNAL_SERVER_ERROR, httpx.codes.BAD_GATEWAY])
-transport = RetryTransport(retry=retry)
+
+# Connection pool defaults for each server's client. One CRCON host rarely needs more than a
+# handful of sockets, but keep-alive lets every poll reuse the same connection.
+MAX_CONNECTIONS = 10
+MAX_KEEPALIVE_CONNECTIONS = 5
+KEEPALIVE_EXPIRY_S = 60.0
+
+# Loading the CA bundle costs tens of milliseconds, so every server's client shares one context
+_ssl_context : ssl.SSLContext = None
+
+def shared_ssl_context() -> ssl.SSLContext:
+    global _ssl_context
+
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+
+    return _ssl_context
+
+# How long a /get_public_info response is reused. Short enough that game changes still show up
+# on the next poll, long enough that the calls made during one poll share a single request.
+PUBLIC_INFO_TTL_S = 5.0
+
+# Page size used when walking /get_scoreboard_maps, how many pages to read when the history index
+# is first built, and an upper bound on the pages one incremental refresh may walk
+HISTORY_PAGE_SIZE = 50
+HISTORY_INITIAL_PAGES = 1
+HISTORY_MAX_REFRESH_PAGES = 20
+# Upper bound on the pages read past the oldest indexed game to find an older one
+HISTORY_MAX_LOOKBACK_PAGES = 20
+
+# Below this many players on both teams a server is still seeding and its live stats aren't used
+SEEDING_PLAYERS_PER_TEAM = 25
 
 API_EP = '/api'
 GAME_HISTORY_EP = '/get_scoreboard_maps'
 CURRENT_MAP = '/get_public_info'
 LIVE_GAME_STATS = '/get_live_game_stats'
+LOG_STREAM_EP = '/ws/logs'
 EST_TO_GMT = datetime.timedelta(hours=6)
 RCRON_TIME_STR_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
@@ -26,34 +65,243 @@ def convert_rcron_time_str_to_datetime(time : str) -> datetime.datetime:
     dt = datetime.datetime.strptime(time, RCRON_TIME_STR_FORMAT)
     return dt
 
+# Parse a whole column of RCRON time strings in one go instead of a strptime per row
+def convert_rcron_time_strs_to_datetimes(times : List[str]) -> List[datetime.datetime]:
+    return np.array(times, dtype='datetime64[s]').astype(datetime.datetime).tolist()
+
+def is_server_empty(public_info) -> bool:
+    if public_info['result']['player_count'] == 0:
+        return True
+    
+    return False
+
+def is_server_seeding(public_info) -> bool:
+    nallies = public_info['result']['player_count_by_team']['allied']
+    naxies = public_info['result']['player_count_by_team']['axis']
+    
+    if nallies < SEEDING_PLAYERS_PER_TEAM and naxies < SEEDING_PLAYERS_PER_TEAM:
+        return True
+    
+    return False
+
+def needs_live_stats(public_info) -> bool:
+    return not is_server_empty(public_info) and not is_server_seeding(public_info)
+
+# (map id, start time) of the game a /get_public_info response is about, see HllGame.game_id
+def game_id_from_public_info(public_info) -> Tuple[str, int]:
+    current_map = public_info['result']['current_map']
+    return current_map['map']['id'], int(current_map['start'])
+
+# Games from /get_scoreboard_maps keyed by (map id, start time), refreshed by only reading the
+# pages newer than the newest game already indexed
+class GameHistoryIndex:
+    def __init__(self):
+        self.games : dict[Tuple[str, datetime.datetime], dict] = {}
+        self.high_water_mark : datetime.datetime = None
+        self.low_water_mark : datetime.datetime = None
+        # Whether the pages read so far reached the oldest game CRCON has
+        self.reached_end = False
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    def __contains__(self, key) -> bool:
+        return key in self.games
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self.games) == 0
+
+    # Every indexed game, newest first like /get_scoreboard_maps
+    @property
+    def history(self) -> List[dict]:
+        keys = sorted(self.games.keys(), key=lambda key: key[1], reverse=True)
+        return [self.games[key] for key in keys]
+
+    def lookup(self, map_id : str, start : datetime.datetime) -> dict:
+        return self.games.get((map_id, start))
+
+    # Index a page of games. Returns True once the page reaches games at or before `since`, at
+    # which point there is nothing older left to read.
+    def add_games(self, game_list : List[dict], since : datetime.datetime = None) -> bool:
+        if len(game_list) == 0:
+            return True
+
+        starts = convert_rcron_time_strs_to_datetimes([game['start'] for game in game_list])
+
+        reached_since = False
+        for game, start in zip(game_list, starts):
+            if since is not None and start <= since:
+                reached_since = True
+                continue
+
+            # Not finished yet, it'll be picked up again once it has a result
+            if game.get('end') is None:
+                continue
+
+            self.games[(game['map']['id'], start)] = game
+
+            if self.high_water_mark is None or start > self.high_water_mark:
+                self.high_water_mark = start
+            if self.low_water_mark is None or start < self.low_water_mark:
+                self.low_water_mark = start
+
+        return reached_since
+
 class HLLServer:
-    def __init__(self, server_name, uri):
+    def __init__(self, server_name, uri,
+                 http2=False,
+                 max_connections=MAX_CONNECTIONS,
+                 max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry=KEEPALIVE_EXPIRY_S,
+                 public_info_ttl=PUBLIC_INFO_TTL_S,
+                 incremental_games=False,
+                 api_key=None,
+                 archive=None,
+                 steamroll_model=None,
+                 history_pages=HISTORY_INITIAL_PAGES,
+                 transport : httpx.AsyncBaseTransport = None):
         self.server_name = server_name
         self.uri = uri
+        # Only needed for the log stream, see events.CrconEventStream
+        self.api_key = api_key
+        # Whether games from this server aggregate their slices incrementally
+        self.incremental_games = incremental_games
+        # An archive.PayloadArchive that gets every raw live stats and public info response
+        self.archive = archive
+        # A predictor.SteamrollModel given to every game, so they can be scored while they're on
+        self.steamroll_model = steamroll_model
+
+        self.http2 = http2
+        # Replaces the pooled HTTP transport, e.g. an httpx.MockTransport for benchmarks
+        self.transport = transport
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self._client : httpx.AsyncClient = None
+
+        self.public_info_cache = SingleFlightCache(public_info_ttl)
+        # Whether the last public info we saw needed the live stats
+        self.was_populated = False
+
+        self.history = GameHistoryIndex()
+        # Pages of history read when the index is first built. Anything older is only read when a
+        # lookup asks for it.
+        self.history_pages = history_pages
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    # One long lived client per server so every request reuses the pooled connections
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            inner = self.transport
+            if inner is None:
+                inner = httpx.AsyncHTTPTransport(verify=shared_ssl_context(), http2=self.http2, limits=self.limits)
+            if metrics.is_enabled():
+                inner = metrics.InstrumentedTransport(inner)
+            transport = RetryTransport(transport=inner, retry=retry)
+            self._client = httpx.AsyncClient(transport=transport)
+
+        return self._client
+
+    @property
+    def auth_headers(self) -> dict:
+        return {'Authorization' : f'Bearer {self.api_key}'} if self.api_key is not None else {}
+
+    @property
+    def log_stream_url(self) -> str:
+        scheme, sep, rest = self.uri.partition('://')
+        scheme = {'https' : 'wss', 'http' : 'ws'}.get(scheme, scheme)
+        return f"{scheme}{sep}{rest.rstrip('/')}{LOG_STREAM_EP}"
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def public_info_hits(self) -> int:
+        return self.public_info_cache.hits
+
+    @property
+    def public_info_misses(self) -> int:
+        return self.public_info_cache.misses
+
+    # Return /get_public_info, shared between every caller within the cache TTL
+    async def get_public_info(self, force_refresh=False) -> dict[Any : Any]:
+        return await self.public_info_cache.get(self._fetch_public_info, force_refresh=force_refresh)
+
+    async def _fetch_public_info(self) -> dict[Any : Any]:
+        url = f'{self.uri}/{API_EP}/{CURRENT_MAP}'
+        response = await self.client.get(url)
+
+        if response.status_code != httpx.codes.OK:
+            raise ConnectionError(f'Got a non-200 response code in \'get_public_info\' for url: {url}')
+
+        public_info = response.json()
+        if public_info['failed']:
+            raise ValueError(f'Bad response from CRCON in \'get_public_info\' for url: {url}')
+
+        if self.archive is not None:
+            self.archive.record(self.server_name, CURRENT_MAP.lstrip('/'), response.content)
+
+        return public_info
 
     # Return the current game
     async def get_current_game(self) -> HllGame:
-        async with httpx.AsyncClient(transport=transport) as client:
-            url = f'{self.uri}/{API_EP}/{CURRENT_MAP}'
-            response = await client.get(url)
+        return self.new_game(await self.get_current_game_id())
 
-        if response.status_code != httpx.codes.OK:
-            print(f"ERROR: Got a non-200 response code in 'get_current_game' for url: {url}")
+    # Return (map id, start time) of the current game. This is all it takes to tell games apart, so
+    # checks that only compare games use it rather than building an HllGame.
+    async def get_current_game_id(self) -> Tuple[str, int]:
+        return game_id_from_public_info(await self.get_public_info())
 
-        r = response.json()
-        if r['failed']:
-            raise ValueError(f'Bad response from CRCON in \'get_current_game\' for url: {url}')
+    # A new HllGame for a (map id, start time) from get_current_game_id or poll
+    def new_game(self, game_id : Tuple[str, int]) -> HllGame:
+        map_id, start_time_s = game_id
+        return HllGame(self, map_id, start_time_s, incremental=self.incremental_games,
+                       steamroll_model=self.steamroll_model)
+
+    # Returns (game id, stats, public_info) for one tick of the bot, see get_current_game_id.
+    # Everything comes from the same public info, and while the server stays populated the live
+    # stats are fetched alongside it, so a busy tick costs one round trip. stats is None when the
+    # server is empty or seeding.
+    async def poll(self) -> Tuple[Tuple[str, int], dict[Any : Any], dict[Any : Any]]:
+        stats, public_info = await self.get_current_game_stats()
+
+        return game_id_from_public_info(public_info), stats, public_info
+
+    # Returns (stats, public_info). The cheap public info decides whether the heavy live stats are
+    # needed at all; stats is None when the server is empty or seeding and skip_if_idle is set.
+    async def get_current_game_stats(self, skip_if_idle=True) -> Tuple[dict[Any : Any], dict[Any : Any]]:
+        if not skip_if_idle or (self.was_populated and not self.public_info_cache.is_fresh):
+            # Probably still populated, so fetch both at once rather than one after the other
+            stats, public_info = await asyncio.gather(self._fetch_live_game_stats(), self.get_public_info())
+            self.was_populated = needs_live_stats(public_info)
 
-        current_map = {'map_id' : None, 'start_time_s' : None} 
-        map_id = r['result']['current_map']['map']['id']
-        start_time_s = int(r['result']['current_map']['start'])
+            if skip_if_idle and not self.was_populated:
+                stats = None
 
-        return HllGame(self, map_id, start_time_s)
+            return stats, public_info
 
-    async def get_current_game_stats(self) -> dict[Any : Any]:
-        async with httpx.AsyncClient(transport=transport) as client:
-            url = f'{self.uri}/{API_EP}/{LIVE_GAME_STATS}'
-            response = await client.get(url)
+        public_info = await self.get_public_info()
+        self.was_populated = needs_live_stats(public_info)
+
+        if not self.was_populated:
+            return None, public_info
+
+        stats = await self._fetch_live_game_stats()
+
+        return stats, public_info
+
+    async def _fetch_live_game_stats(self) -> dict[Any : Any]:
+        url = f'{self.uri}/{API_EP}/{LIVE_GAME_STATS}'
+        response = await self.client.get(url)
 
         if response.status_code != httpx.codes.OK:
             raise ConnectionError(f'Got a non-200 response code in \'get_current_game_stats\' for url: {url}')
@@ -62,76 +310,88 @@ class HLLServer:
         if stats['failed']:
             raise ValueError(f'Bad response from CRCON in \'get_current_game_stats\' for url: {url}')
 
-        async with httpx.AsyncClient(transport=transport) as client:
-            url = f'{self.uri}/{API_EP}/{CURRENT_MAP}'
-            response = await client.get(url)
+        if self.archive is not None:
+            self.archive.record(self.server_name, LIVE_GAME_STATS.lstrip('/'), response.content)
 
-        if response.status_code != httpx.codes.OK:
-            print(f"ERROR: Got a non-200 response code in 'get_current_game_stats' for url: {url}")
-
-        public_info = response.json()
-        if public_info['failed']:
-            raise ValueError(f'Bad response from CRCON in \'get_current_game_stats\' for url: {url}')
-        
-        
-        return stats, public_info
+        return stats
 
     # Is the game with game_id over?
     async def is_game_over(self, game: HllGameStatsSlice) -> bool:
-        async with httpx.AsyncClient(transport=transport) as client:
-            url = f'{self.uri}/{API_EP}/{CURRENT_MAP}'
-            response = await client.get(url)
+        return game.game_id != await self.get_current_game_id()
 
-        if response.status_code != httpx.codes.OK:
-            raise ConnectionError(f'Got a non-200 response code in \'is_game_over\' for url: {url}')
-        
-        r = response.json()
-        if r['failed']:
-            raise ValueError(f'Bad response from CRCON in \'is_game_over\' for url: {url}')
+    # Get information about the game
+    async def get_game(self, game: dict[str : str, str : int]) -> dict[any : any]:
+        game_start_datetime = convert_s_to_datetime(game.start_time_s)
 
-        current_map = await self.get_current_game()
+        game_match = self.history.lookup(game.map, game_start_datetime)
+        if game_match is None:
+            await self.refresh_history()
+            game_match = self.history.lookup(game.map, game_start_datetime)
 
-        if game.map == current_map.map and game.start_time_s == current_map.start_time_s:
-            return False
+        # Older than anything indexed so far
+        if game_match is None and self.history.low_water_mark is not None and game_start_datetime < self.history.low_water_mark:
+            await self.extend_history(game_start_datetime)
+            game_match = self.history.lookup(game.map, game_start_datetime)
 
-        return True
+        return game_match
 
-    # Get information about the game
-    async def get_game(self, game: dict[str : str, str : int]) -> dict[any : any]:
+    # Every game in /get_scoreboard_maps, newest first. Reads pages until the end of the history,
+    # or only the newest max_pages pages. The games stay indexed, so later calls only read pages
+    # that are new or not read yet.
+    async def get_history(self, max_pages=None) -> List[dict]:
+        await self.refresh_history()
 
-        # Make a call to the GAME_HISTORY_EP to first get a list of all the maps..
-        async with httpx.AsyncClient(transport=transport) as client:
-            url = f'{self.uri}/{API_EP}/{GAME_HISTORY_EP}'
-            response = await client.get(url)
+        if not self.history.reached_end:
+            if max_pages is None:
+                await self.extend_history(datetime.datetime.min, max_pages=None)
+            elif len(self.history) < max_pages * HISTORY_PAGE_SIZE:
+                first_page = max(1, len(self.history) // HISTORY_PAGE_SIZE)
+                await self.extend_history(datetime.datetime.min, max_pages=max_pages - first_page + 1)
 
-        if response.status_code != httpx.codes.OK:
-            raise ConnectionError(f'Got a non-200 response code in \'get_game\' for url: {url}')
+        history = self.history.history
+        if max_pages is not None:
+            history = history[:max_pages * HISTORY_PAGE_SIZE]
 
-        r = response.json()
-        if r['failed']:
-            raise ValueError(f'Bad response from CRCON in \'get_game\' for url: {url}')
+        return history
 
-        # Now search through the list of resutls and find the game by the id and the start time
-        game_list = r['result']['maps']
+    # Read /get_scoreboard_maps pages, newest first, until we reach games that are already indexed
+    async def refresh_history(self, max_pages=None):
+        if max_pages is None:
+            max_pages = self.history_pages if self.history.is_empty else HISTORY_MAX_REFRESH_PAGES
 
-        game_start_datetime = convert_s_to_datetime(game.start_time_s)
-        game_match = None
-        for prev_game in game_list:
-            prev_game_start_time = convert_rcron_time_str_to_datetime(prev_game['start'])
+        since = self.history.high_water_mark
+        for page in range(1, max_pages + 1):
+            result = await self.get_history_page(page)
+            game_list = result['maps']
 
-            if game.map == prev_game['map']['id'] and game_start_datetime == prev_game_start_time:
-                game_match = prev_game
+            if self.history.add_games(game_list, since=since):
                 break
-            else:
-                continue
 
-        return game_match
+            if page * HISTORY_PAGE_SIZE >= result.get('total', 0):
+                self.history.reached_end = True
+                break
 
+    # Read /get_scoreboard_maps pages past the oldest indexed game until they reach `until`. Games
+    # that finished since the index was built push the older ones back, so this starts a page early
+    # and lets the index drop the overlap. max_pages=None reads to the end if need be.
+    async def extend_history(self, until : datetime.datetime, max_pages=HISTORY_MAX_LOOKBACK_PAGES):
+        first_page = max(1, len(self.history) // HISTORY_PAGE_SIZE)
+        pages = itertools.count(first_page) if max_pages is None else range(first_page, first_page + max_pages)
+        for page in pages:
+            result = await self.get_history_page(page)
+            game_list = result['maps']
+            self.history.add_games(game_list)
+
+            if len(game_list) == 0 or page * HISTORY_PAGE_SIZE >= result.get('total', 0):
+                self.history.reached_end = True
+                break
 
-    async def get_history(self) -> dict[any : any]:
-        async with httpx.AsyncClient(transport=transport) as client:
-            url = f'{self.uri}/{API_EP}/{GAME_HISTORY_EP}'
-            response = await client.get(url)
+            if self.history.low_water_mark is not None and self.history.low_water_mark <= until:
+                break
+
+    async def get_history_page(self, page=1, limit=HISTORY_PAGE_SIZE) -> dict[any : any]:
+        url = f'{self.uri}/{API_EP}/{GAME_HISTORY_EP}'
+        response = await self.client.get(url, params={'page' : page, 'limit' : limit})
 
         if response.status_code != httpx.codes.OK:
             raise ConnectionError(f'Got a non-200 response code in \'get_history\' for url: {url}')
@@ -140,6 +400,4 @@ class HLLServer:
         if r['failed']:
             raise ValueError(f'Bad response from CRCON in \'get_history\' for url: {url}')
 
-        return r['result']['maps']
-
-    
+        return r['result']
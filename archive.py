@@ -0,0 +1,315 @@
+# Opt-in archive of the raw CRCON responses behind every slice, so past games can be digested
+# again after HllSideStats or the team detection rules change.
+#
+#   archive = PayloadArchive('archive/')
+#   HLLServer(name, uri, archive=archive)
+#   ...
+#   python archive.py replay archive/ --workers 8
+#
+# Each response becomes one JSON line, {"t", "server", "endpoint", "body"}, with the body copied in
+# exactly as CRCON sent it. Lines go into gzip chunk files that are only ever appended to and are
+# rotated by size and age. The poll path only puts the response on a queue; compressing and
+# writing happen on the archive's own thread. A chunk that was being written when the process died
+# reads back up to its last flush.
+import argparse
+import atexit
+import concurrent.futures
+import datetime
+import glob
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from HLLStatsDigester import HllGameStatsSlice, slice_dtype
+import metrics
+
+LIVE_GAME_STATS = 'get_live_game_stats'
+PUBLIC_INFO = 'get_public_info'
+
+CHUNK_SUFFIX = '.jsonl.gz'
+# Uncompressed bytes and seconds before a chunk is closed and the next one started
+CHUNK_BYTES = 256 * 1024 * 1024
+CHUNK_S = 60 * 60
+COMPRESS_LEVEL = 6
+# Responses waiting to be written. When the writer falls this far behind, new ones are dropped
+# rather than letting the poll path wait.
+MAX_QUEUE = 1024
+# A live stats response is digested with the public info fetched closest to it, if within this
+MAX_PAIR_S = 30.0
+
+_STOP = object()
+
+
+def _chunk_name(prefix : str, started : float, seq : int) -> str:
+    stamp = datetime.datetime.fromtimestamp(started, datetime.timezone.utc).strftime('%Y%m%dT%H%M%S')
+    return f'{prefix}-{stamp}-{seq:06d}{CHUNK_SUFFIX}'
+
+# One archive line. The body is spliced in without being decoded again; a newline can only sit
+# between JSON tokens, so swapping it for a space keeps the body the same document.
+def encode_record(t : float, server : str, endpoint : str, body : bytes, carried=False) -> bytes:
+    head = {'t' : t, 'server' : server, 'endpoint' : endpoint}
+    if carried:
+        head['carried'] = True
+
+    body = body.replace(b'\r', b' ').replace(b'\n', b' ')
+    return json.dumps(head)[:-1].encode() + b', "body": ' + body + b'}\n'
+
+
+class PayloadArchive:
+    def __init__(self, directory : str, prefix='crcon', chunk_bytes=CHUNK_BYTES, chunk_s=CHUNK_S,
+                 compresslevel=COMPRESS_LEVEL, max_queue=MAX_QUEUE):
+        self.directory = directory
+        self.prefix = prefix
+        self.chunk_bytes = chunk_bytes
+        self.chunk_s = chunk_s
+        self.compresslevel = compresslevel
+
+        self.queue : queue.Queue = queue.Queue(maxsize=max_queue)
+        self.nrecords : int = 0
+        self.ndropped : int = 0
+        self.nchunks : int = 0
+
+        # Only touched by the writer thread
+        self._file : gzip.GzipFile = None
+        self._chunk_started : float = None
+        self._chunk_nbytes : int = 0
+        # The newest public info per server, repeated at the top of each chunk so every chunk can
+        # be replayed on its own
+        self._public_info : Dict[str, Tuple[float, bytes]] = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='payload-archive', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __str__(self) -> str:
+        return f'<PayloadArchive(Dir:{self.directory}, Records:{self.nrecords}, Dropped:{self.ndropped}, Chunks:{self.nchunks})>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Called on the poll path, never blocks. body is the response bytes.
+    def record(self, server : str, endpoint : str, body : bytes):
+        try:
+            self.queue.put_nowait((time.time(), server, endpoint, body))
+        except queue.Full:
+            self.ndropped += 1
+            metrics.ARCHIVE_RECORDS.labels('dropped').inc()
+
+    # Write whatever is queued, finish the current chunk and stop the writer
+    def close(self):
+        if not self._thread.is_alive():
+            return
+
+        self.queue.put(_STOP)
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                batch = []
+                while item is not _STOP:
+                    batch.append(item)
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                self._write(batch)
+
+                if item is _STOP:
+                    break
+        finally:
+            self._close_chunk()
+
+    def _write(self, batch : list):
+        for t, server, endpoint, body in batch:
+            if self._file is None or self._chunk_nbytes >= self.chunk_bytes or t - self._chunk_started >= self.chunk_s:
+                self._open_chunk(t)
+
+            self._write_line(encode_record(t, server, endpoint, body))
+            if endpoint == PUBLIC_INFO:
+                self._public_info[server] = (t, body)
+
+            self.nrecords += 1
+            metrics.ARCHIVE_RECORDS.labels('written').inc()
+
+        # A sync flush per batch rather than per record, so a quiet bot still gets its responses
+        # onto disk without a busy one paying for a flush each
+        if self._file is not None:
+            self._file.flush()
+
+    def _write_line(self, line : bytes):
+        self._file.write(line)
+        self._chunk_nbytes += len(line)
+        metrics.ARCHIVE_BYTES.labels().inc(len(line))
+
+    def _open_chunk(self, t : float):
+        self._close_chunk()
+
+        path = os.path.join(self.directory, _chunk_name(self.prefix, t, self.nchunks))
+        self._file = gzip.GzipFile(path, mode='ab', compresslevel=self.compresslevel)
+        self._chunk_started = t
+        self._chunk_nbytes = 0
+        self.nchunks += 1
+
+        for server, (info_t, body) in self._public_info.items():
+            self._write_line(encode_record(info_t, server, PUBLIC_INFO, body, carried=True))
+
+    def _close_chunk(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def chunk_paths(path : str) -> List[str]:
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, f'*{CHUNK_SUFFIX}')))
+
+    return [path]
+
+# The records of one chunk in the order they were written. A chunk cut off mid write ends at its
+# last complete line.
+def read_chunk(path : str) -> Iterator[dict]:
+    with gzip.open(path, 'rb') as f:
+        try:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                yield json.loads(line)
+        except EOFError:
+            return
+
+def read_archive(path : str) -> Iterator[dict]:
+    for chunk in chunk_paths(path):
+        yield from read_chunk(chunk)
+
+
+# Runs in a worker process: digest every live stats response in a chunk with the public info
+# closest to it in time from the same server. Returns, per server, the response times and the
+# slice records, plus how many responses couldn't be paired.
+def replay_chunk(path : str, max_pair_s=MAX_PAIR_S) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], int]:
+    stats : Dict[str, List[Tuple[float, dict]]] = {}
+    public_info : Dict[str, List[Tuple[float, dict]]] = {}
+
+    for record in read_chunk(path):
+        by_server = stats if record['endpoint'] == LIVE_GAME_STATS else public_info
+        by_server.setdefault(record['server'], []).append((record['t'], record['body']))
+
+    dtype = slice_dtype()
+    replayed = {}
+    nunpaired = 0
+    for server, responses in stats.items():
+        infos = sorted(public_info.get(server, []), key=lambda info: info[0])
+        info_t = np.array([t for t, _ in infos], dtype=np.float64)
+
+        times = []
+        rows = []
+        for t, body in responses:
+            if len(infos) == 0:
+                nunpaired += 1
+                continue
+
+            idx = int(np.searchsorted(info_t, t))
+            nearest = min((i for i in (idx - 1, idx) if 0 <= i < len(infos)), key=lambda i: abs(info_t[i] - t))
+            if abs(info_t[nearest] - t) > max_pair_s:
+                nunpaired += 1
+                continue
+
+            times.append(t)
+            rows.append(HllGameStatsSlice(stats=body, public_info=infos[nearest][1]).to_row())
+
+        replayed[server] = (np.array(times, dtype=np.float64), np.array(rows, dtype=dtype))
+
+    return replayed, nunpaired
+
+class ReplayResult:
+    def __init__(self):
+        # Per server, response times and slice records, both in time order
+        self.times : Dict[str, np.ndarray] = {}
+        self.records : Dict[str, np.ndarray] = {}
+        self.nunpaired : int = 0
+
+    def __len__(self) -> int:
+        return sum(len(records) for records in self.records.values())
+
+    def add(self, replayed : Dict[str, Tuple[np.ndarray, np.ndarray]], nunpaired : int):
+        self.nunpaired += nunpaired
+        for server, (times, records) in replayed.items():
+            if server in self.times:
+                times = np.concatenate((self.times[server], times))
+                records = np.concatenate((self.records[server], records))
+            self.times[server] = times
+            self.records[server] = records
+
+    def sort(self):
+        for server, times in self.times.items():
+            order = np.argsort(times, kind='stable')
+            self.times[server] = times[order]
+            self.records[server] = self.records[server][order]
+
+# Chunks are independent, so each one goes to its own worker process
+def replay(path : str, workers=None, max_pair_s=MAX_PAIR_S) -> ReplayResult:
+    chunks = chunk_paths(path)
+    result = ReplayResult()
+
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            result.add(*replay_chunk(chunk, max_pair_s))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for replayed in executor.map(replay_chunk, chunks, [max_pair_s] * len(chunks)):
+                result.add(*replayed)
+
+    result.sort()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect or replay an archive of raw CRCON responses')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    replay_parser = subparsers.add_parser('replay', help='digest every archived live stats response again')
+    replay_parser.add_argument('path', help='archive directory or a single chunk')
+    replay_parser.add_argument('--workers', type=int, default=None)
+    replay_parser.add_argument('--max-pair', type=float, default=MAX_PAIR_S,
+                               help='seconds between a live stats response and the public info it is digested with')
+    replay_parser.add_argument('--output', help='save the slice records per server to this .npz file')
+
+    stats_parser = subparsers.add_parser('stats', help='count the responses in each chunk')
+    stats_parser.add_argument('path', help='archive directory or a single chunk')
+
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        started = time.perf_counter()
+        result = replay(args.path, workers=args.workers, max_pair_s=args.max_pair)
+        elapsed = time.perf_counter() - started
+
+        print(f'Replayed {len(result)} slices from {len(chunk_paths(args.path))} chunks in {elapsed:.2f}s '
+              f'({len(result) / max(elapsed, 1e-9):,.1f} slices/s), {result.nunpaired} without public info')
+        for server, records in result.records.items():
+            print(f'  {server}: {len(records)} slices')
+
+        if args.output is not None:
+            np.savez(args.output, **{server : records for server, records in result.records.items()})
+    else:
+        for chunk in chunk_paths(args.path):
+            counts = {}
+            for record in read_chunk(chunk):
+                key = (record['server'], record['endpoint'])
+                counts[key] = counts.get(key, 0) + 1
+            print(f'{chunk}: {os.path.getsize(chunk):,} bytes')
+            for (server, endpoint), count in sorted(counts.items()):
+                print(f'  {server} {endpoint}: {count}')
@@ -0,0 +1,296 @@
+# Rebuild steamroll history from /get_scoreboard_maps across many servers.
+#
+#   python backfill.py --server "Glow's East=https://scoreboard-us-east-1.glows.gg/" --db steamrolls.sqlite
+#
+# Histories are pulled from every server concurrently. Pages are grouped into chunks as they
+# arrive and classified in a process pool while the next pages are fetched, and each chunk is
+# written to a SQLite store in one transaction together with how far the run has got. Chunks are
+# stored in page order, so that progress always marks a contiguous range: a run cut short, by
+# --max-pages or an error, carries on from the oldest page it hadn't stored. Once a run reaches the
+# server's checkpoint, the newest game it started from becomes the checkpoint and a rerun only
+# reads the pages newer than that. The (server, map, start) key drops any game seen before.
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+from dataclasses import dataclass
+import sqlite3
+import time
+import traceback
+from typing import List, Tuple
+
+from HllServer import HLLServer, HISTORY_PAGE_SIZE
+from HLLStatsDigester import HllGame
+from utilities import Team
+
+DEFAULT_CHUNK_SIZE = 200
+DEFAULT_MAX_CONCURRENT_SERVERS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    server TEXT NOT NULL,
+    map_id TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT,
+    game_mode TEXT,
+    allied_score INTEGER,
+    axis_score INTEGER,
+    duration_s INTEGER,
+    steamroll INTEGER,
+    steamroll_reason TEXT,
+    PRIMARY KEY (server, map_id, start)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    server TEXT PRIMARY KEY,
+    newest_start TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS progress (
+    server TEXT PRIMARY KEY,
+    run_newest TEXT NOT NULL,
+    next_offset INTEGER NOT NULL,
+    total INTEGER NOT NULL
+);
+"""
+
+
+# Runs in the worker processes, so it only takes and returns plain data. Returns the rows and
+# how many games couldn't be classified.
+def classify_games(server_name : str, games : List[dict]) -> Tuple[List[Tuple], int]:
+    rows = []
+    nrejected = 0
+    for game in games:
+        try:
+            hllgame = HllGame()
+            hllgame.process_game_result(game)
+            steamroll = hllgame.was_steamroll()
+        except (KeyError, TypeError, ValueError) as e:
+            nrejected += 1
+            print(f"ERROR: Couldn't classify {game.get('map', {}).get('id')} at {game.get('start')} "
+                  f"from '{server_name}': {e!r}")
+            continue
+
+        rows.append((server_name, game['map']['id'], game['start'], game['end'], hllgame.game_mode,
+                     hllgame.score[Team.ALLIES], hllgame.score[Team.AXIS], int(hllgame.duration.total_seconds()),
+                     int(steamroll), hllgame.steamroll_reason))
+
+    return rows, nrejected
+
+
+# How far an unfinished run got: the newest game it started from, and how many games were ahead of
+# its oldest unstored page out of the history's total at the time
+@dataclass
+class Progress:
+    run_newest : str
+    next_offset : int
+    total : int
+
+    # The page to carry on from. Games finished since are listed ahead of it, pushing it back.
+    def resume_page(self, total : int) -> int:
+        return (self.next_offset + max(0, total - self.total)) // HISTORY_PAGE_SIZE + 1
+
+
+class BackfillStore:
+    def __init__(self, path : str):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def checkpoint(self, server_name : str) -> str:
+        row = self.db.execute('SELECT newest_start FROM checkpoints WHERE server = ?', (server_name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def progress(self, server_name : str) -> Progress:
+        row = self.db.execute('SELECT run_newest, next_offset, total FROM progress WHERE server = ?',
+                              (server_name,)).fetchone()
+        return Progress(*row) if row is not None else None
+
+    def _insert(self, rows : List[Tuple]) -> int:
+        before = self.db.total_changes
+        self.db.executemany('INSERT OR IGNORE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return self.db.total_changes - before
+
+    # Store a chunk and how far the run has got, or neither
+    def add_games(self, server_name : str, rows : List[Tuple], progress : Progress) -> int:
+        with self.db:
+            nstored = self._insert(rows)
+            self.db.execute('INSERT INTO progress (server, run_newest, next_offset, total) VALUES (?, ?, ?, ?) '
+                            'ON CONFLICT(server) DO UPDATE SET run_newest = excluded.run_newest, '
+                            'next_offset = excluded.next_offset, total = excluded.total',
+                            (server_name, progress.run_newest, progress.next_offset, progress.total))
+        return nstored
+
+    # Store a run's last chunk and move the checkpoint up to where the run started, or neither
+    def finish_run(self, server_name : str, rows : List[Tuple], newest_start : str) -> int:
+        with self.db:
+            nstored = self._insert(rows)
+            if newest_start is not None:
+                self.db.execute('INSERT INTO checkpoints (server, newest_start) VALUES (?, ?) '
+                                'ON CONFLICT(server) DO UPDATE SET newest_start = excluded.newest_start',
+                                (server_name, newest_start))
+            self.db.execute('DELETE FROM progress WHERE server = ?', (server_name,))
+        return nstored
+
+
+class Backfill:
+    def __init__(self, servers : List[HLLServer], store : BackfillStore,
+                 workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_concurrent_servers=DEFAULT_MAX_CONCURRENT_SERVERS, max_pages=None):
+        self.servers = servers
+        self.store = store
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_pages = max_pages
+        self.semaphore = asyncio.Semaphore(max_concurrent_servers)
+
+        self.nfetched : int = 0
+        self.nclassified : int = 0
+        self.nrejected : int = 0
+        self.nstored : int = 0
+
+    # Newest first, from where the last run stopped, until the checkpoint or the end of the
+    # history. Yields each page's finished games newer than the checkpoint, the number of games
+    # listed up to the end of the page and the history's total, and whether the run is complete.
+    # Unfinished games are left for the next run.
+    async def fetch_pages(self, server : HLLServer, since : str, progress : Progress):
+        page = 1
+        if progress is not None:
+            result = await server.get_history_page(1)
+            page = progress.resume_page(result.get('total', 0))
+
+        npages = 0
+        while True:
+            result = await server.get_history_page(page)
+            game_list = result['maps']
+            total = result.get('total', 0)
+            npages += 1
+
+            games = []
+            reached_since = False
+            for game in game_list:
+                if since is not None and game['start'] <= since:
+                    reached_since = True
+                    continue
+                if game.get('end') is None:
+                    continue
+                games.append(game)
+
+            done = reached_since or len(game_list) == 0 or page * HISTORY_PAGE_SIZE >= total
+            yield games, page * HISTORY_PAGE_SIZE, total, done
+
+            if done or (self.max_pages is not None and npages >= self.max_pages):
+                return
+            page += 1
+
+    async def _store_chunk(self, server : HLLServer, future : asyncio.Future, progress : Progress, done : bool) -> int:
+        rows, nrejected = await future
+        self.nclassified += len(rows)
+        self.nrejected += nrejected
+
+        if done:
+            nstored = self.store.finish_run(server.server_name, rows, progress.run_newest)
+        else:
+            nstored = self.store.add_games(server.server_name, rows, progress)
+        self.nstored += nstored
+
+        return nrejected
+
+    async def backfill_server(self, server : HLLServer, pool : concurrent.futures.Executor):
+        loop = asyncio.get_running_loop()
+
+        since = self.store.checkpoint(server.server_name)
+        progress = self.store.progress(server.server_name)
+        run_newest = progress.run_newest if progress is not None else None
+
+        # Chunks being classified, in page order, each with the progress it completes
+        pending = collections.deque()
+        # The same game can be listed on two pages if a new one lands while we're paging
+        seen = set()
+        chunk = []
+        nfetched = 0
+        nrejected = 0
+
+        async with self.semaphore:
+            try:
+                async for games, offset, total, done in self.fetch_pages(server, since, progress):
+                    for game in games:
+                        key = (game['map']['id'], game['start'])
+                        if key not in seen:
+                            seen.add(key)
+                            chunk.append(game)
+                            # A resumed run keeps the newest game it started from
+                            if progress is None and (run_newest is None or game['start'] > run_newest):
+                                run_newest = game['start']
+                    nfetched += len(games)
+                    last = (offset, total, done)
+
+                    if run_newest is not None and (done or len(chunk) >= self.chunk_size):
+                        future = loop.run_in_executor(pool, classify_games, server.server_name, chunk)
+                        pending.append((future, Progress(run_newest, offset, total), done))
+                        chunk = []
+                    elif done:
+                        # Nothing new since the checkpoint
+                        self.store.finish_run(server.server_name, [], None)
+
+                    # Store whatever has been classified, keeping to page order
+                    while len(pending) > 0 and pending[0][0].done():
+                        nrejected += await self._store_chunk(server, *pending.popleft())
+
+                # Stopped by --max-pages with a chunk still open
+                if len(chunk) > 0:
+                    future = loop.run_in_executor(pool, classify_games, server.server_name, chunk)
+                    pending.append((future, Progress(run_newest, last[0], last[1]), last[2]))
+            finally:
+                await server.aclose()
+                self.nfetched += nfetched
+
+                # Pages fetched but not yet chunked after an error are simply read again next run
+                while len(pending) > 0:
+                    nrejected += await self._store_chunk(server, *pending.popleft())
+
+        print(f"{server.server_name}: {nfetched} new games, {nrejected} rejected")
+
+    async def run(self):
+        started = time.monotonic()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = await asyncio.gather(*[self.backfill_server(server, pool) for server in self.servers],
+                                           return_exceptions=True)
+
+        for server, result in zip(self.servers, results):
+            if isinstance(result, Exception):
+                print(f"ERROR: Backfill of '{server.server_name}' failed")
+                traceback.print_exception(result)
+
+        elapsed = time.monotonic() - started
+        rate = self.nclassified / elapsed if elapsed > 0 else 0.0
+        print(f"Fetched {self.nfetched} games, classified {self.nclassified}, rejected {self.nrejected}, "
+              f"stored {self.nstored} new in {elapsed:.1f}s ({rate:,.0f} games/sec)")
+
+
+def parse_server(value : str) -> HLLServer:
+    name, sep, uri = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=URI, got '{value}'")
+
+    return HLLServer(name, uri)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Backfill steamroll history from CRCON game history')
+    parser.add_argument('--server', type=parse_server, action='append', required=True, help='NAME=URI, may be repeated')
+    parser.add_argument('--db', default='steamrolls.sqlite')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--max-concurrent-servers', type=int, default=DEFAULT_MAX_CONCURRENT_SERVERS)
+    parser.add_argument('--max-pages', type=int, default=None)
+    args = parser.parse_args()
+
+    store = BackfillStore(args.db)
+    backfill = Backfill(args.server, store,
+                        workers=args.workers,
+                        chunk_size=args.chunk_size,
+                        max_concurrent_servers=args.max_concurrent_servers,
+                        max_pages=args.max_pages)
+    asyncio.run(backfill.run())
+    store.close()
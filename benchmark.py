@@ -0,0 +1,329 @@
+# Benchmarks for the stats digester and the bot's poll path, run with: python benchmark.py
+#
+# Every payload comes from the seeded generators in synthetic.py, so runs with the same --seed
+# time the same work. --output writes the results as JSON and --compare checks a run against an
+# earlier one, exiting non-zero if anything got slower than --threshold allows.
+#
+#   python benchmark.py --output baseline.json
+#   python benchmark.py --compare baseline.json
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import platform
+import random
+import sys
+import timeit
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from HllServer import HLLServer, HISTORY_MAX_LOOKBACK_PAGES, HISTORY_PAGE_SIZE
+from HLLStatsDigester import HllGame, HllGameStatsSlice
+from predictor import FEATURE_NAMES, SteamrollModel
+from synthetic import (SyntheticCrcon, make_live_game_stats, make_public_info, make_snapshots,
+                       rcron_time_str_to_s)
+from utilities import Team, detect_team, detect_teams
+
+PLAYER_COUNTS = (10, 50, 100)
+TICK_PLAYER_COUNTS = (50, 100)
+# Response delay for the round trip count of a tick, large enough to swamp the digest itself
+TICK_LATENCY_S = 0.05
+HISTORY_SIZES = (100, 1000, 5000)
+DEFAULT_THRESHOLD = 0.2
+
+
+# Seconds per call of each named benchmark, with the parameters it ran with
+class Results:
+    def __init__(self):
+        self.results : Dict[str, dict] = {}
+
+    def record(self, name : str, seconds : float, **params):
+        self.results[name] = {'seconds' : seconds, **params}
+
+    def time(self, name : str, fn : Callable, repeat : int, number=1, **params) -> float:
+        seconds = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+        self.record(name, seconds, **params)
+        return seconds
+
+    def to_json(self, args) -> dict:
+        return {'meta' : {'created' : datetime.datetime.now().isoformat(timespec='seconds'),
+                          'python' : platform.python_version(),
+                          'numpy' : np.__version__,
+                          'platform' : platform.platform(),
+                          'seed' : args.seed,
+                          'repeat' : args.repeat},
+                'results' : self.results}
+
+
+# The per-datum path process_stats used before columnar ingestion
+def process_stats_per_datum(rcon_stats, public_info) -> HllGameStatsSlice:
+    stat_slice = HllGameStatsSlice()
+    stat_slice._process_public_info(public_info)
+
+    for player in rcon_stats['result']['stats']:
+        team, _ = detect_team(player)
+
+        if team == Team.UNKNOWN:
+            continue
+
+        for stat in player:
+            if stat not in stat_slice.teams[team]:
+                continue
+
+            stat_slice.teams[team].add_datum(stat, player[stat])
+
+    return stat_slice
+
+def check_same_aggregates(a : HllGameStatsSlice, b : HllGameStatsSlice):
+    for team in a.teams:
+        for stat_a, stat_b in zip(a.teams[team].stats, b.teams[team].stats):
+            for agg in ('sum', 'mean', 'median', 'std'):
+                if not np.isclose(getattr(stat_a, agg), getattr(stat_b, agg)):
+                    raise AssertionError(f'{team} {stat_a.name} {agg}: {getattr(stat_a, agg)} != {getattr(stat_b, agg)}')
+
+def bench_process_stats(results : Results, nplayers : int, repeat : int, seed : int):
+    rng = random.Random(seed)
+    stats = make_live_game_stats(rng, nplayers)
+    public_info = make_public_info(rng, nplayers)
+
+    check_same_aggregates(process_stats_per_datum(stats, public_info), HllGameStatsSlice(stats, public_info))
+
+    per_datum = results.time(f'process_stats.per_datum.{nplayers}', lambda: process_stats_per_datum(stats, public_info),
+                             repeat, nplayers=nplayers)
+    columnar = results.time(f'process_stats.columnar.{nplayers}', lambda: HllGameStatsSlice(stats, public_info),
+                            repeat, nplayers=nplayers)
+
+    print(f'process_stats {nplayers:>3} players: per datum {per_datum * 1000:8.2f} ms, '
+          f'columnar {columnar * 1000:8.2f} ms, speedup {per_datum / columnar:5.1f}x')
+
+def bench_detect_team(results : Results, nplayers : int, repeat : int, seed : int):
+    rng = random.Random(seed)
+    players = make_live_game_stats(rng, nplayers)['result']['stats']
+
+    if [detect_team(player) for player in players] != detect_teams(players):
+        raise AssertionError('detect_teams does not match detect_team')
+
+    per_player = results.time(f'detect_team.per_player.{nplayers}', lambda: [detect_team(player) for player in players],
+                              repeat, number=10, nplayers=nplayers)
+    batch = results.time(f'detect_team.batch.{nplayers}', lambda: detect_teams(players),
+                         repeat, number=10, nplayers=nplayers)
+
+    print(f'detect_team   {nplayers:>3} players: per player {per_player * 1000:6.2f} ms, '
+          f'batch {batch * 1000:6.2f} ms, speedup {per_player / batch:5.1f}x')
+
+def bench_incremental(results : Results, nplayers : int, nsnapshots : int, nchanged : int, repeat : int, seed : int):
+    rng = random.Random(seed)
+    snapshots = make_snapshots(rng, nplayers, nsnapshots, nchanged)
+    public_info = make_public_info(rng, nplayers)
+
+    def run(incremental):
+        game = HllGame(incremental=incremental)
+        for stats in snapshots:
+            game.add_stat_slice(stats, public_info)
+
+    full = min(timeit.repeat(lambda: run(False), number=1, repeat=repeat)) / nsnapshots
+    incremental = min(timeit.repeat(lambda: run(True), number=1, repeat=repeat)) / nsnapshots
+    results.record(f'add_stat_slice.full.{nplayers}', full, nplayers=nplayers, nchanged=nchanged)
+    results.record(f'add_stat_slice.incremental.{nplayers}', incremental, nplayers=nplayers, nchanged=nchanged)
+
+    print(f'add_stat_slice {nplayers:>3} players, {nchanged:>2} changed: full {full * 1000:6.2f} ms, '
+          f'incremental {incremental * 1000:6.2f} ms per slice')
+
+def bench_to_numpy(results : Results, nplayers : int, nslices : int, repeat : int, seed : int):
+    rng = random.Random(seed)
+    game = HllGame()
+    for stats in make_snapshots(rng, nplayers, nslices, max(1, nplayers // 10)):
+        game.add_stat_slice(stats, make_public_info(rng, nplayers))
+
+    seconds = results.time(f'to_numpy.{nslices}', game.to_numpy, repeat, number=10, nslices=nslices)
+
+    print(f'to_numpy      {nslices:>3} slices:  {seconds * 1000:8.3f} ms')
+
+# Scoring the newest slice of a game, which the bot does once per tick. Any weights time the same.
+def bench_predict(results : Results, nslices : int, repeat : int, seed : int):
+    rng = random.Random(seed)
+    game = HllGame()
+    for stats in make_snapshots(rng, 100, nslices, 10):
+        game.add_stat_slice(stats, make_public_info(rng, 100))
+
+    nfeatures = len(FEATURE_NAMES)
+    model = SteamrollModel([rng.uniform(-1, 1) for _ in range(nfeatures)], 0.0, [0.0] * nfeatures, [1.0] * nfeatures)
+    records = game.slice_buffer.view
+
+    def run():
+        predictor = model.predictor()
+        for record in records:
+            predictor.update(record)
+
+    seconds = min(timeit.repeat(run, number=10, repeat=repeat)) / (10 * nslices)
+    results.record(f'predict.{nslices}', seconds, nslices=nslices)
+
+    print(f'predict       {nslices:>3} slices:  {seconds * 1e6:8.2f} us per slice')
+
+async def _time_async(fn : Callable, repeat : int, number=1) -> float:
+    loop = asyncio.get_running_loop()
+    best = float('inf')
+    for _ in range(repeat):
+        started = loop.time()
+        for _ in range(number):
+            await fn()
+        best = min(best, loop.time() - started)
+
+    return best / number
+
+# A cold get_game reads the first history page before it can look the game up. Indexing the whole
+# history is what a long running bot has paid for by the time a warm lookup happens.
+def bench_get_game(results : Results, nhistory : int, repeat : int, seed : int):
+    crcon = SyntheticCrcon(seed=seed, nhistory=nhistory)
+    newest = HllGame(map=crcon.history[0]['map']['id'], start_time_s=rcron_time_str_to_s(crcon.history[0]['start']))
+    oldest = HllGame(map=crcon.history[-1]['map']['id'], start_time_s=rcron_time_str_to_s(crcon.history[-1]['start']))
+    npages = -(-nhistory // HISTORY_PAGE_SIZE)
+
+    async def cold():
+        async with HLLServer('synthetic', crcon.uri, transport=crcon.transport) as server:
+            if await server.get_game(newest) is None:
+                raise AssertionError('get_game did not find the newest game')
+
+    # Pages back from the first page to the oldest game one lookup may reach
+    deep_idx = min(nhistory, HISTORY_MAX_LOOKBACK_PAGES * HISTORY_PAGE_SIZE) - 1
+    deep = HllGame(map=crcon.history[deep_idx]['map']['id'], start_time_s=rcron_time_str_to_s(crcon.history[deep_idx]['start']))
+
+    async def cold_deep():
+        async with HLLServer('synthetic', crcon.uri, transport=crcon.transport) as server:
+            if await server.get_game(deep) is None:
+                raise AssertionError(f'get_game did not find game {deep_idx} of the history')
+
+    async def index():
+        async with HLLServer('synthetic', crcon.uri, transport=crcon.transport) as server:
+            await server.refresh_history(max_pages=npages)
+            if len(server.history) != nhistory:
+                raise AssertionError(f'Indexed {len(server.history)} of {nhistory} games')
+
+    async def warm():
+        async with HLLServer('synthetic', crcon.uri, transport=crcon.transport) as server:
+            await server.refresh_history(max_pages=npages)
+            return await _time_async(lambda: server.get_game(oldest), repeat, number=100)
+
+    cold_s = results.time(f'get_game.cold.{nhistory}', lambda: asyncio.run(cold()), repeat, nhistory=nhistory)
+    cold_deep_s = results.time(f'get_game.cold_deep.{nhistory}', lambda: asyncio.run(cold_deep()), repeat, nhistory=nhistory)
+    index_s = results.time(f'refresh_history.{nhistory}', lambda: asyncio.run(index()), repeat, nhistory=nhistory)
+    warm_s = asyncio.run(warm())
+    results.record(f'get_game.warm.{nhistory}', warm_s, nhistory=nhistory)
+
+    print(f'get_game     {nhistory:>5} games: cold {cold_s * 1000:8.2f} ms, cold deep {cold_deep_s * 1000:8.2f} ms, '
+          f'warm {warm_s * 1e6:8.2f} us, indexing all {index_s * 1000:8.2f} ms')
+
+# One pass of the bot's check_for_steamroll against a synthetic server mid-game: public info, live
+# stats, digesting the slice and queueing the status update. Nothing is sent to Discord. Below
+# SEEDING_PLAYERS_PER_TEAM a side the tick stops at public info, so only populated games are timed.
+def bench_tick(results : Results, nplayers : int, repeat : int, seed : int):
+    import steamrollbot
+    from scheduler import ServerState
+
+    crcon = SyntheticCrcon(seed=seed, nplayers=nplayers)
+
+    async def run():
+        server = HLLServer('synthetic', crcon.uri, transport=crcon.transport, public_info_ttl=0.0)
+        state = ServerState(server, 0)
+        async with server:
+            await steamrollbot.check_for_steamroll(state)
+            seconds = await _time_async(lambda: steamrollbot.check_for_steamroll(state), repeat, number=5)
+
+        if state.current_game.nslices != 1 + repeat * 5:
+            raise AssertionError(f'Expected a slice per tick, got {state.current_game.nslices}')
+        return seconds
+
+    # The bot prints every tick
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = asyncio.run(run())
+    results.record(f'tick.{nplayers}', seconds, nplayers=nplayers)
+    steamrollbot.outbox.channels.clear()
+
+    print(f'tick          {nplayers:>3} players: {seconds * 1000:8.2f} ms')
+
+
+# A populated tick against a server with latency_s per response. The live stats go out alongside
+# the public info, so this should take about one round trip rather than two.
+def bench_tick_latency(results : Results, latency_s : float, repeat : int, seed : int):
+    import steamrollbot
+    from scheduler import ServerState
+
+    crcon = SyntheticCrcon(seed=seed, nplayers=100, latency_s=latency_s)
+
+    async def run():
+        server = HLLServer('synthetic', crcon.uri, transport=crcon.transport, public_info_ttl=0.0)
+        state = ServerState(server, 0)
+        async with server:
+            await steamrollbot.check_for_steamroll(state)
+            return await _time_async(lambda: steamrollbot.check_for_steamroll(state), repeat, number=1)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = asyncio.run(run())
+    round_trips = seconds / latency_s
+    results.record(f'tick_latency.{int(latency_s * 1000)}ms', seconds, latency_s=latency_s, round_trips=round_trips)
+    steamrollbot.outbox.channels.clear()
+
+    print(f'tick   {latency_s * 1000:5.0f} ms latency: {seconds * 1000:8.2f} ms ({round_trips:.2f} round trips)')
+
+
+def compare(results : dict, baseline : dict, threshold : float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        ratio = result['seconds'] / baseline[name]['seconds'] if baseline[name]['seconds'] > 0 else 1.0
+        flag = ''
+        if ratio > 1.0 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<36} {baseline[name]["seconds"] * 1000:10.3f} ms -> {result["seconds"] * 1000:10.3f} ms  {ratio:5.2f}x{flag}')
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the HLL stats digester and poll path')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='how much slower than the baseline counts as a regression')
+    args = parser.parse_args()
+
+    results = Results()
+
+    for nplayers in PLAYER_COUNTS:
+        bench_process_stats(results, nplayers, args.repeat, args.seed)
+        bench_detect_team(results, nplayers, args.repeat, args.seed)
+
+    bench_incremental(results, 100, 50, 10, args.repeat, args.seed)
+
+    for nslices in (10, 45):
+        bench_to_numpy(results, 100, nslices, args.repeat, args.seed)
+
+    bench_predict(results, 45, args.repeat, args.seed)
+
+    for nhistory in HISTORY_SIZES:
+        bench_get_game(results, nhistory, args.repeat, args.seed)
+
+    for nplayers in TICK_PLAYER_COUNTS:
+        bench_tick(results, nplayers, args.repeat, args.seed)
+    bench_tick_latency(results, TICK_LATENCY_S, args.repeat, args.seed)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results.to_json(args), f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results.results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
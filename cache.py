@@ -0,0 +1,61 @@
+# Small async caches shared by the CRCON clients
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+
+class SingleFlightCache:
+    def __init__(self, ttl_s : float):
+        self.ttl_s = ttl_s
+
+        self._value : Any = None
+        self._expires_at : float = 0.0
+        self._inflight : asyncio.Task = None
+
+        self.hits : int = 0
+        self.misses : int = 0
+
+    def __str__(self) -> str:
+        return f'<SingleFlightCache(TTL:{self.ttl_s}s, Hits:{self.hits}, Misses:{self.misses})>'
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+
+        return self.hits / total
+
+    @property
+    def is_fresh(self) -> bool:
+        return self._value is not None and time.monotonic() < self._expires_at
+
+    def invalidate(self):
+        self._value = None
+        self._expires_at = 0.0
+
+    async def get(self, fetch : Callable[[], Awaitable[Any]], force_refresh=False) -> Any:
+        if not force_refresh and self.is_fresh:
+            self.hits += 1
+            return self._value
+
+        # Anyone arriving while a request is already out shares its result
+        task = self._inflight
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(fetch))
+            self._inflight = task
+        else:
+            self.hits += 1
+
+        # Shielded so one caller being cancelled doesn't cancel the request for everyone else
+        return await asyncio.shield(task)
+
+    async def _fetch(self, fetch : Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await fetch()
+            self._value = value
+            self._expires_at = time.monotonic() + self.ttl_s
+            return value
+        finally:
+            self._inflight = None
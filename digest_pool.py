@@ -0,0 +1,113 @@
+# Runs slice digestion (process_stats, team detection and the NumPy reductions) in a worker pool
+# so the bot's event loop, and with it the Discord gateway heartbeat, never waits on it.
+import asyncio
+import concurrent.futures
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from HLLStatsDigester import HllGame, HllGameStatsSlice
+from live_stats import compact_live_game_stats
+import metrics
+from utilities import Team
+
+EXECUTOR_THREAD = 'thread'
+EXECUTOR_PROCESS = 'process'
+
+# Runs in a worker process. Returns, per side, the player ids, the players x stats matrix, the
+# counts and the four aggregate arrays, which are all the main process needs to rebuild the slice.
+def digest_compact(stats, public_info) -> Dict[Team, Tuple[List[str], np.ndarray, Any, Any, Any, Any, Any]]:
+    stat_slice = HllGameStatsSlice(stats=stats, public_info=public_info)
+
+    digested = {}
+    for team, side in stat_slice.teams.items():
+        matrix = side.matrix if side.matrix is not None else np.zeros((0, side.nstats))
+        digested[team] = (side.player_ids, matrix, side.counts, *side.aggregates())
+
+    return digested
+
+def slice_from_digested(public_info, digested) -> HllGameStatsSlice:
+    stat_slice = HllGameStatsSlice()
+    stat_slice._process_public_info(public_info)
+
+    for team, side in stat_slice.teams.items():
+        player_ids, matrix, counts, sums, means, medians, stds = digested[team]
+        side.matrix = matrix
+        side.player_ids = player_ids
+        side.load_aggregates(counts, sums, means, medians, stds)
+
+    return stat_slice
+
+
+class DigestExecutor:
+    def __init__(self, kind=EXECUTOR_THREAD, max_workers=None):
+        if kind == EXECUTOR_THREAD:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='digest')
+        elif kind == EXECUTOR_PROCESS:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            raise ValueError(f"Unknown digest executor '{kind}', expected '{EXECUTOR_THREAD}' or '{EXECUTOR_PROCESS}'")
+
+        self.kind = kind
+        self.ndigested : int = 0
+        self.nskipped : int = 0
+
+        # The digest each game has running. Cancelling the await, e.g. on a tick timeout, doesn't
+        # stop a worker, so this is what says whether the game's last digest is really done.
+        self._in_flight : Dict[HllGame, concurrent.futures.Future] = {}
+
+    def __str__(self) -> str:
+        return f'<DigestExecutor(Kind:{self.kind}, Digested:{self.ndigested}, Skipped:{self.nskipped})>'
+
+    def _submit(self, game : HllGame, fn, *args) -> concurrent.futures.Future:
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(fn, *args)
+        self._in_flight[game] = future
+
+        # Done callbacks run on the worker thread, so the bookkeeping is handed back to the loop
+        # rather than racing add_stat_slice over _in_flight
+        def done(future):
+            try:
+                loop.call_soon_threadsafe(self._forget, game, future)
+            except RuntimeError:
+                # The loop has already closed, nothing is left to read _in_flight
+                pass
+
+        future.add_done_callback(done)
+        return future
+
+    def _forget(self, game : HllGame, future : concurrent.futures.Future):
+        if self._in_flight.get(game) is future:
+            del self._in_flight[game]
+
+    # Digest a snapshot off the loop, then add the slice to the game back on the loop. A game's
+    # slices are digested one at a time, so if its last digest is still running, e.g. after a tick
+    # timed out, this snapshot is skipped and None returned; the next one is cumulative anyway.
+    async def add_stat_slice(self, game : HllGame, stats, public_info) -> HllGameStatsSlice:
+        running = self._in_flight.get(game)
+        if running is not None and not running.done():
+            self.nskipped += 1
+            print(f"A slice for {game.map} is still being digested, skipping this one")
+            return None
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        if self.kind == EXECUTOR_THREAD:
+            stat_slice = await asyncio.wrap_future(self._submit(game, game.digest_slice, stats, public_info))
+        else:
+            # The game's team cache and incremental aggregator live in this process, so a process
+            # worker digests the snapshot from scratch. Only the keys the digester reads are sent.
+            digested = await asyncio.wrap_future(self._submit(game, digest_compact,
+                                                              compact_live_game_stats(stats), public_info))
+            stat_slice = slice_from_digested(public_info, digested)
+
+        game.append_slice(stat_slice)
+        self.ndigested += 1
+        # Includes waiting for a free worker
+        metrics.DIGEST_SECONDS.labels(f'{self.kind}_pool').observe(loop.time() - started)
+
+        return stat_slice
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,190 @@
+# Push based game transitions from the CRCON log stream (/ws/logs).
+#
+# Each stream subscribes to MATCH START, MATCH ENDED and KILL. Match events wake the server's poll
+# right away instead of waiting out its interval, kills are counted on the current game as they
+# happen. While a stream is down the scheduler simply keeps polling on its own, and the stream
+# reconnects with exponential back off, resuming from the last log id it saw.
+from dataclasses import dataclass
+import asyncio
+import json
+import random
+import re
+import traceback
+from typing import Awaitable, Callable
+
+from HllServer import HLLServer
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+MATCH_START = 'MATCH START'
+MATCH_ENDED = 'MATCH ENDED'
+KILL = 'KILL'
+DEFAULT_ACTIONS = (MATCH_START, MATCH_ENDED, KILL)
+
+RECONNECT_MIN_S = 1.0
+RECONNECT_MAX_S = 60.0
+
+# e.g. "`CARENTAN Warfare` ALLIED (2 - 3) AXIS"
+MATCH_SCORE = re.compile(r'ALLIED \((\d+) - (\d+)\) AXIS')
+
+
+@dataclass
+class LogEvent:
+    id : str
+    action : str
+    timestamp_ms : int = 0
+    player_id : str = None
+    victim_id : str = None
+    weapon : str = None
+    sub_content : str = None
+    message : str = None
+
+    @classmethod
+    def from_log(cls, entry : dict) -> 'LogEvent':
+        log = entry['log']
+        return cls(id=entry.get('id'),
+                   action=log.get('action'),
+                   timestamp_ms=log.get('timestamp_ms', 0),
+                   player_id=log.get('player1_id'),
+                   victim_id=log.get('player2_id'),
+                   weapon=log.get('weapon'),
+                   sub_content=log.get('sub_content'),
+                   message=log.get('message'))
+
+    # (allied, axis) from a MATCH ENDED event, None if it doesn't carry one
+    def match_score(self) -> tuple:
+        for text in (self.sub_content, self.message):
+            match = MATCH_SCORE.search(text or '')
+            if match is not None:
+                return int(match.group(1)), int(match.group(2))
+
+        return None
+
+
+class CrconEventStream:
+    def __init__(self, server : HLLServer,
+                 on_event : Callable[[LogEvent], Awaitable[None]],
+                 on_status : Callable[[bool], None] = None,
+                 actions=DEFAULT_ACTIONS,
+                 reconnect_min_s=RECONNECT_MIN_S,
+                 reconnect_max_s=RECONNECT_MAX_S):
+        if websockets is None:
+            raise ImportError('The CRCON log stream needs the websockets package')
+
+        self.server = server
+        self.on_event = on_event
+        # Called with True on connect and False on disconnect
+        self.on_status = on_status
+        self.actions = list(actions)
+        self.reconnect_min_s = reconnect_min_s
+        self.reconnect_max_s = reconnect_max_s
+
+        self.connected = False
+        self.last_seen_id : str = None
+        self.nevents : int = 0
+        self.nreconnects : int = 0
+        self._task : asyncio.Task = None
+
+    def __str__(self) -> str:
+        return (f'<CrconEventStream(Server:{self.server.server_name}, Connected:{self.connected}, '
+                f'Events:{self.nevents}, Reconnects:{self.nreconnects})>')
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(), name=f'events-{self.server.server_name}')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _set_connected(self, connected : bool):
+        if connected == self.connected:
+            return
+
+        self.connected = connected
+        if self.on_status is not None:
+            self.on_status(connected)
+
+    async def run(self):
+        backoff_s = self.reconnect_min_s
+
+        while True:
+            try:
+                await self._consume()
+            except asyncio.CancelledError:
+                self._set_connected(False)
+                raise
+            except Exception as e:
+                print(f"ERROR: Log stream for '{self.server.server_name}' dropped: {e!r}")
+
+            if self.connected:
+                backoff_s = self.reconnect_min_s
+            self._set_connected(False)
+
+            self.nreconnects += 1
+            await asyncio.sleep(backoff_s * random.uniform(0.5, 1.0))
+            backoff_s = min(self.reconnect_max_s, backoff_s * 2)
+
+    async def _consume(self):
+        async with websockets.connect(self.server.log_stream_url,
+                                      additional_headers=self.server.auth_headers) as ws:
+            await ws.send(json.dumps({'last_seen_id' : self.last_seen_id, 'actions' : self.actions}))
+            self._set_connected(True)
+
+            async for message in ws:
+                payload = json.loads(message)
+                if payload.get('error'):
+                    raise ConnectionError(f"CRCON log stream error: {payload['error']}")
+
+                for entry in payload.get('logs') or []:
+                    await self._dispatch(LogEvent.from_log(entry))
+
+                if payload.get('last_seen_id') is not None:
+                    self.last_seen_id = payload['last_seen_id']
+
+    async def _dispatch(self, event : LogEvent):
+        self.nevents += 1
+        if event.id is not None:
+            self.last_seen_id = event.id
+
+        try:
+            await self.on_event(event)
+        except Exception:
+            print(f"ERROR: Handling {event.action} from '{self.server.server_name}' failed")
+            traceback.print_exc()
+
+
+# Wire a scheduled server up to its log stream. Kills are counted on the current game, a match
+# starting or ending drops the cached public info and wakes the server's poll. While connected the
+# scheduler's interval policy can relax, since game-over no longer has to be caught by polling.
+def attach_event_stream(scheduler, state, **kwargs) -> CrconEventStream:
+    server = state.server
+
+    async def on_event(event : LogEvent):
+        game = state.current_game
+
+        if event.action == KILL:
+            if game is not None:
+                game.add_kill_event(event.weapon)
+            return
+
+        if event.action == MATCH_ENDED and game is not None:
+            score = event.match_score()
+            if score is not None:
+                game.add_score_event(*score)
+
+        server.public_info_cache.invalidate()
+        scheduler.poke(state)
+
+    def on_status(connected : bool):
+        state.streaming = connected
+
+    stream = CrconEventStream(server, on_event, on_status=on_status, **kwargs)
+    scheduler.add_stream(stream)
+
+    return stream
@@ -0,0 +1,414 @@
+# A local stand-in for CRCON, for exercising and load testing the bot without a real server.
+#
+#   python fake_crcon.py record --uri https://scoreboard-us-east-1.glows.gg/ --duration 3600 --out session.jsonl
+#   python fake_crcon.py serve --servers 200 --speed 30 --session session.jsonl --error-rate 0.02
+#
+# FakeCrcon serves /api/get_public_info, /api/get_live_game_stats and /api/get_scoreboard_maps for
+# any number of servers, server N under /s/N (its HLLServer uri is http://host:port/s/N). Every
+# server replays a session, either recorded from a real CRCON or generated by make_session, at
+# `speed` times real time, each from its own offset so they don't change maps in lockstep. Faults
+# (latency, 500s, 502s, hangs) are injected per request.
+#
+# FakeLogServer serves /ws/logs: a client subscribes with {"last_seen_id", "actions"} and is sent
+# every scripted log entry after last_seen_id whose action it asked for, one message per entry.
+# drop_after closes each connection after that many entries, to exercise reconnects.
+import argparse
+import asyncio
+import bisect
+from collections import Counter
+from dataclasses import dataclass
+import json
+import random
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+from HllServer import API_EP, CURRENT_MAP, GAME_HISTORY_EP, HISTORY_PAGE_SIZE, LIVE_GAME_STATS
+from synthetic import (GAME_LENGTH_S, MAPS, EPOCH_S, make_live_game_stats, make_scoreboard_map,
+                       make_public_info, scoreboard_page)
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_HTTP_PORT = 8010
+
+ENDPOINTS = (CURRENT_MAP.strip('/'), LIVE_GAME_STATS.strip('/'), GAME_HISTORY_EP.strip('/'))
+PUBLIC_INFO, LIVE_STATS, SCOREBOARD_MAPS = ENDPOINTS
+# Session time between generated snapshots
+SESSION_STEP_S = 60
+SEEDING_STEPS = 10
+
+
+def make_log(idx : int, action : str, **fields) -> dict:
+    return {'id' : str(idx), 'log' : {'version' : 1, 'timestamp_ms' : idx * 1000, 'action' : action, **fields}}
+
+# A short match: it starts, a few kills land on both sides, and it ends 1 - 4
+def make_match_logs(map_name='CARENTAN Warfare', allied=1, axis=4) -> List[dict]:
+    logs = [make_log(1, 'MATCH START', sub_content=map_name, message=f'MATCH START {map_name}')]
+    kills = [('M1 GARAND', 'a1', 'x1'), ('KARABINER 98K', 'x1', 'a1'), ('MP40', 'x2', 'a2'), ('KARABINER 98K', 'x1', 'a3')]
+    for weapon, killer, victim in kills:
+        logs.append(make_log(len(logs) + 1, 'KILL', player1_id=killer, player2_id=victim, weapon=weapon))
+    logs.append(make_log(len(logs) + 1, 'MATCH ENDED',
+                         sub_content=f'`{map_name}` ALLIED ({allied} - {axis}) AXIS',
+                         message=f'MATCH ENDED `{map_name}` ALLIED ({allied} - {axis}) AXIS'))
+    return logs
+
+
+class FakeLogServer:
+    def __init__(self, logs : List[dict], host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 drop_after : int = None, interval_s=0.0):
+        if websockets is None:
+            raise ImportError('The fake log server needs the websockets package')
+
+        self.logs = logs
+        self.host = host
+        self.port = port
+        self.drop_after = drop_after
+        self.interval_s = interval_s
+
+        self.nconnections : int = 0
+        self._server = None
+
+    @property
+    def uri(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        self._server = await websockets.serve(self._handle, self.host, self.port)
+        # Port 0 picks a free one
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def pending(self, last_seen_id : str, actions : List[str]) -> List[dict]:
+        ids = [entry['id'] for entry in self.logs]
+        start = ids.index(last_seen_id) + 1 if last_seen_id in ids else 0
+        return [entry for entry in self.logs[start:] if not actions or entry['log']['action'] in actions]
+
+    async def _handle(self, ws):
+        self.nconnections += 1
+        subscription = json.loads(await ws.recv())
+
+        sent = 0
+        for entry in self.pending(subscription.get('last_seen_id'), subscription.get('actions')):
+            if self.drop_after is not None and sent >= self.drop_after:
+                return
+
+            await ws.send(json.dumps({'last_seen_id' : entry['id'], 'logs' : [entry], 'error' : None}))
+            sent += 1
+            await asyncio.sleep(self.interval_s)
+
+        await ws.wait_closed()
+
+
+# A session is, per endpoint, the response bodies in the order they were seen and the session time
+# each was seen at. A request is answered with the newest body at or before the current session
+# time. Scoreboard bodies are a whole /get_scoreboard_maps response, paged again when served.
+class Session:
+    def __init__(self):
+        self.times : Dict[str, List[float]] = {endpoint : [] for endpoint in ENDPOINTS}
+        self.bodies : Dict[str, List[bytes]] = {endpoint : [] for endpoint in ENDPOINTS}
+        self.history : List[List[dict]] = []
+
+    @property
+    def duration_s(self) -> float:
+        return max((times[-1] for times in self.times.values() if len(times) > 0), default=0.0) + SESSION_STEP_S
+
+    def add(self, t : float, endpoint : str, body : dict):
+        self.times[endpoint].append(t)
+        if endpoint == SCOREBOARD_MAPS:
+            self.history.append(body['result']['maps'])
+            self.bodies[endpoint].append(b'')
+        else:
+            self.bodies[endpoint].append(json.dumps(body).encode())
+
+    def _index(self, endpoint : str, t : float) -> int:
+        return max(0, bisect.bisect_right(self.times[endpoint], t) - 1)
+
+    def body(self, endpoint : str, t : float, page=1, limit=HISTORY_PAGE_SIZE) -> bytes:
+        if len(self.times[endpoint]) == 0:
+            raise LookupError(f'The session has nothing for {endpoint}')
+
+        idx = self._index(endpoint, t)
+        if endpoint == SCOREBOARD_MAPS:
+            return json.dumps(scoreboard_page(self.history[idx], page, limit)).encode()
+
+        return self.bodies[endpoint][idx]
+
+    # One JSON record per line: {"t", "endpoint", "body"}
+    @classmethod
+    def load(cls, path : str) -> 'Session':
+        session = cls()
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    session.add(record['t'], record['endpoint'], record['body'])
+
+        return session
+
+
+# Generated stand-in for a recording: each game seeds for SEEDING_STEPS, plays until its time runs
+# out or one side takes all 5 sectors, then the map changes and the game lands in the history.
+def make_session(seed=0, ngames=3, nplayers=100, game_length_s=GAME_LENGTH_S) -> Session:
+    rng = random.Random(seed)
+    session = Session()
+    history = []
+    t = 0.0
+
+    for _ in range(ngames):
+        start_time_s = EPOCH_S + int(t)
+        map_idx = rng.randrange(len(MAPS))
+        stats = make_live_game_stats(rng, nplayers)
+        score = {'allied' : 2, 'axis' : 2}
+        session.add(t, SCOREBOARD_MAPS, {'failed' : False, 'result' : {'maps' : list(history)}})
+
+        for step in range(SEEDING_STEPS):
+            public_info = make_public_info(rng, 2 + 4 * step, map_idx, start_time_s)
+            public_info['result'].update(time_remaining=game_length_s, score=score)
+            session.add(t, PUBLIC_INFO, public_info)
+            t += SESSION_STEP_S
+
+        time_remaining = game_length_s
+        while time_remaining > 0 and 0 < score['allied'] < 5:
+            public_info = make_public_info(rng, nplayers, map_idx, start_time_s)
+            public_info['result'].update(time_remaining=time_remaining, score=dict(score))
+            session.add(t, PUBLIC_INFO, public_info)
+            session.add(t, LIVE_STATS, stats)
+
+            for player in rng.sample(stats['result']['stats'], nplayers // 5):
+                player['kills'] += 1
+                player['combat'] += rng.randint(1, 10)
+            if rng.random() < 0.1:
+                capture = 1 if rng.random() < 0.5 else -1
+                score = {'allied' : score['allied'] + capture, 'axis' : score['axis'] - capture}
+
+            time_remaining -= SESSION_STEP_S
+            t += SESSION_STEP_S
+
+        game = make_scoreboard_map(rng, len(history) + 1, start_time_s, map_idx)
+        game['result'] = dict(score)
+        history.insert(0, game)
+
+    session.add(t, SCOREBOARD_MAPS, {'failed' : False, 'result' : {'maps' : list(history)}})
+    return session
+
+
+# Poll a real CRCON and write what it returns as a session file
+async def record_session(uri : str, path : str, duration_s : float, interval_s=SESSION_STEP_S):
+    started = time.monotonic()
+
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        with open(path, 'w') as f:
+            while time.monotonic() - started < duration_s:
+                t = time.monotonic() - started
+                for endpoint in ENDPOINTS:
+                    params = {'page' : 1, 'limit' : HISTORY_PAGE_SIZE} if endpoint == SCOREBOARD_MAPS else None
+                    try:
+                        response = await client.get(f"{uri.rstrip('/')}{API_EP}/{endpoint}", params=params)
+                        response.raise_for_status()
+                    except httpx.HTTPError as e:
+                        print(f'ERROR: Recording {endpoint} failed: {e!r}')
+                        continue
+                    f.write(json.dumps({'t' : t, 'endpoint' : endpoint, 'body' : response.json()}) + '\n')
+                f.flush()
+
+                await asyncio.sleep(interval_s)
+
+
+@dataclass
+class Faults:
+    latency_s : float = 0.0
+    # Extra latency, uniform in [0, latency_jitter_s]
+    latency_jitter_s : float = 0.0
+    error_500_rate : float = 0.0
+    error_502_rate : float = 0.0
+    hang_rate : float = 0.0
+    # How long a hung request sits before it is answered
+    hang_s : float = 120.0
+
+
+class FakeCrcon:
+    def __init__(self, sessions : List[Session], nservers=1, speed=1.0, faults : Faults = None,
+                 host=DEFAULT_HOST, port=DEFAULT_HTTP_PORT, seed=0):
+        if web is None:
+            raise ImportError('The fake CRCON server needs the aiohttp package')
+
+        self.sessions = sessions
+        self.nservers = nservers
+        self.speed = speed
+        self.faults = faults if faults is not None else Faults()
+        self.host = host
+        self.port = port
+        self.rng = random.Random(seed)
+
+        # Server N replays sessions[N % len(sessions)] from offsets[N] into it
+        self.offsets_s = [self.rng.uniform(0, sessions[idx % len(sessions)].duration_s) for idx in range(nservers)]
+        self.started_s = time.monotonic()
+
+        self.requests = Counter()
+        self.responses = Counter()
+        self.nhangs : int = 0
+        self._runner = None
+
+    def uri(self, idx : int) -> str:
+        return f'http://{self.host}:{self.port}/s/{idx}'
+
+    @property
+    def uris(self) -> List[str]:
+        return [self.uri(idx) for idx in range(self.nservers)]
+
+    def session_time(self, idx : int) -> Tuple[Session, float]:
+        session = self.sessions[idx % len(self.sessions)]
+        t = (time.monotonic() - self.started_s) * self.speed + self.offsets_s[idx]
+        return session, t % session.duration_s
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{path:.*}', self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Port 0 picks a free one
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.started_s = time.monotonic()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def _route(self, path : str) -> Tuple[int, str]:
+        parts = [part for part in path.split('/') if part]
+        idx = 0
+        if len(parts) >= 2 and parts[0] == 's':
+            idx = int(parts[1])
+        return idx, parts[-1] if len(parts) > 0 else ''
+
+    async def _handle(self, request : 'web.Request') -> 'web.Response':
+        try:
+            idx, endpoint = self._route(request.path)
+        except ValueError:
+            return self._respond(404, b'{"failed": true}')
+        if endpoint not in ENDPOINTS or idx >= self.nservers:
+            return self._respond(404, b'{"failed": true}')
+
+        self.requests[endpoint] += 1
+        faults = self.faults
+        delay_s = faults.latency_s + self.rng.uniform(0, faults.latency_jitter_s)
+        if delay_s > 0:
+            await asyncio.sleep(delay_s)
+
+        roll = self.rng.random()
+        if roll < faults.hang_rate:
+            self.nhangs += 1
+            await asyncio.sleep(faults.hang_s)
+        elif roll < faults.hang_rate + faults.error_500_rate:
+            return self._respond(500, b'Internal Server Error')
+        elif roll < faults.hang_rate + faults.error_500_rate + faults.error_502_rate:
+            return self._respond(502, b'Bad Gateway')
+
+        session, t = self.session_time(idx)
+        body = session.body(endpoint, t,
+                            page=int(request.query.get('page', 1)),
+                            limit=int(request.query.get('limit', HISTORY_PAGE_SIZE)))
+        return self._respond(200, body)
+
+    def _respond(self, status : int, body : bytes) -> 'web.Response':
+        self.responses[status] += 1
+        return web.Response(status=status, body=body, content_type='application/json')
+
+    def stats(self) -> dict:
+        return {'requests' : dict(self.requests), 'responses' : dict(self.responses), 'hangs' : self.nhangs}
+
+
+async def serve_logs(host : str, port : int, interval_s : float):
+    async with FakeLogServer(make_match_logs(), host=host, port=port, interval_s=interval_s) as server:
+        print(f'Fake CRCON log stream on ws://{server.host}:{server.port}/ws/logs')
+        await asyncio.Future()
+
+async def serve(args):
+    if args.session is not None:
+        sessions = [Session.load(path) for path in args.session]
+    else:
+        sessions = [make_session(seed=args.seed + idx, nplayers=args.players) for idx in range(args.sessions)]
+
+    faults = Faults(latency_s=args.latency, latency_jitter_s=args.latency_jitter,
+                    error_500_rate=args.error_rate / 2, error_502_rate=args.error_rate / 2,
+                    hang_rate=args.hang_rate, hang_s=args.hang)
+
+    async with FakeCrcon(sessions, nservers=args.servers, speed=args.speed, faults=faults,
+                         host=args.host, port=args.port, seed=args.seed) as crcon:
+        print(f'Fake CRCON serving {crcon.nservers} servers at {crcon.uri(0)} .. {crcon.uri(crcon.nservers - 1)}')
+        while True:
+            await asyncio.sleep(60)
+            print(crcon.stats())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='A local stand-in for CRCON')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='serve the CRCON HTTP API for many fake servers')
+    serve_parser.add_argument('--host', default=DEFAULT_HOST)
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_HTTP_PORT)
+    serve_parser.add_argument('--servers', type=int, default=1)
+    serve_parser.add_argument('--speed', type=float, default=1.0, help='session seconds per real second')
+    serve_parser.add_argument('--session', action='append', help='recorded session file, may be repeated')
+    serve_parser.add_argument('--sessions', type=int, default=4, help='how many sessions to generate without --session')
+    serve_parser.add_argument('--players', type=int, default=100)
+    serve_parser.add_argument('--seed', type=int, default=0)
+    serve_parser.add_argument('--latency', type=float, default=0.0)
+    serve_parser.add_argument('--latency-jitter', type=float, default=0.0)
+    serve_parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 500 or 502')
+    serve_parser.add_argument('--hang-rate', type=float, default=0.0)
+    serve_parser.add_argument('--hang', type=float, default=120.0, help='seconds a hung request sits')
+
+    record_parser = commands.add_parser('record', help='record a session from a real CRCON')
+    record_parser.add_argument('--uri', required=True)
+    record_parser.add_argument('--out', required=True)
+    record_parser.add_argument('--duration', type=float, default=3600.0)
+    record_parser.add_argument('--interval', type=float, default=SESSION_STEP_S)
+
+    logs_parser = commands.add_parser('logs', help='serve a scripted /ws/logs stream')
+    logs_parser.add_argument('--host', default=DEFAULT_HOST)
+    logs_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    logs_parser.add_argument('--interval', type=float, default=1.0, help='seconds between log entries')
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        asyncio.run(serve(args))
+    elif args.command == 'record':
+        asyncio.run(record_session(args.uri, args.out, args.duration, args.interval))
+    else:
+        asyncio.run(serve_logs(args.host, args.port, args.interval))
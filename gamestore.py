@@ -0,0 +1,184 @@
+# Append-only binary store of finished games, one block of slice records per game.
+#
+#   <path>.dat  header + every game's slice records back to back, in the slice dtype
+#   <path>.idx  header + one index record per game (where its rows are, plus its y-vector)
+#
+# Both files start with MAGIC, a uint32 version, a uint32 header length and a JSON header holding
+# the record dtypes, padded so the records start aligned. Rows are only ever appended and a game
+# only exists once its index record is written, so a crash mid-append loses at most that game.
+import json
+import os
+import struct
+
+import numpy as np
+
+from HLLStatsDigester import HllGame, slice_dtype
+
+MAGIC = b'HLLGAMES'
+VERSION = 1
+HEADER_ALIGN = 64
+NAME_SIZE = 64
+
+INDEX_FIELDS = [('server', f'S{NAME_SIZE}'),
+                ('map', f'S{NAME_SIZE}'),
+                ('start_time_s', '<i8'),
+                ('row', '<i8'),
+                ('nrows', '<i8')]
+
+
+def y_dtype() -> np.dtype:
+    return np.dtype([('AXIS Score', '<u4'), ('ALLIED Score', '<u4'), ('WAS STEAMROLL', '<u4')])
+
+def index_dtype() -> np.dtype:
+    return np.dtype(INDEX_FIELDS + y_dtype().descr)
+
+def _dtype_to_json(dtype : np.dtype) -> list:
+    return [list(field) for field in dtype.descr]
+
+def _dtype_from_json(descr : list) -> np.dtype:
+    return np.dtype([tuple(field) for field in descr])
+
+def _write_header(f, header : dict) -> int:
+    body = json.dumps(header).encode()
+    size = len(MAGIC) + 8 + len(body)
+    padding = (-size) % HEADER_ALIGN
+
+    f.write(MAGIC)
+    f.write(struct.pack('<II', VERSION, len(body) + padding))
+    f.write(body + b' ' * padding)
+
+    return size + padding
+
+def _read_header(f) -> tuple[dict, int]:
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError(f"'{f.name}' is not an HLL game store file")
+
+    version, length = struct.unpack('<II', f.read(8))
+    if version != VERSION:
+        raise ValueError(f"'{f.name}' is version {version}, expected {VERSION}")
+
+    header = json.loads(f.read(length))
+    return header, len(MAGIC) + 8 + length
+
+
+class HllGameStore:
+    def __init__(self, path : str, dtype : np.dtype = None):
+        self.data_path = f'{path}.dat'
+        self.index_path = f'{path}.idx'
+        self.dtype = dtype if dtype is not None else slice_dtype()
+        self.index_dtype = index_dtype()
+
+        if not os.path.exists(self.data_path) or not os.path.exists(self.index_path):
+            self._create()
+
+        self._open()
+
+    def _create(self):
+        with open(self.data_path, 'wb') as f:
+            _write_header(f, {'x_dtype' : _dtype_to_json(self.dtype)})
+
+        with open(self.index_path, 'wb') as f:
+            _write_header(f, {'index_dtype' : _dtype_to_json(self.index_dtype)})
+
+    def _open(self):
+        with open(self.data_path, 'rb') as f:
+            header, self.data_offset = _read_header(f)
+        if _dtype_from_json(header['x_dtype']) != self.dtype:
+            raise ValueError(f"'{self.data_path}' was written with a different slice schema")
+
+        with open(self.index_path, 'rb') as f:
+            header, self.index_offset = _read_header(f)
+        if _dtype_from_json(header['index_dtype']) != self.index_dtype:
+            raise ValueError(f"'{self.index_path}' was written with a different index schema")
+
+        # Drop anything written after the last complete game, e.g. from a crash mid-append
+        index_size = os.path.getsize(self.index_path) - self.index_offset
+        self.ngames = index_size // self.index_dtype.itemsize
+        os.truncate(self.index_path, self.index_offset + self.ngames * self.index_dtype.itemsize)
+
+        self.nrows = 0
+        if self.ngames > 0:
+            last = np.fromfile(self.index_path, dtype=self.index_dtype, count=1,
+                               offset=self.index_offset + (self.ngames - 1) * self.index_dtype.itemsize)[0]
+            self.nrows = int(last['row'] + last['nrows'])
+        os.truncate(self.data_path, self.data_offset + self.nrows * self.dtype.itemsize)
+
+    def __len__(self) -> int:
+        return self.ngames
+
+    def append_game(self, game : HllGame):
+        x = np.ascontiguousarray(game.to_numpy(), dtype=self.dtype)
+        if game.y is None:
+            raise ValueError(f'Game on {game.map} is still on, only finished games can be stored')
+
+        record = np.zeros(1, dtype=self.index_dtype)
+        record['server'] = (game.server.server_name if game.server is not None else '').encode()[:NAME_SIZE]
+        record['map'] = (game.map or '').encode()[:NAME_SIZE]
+        record['start_time_s'] = game.start_time_s or 0
+        record['row'] = self.nrows
+        record['nrows'] = len(x)
+        for name in y_dtype().names:
+            record[name] = game.y[name][0]
+
+        with open(self.data_path, 'ab') as f:
+            f.write(x.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(self.index_path, 'ab') as f:
+            f.write(record.tobytes())
+
+        self.nrows += len(x)
+        self.ngames += 1
+
+
+# Memory-maps a whole store. Games, columns and the y-vectors are all views of the mapped files,
+# so nothing is read until it is touched.
+class HllGameStoreReader:
+    def __init__(self, path : str):
+        self.data_path = f'{path}.dat'
+        self.index_path = f'{path}.idx'
+
+        with open(self.data_path, 'rb') as f:
+            header, data_offset = _read_header(f)
+        self.dtype = _dtype_from_json(header['x_dtype'])
+
+        with open(self.index_path, 'rb') as f:
+            header, index_offset = _read_header(f)
+        self.index_dtype = _dtype_from_json(header['index_dtype'])
+
+        ngames = (os.path.getsize(self.index_path) - index_offset) // self.index_dtype.itemsize
+        self.index = self._map(self.index_path, self.index_dtype, index_offset, ngames)
+
+        nrows = int(self.index[-1]['row'] + self.index[-1]['nrows']) if ngames > 0 else 0
+        self.x = self._map(self.data_path, self.dtype, data_offset, nrows)
+
+    @staticmethod
+    def _map(path : str, dtype : np.dtype, offset : int, count : int) -> np.ndarray:
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, idx : int) -> tuple[np.ndarray, np.void]:
+        entry = self.index[idx]
+        return self.game_x(idx), entry[list(y_dtype().names)]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.index[list(y_dtype().names)]
+
+    def game_x(self, idx : int) -> np.ndarray:
+        entry = self.index[idx]
+        return self.x[entry['row']:entry['row'] + entry['nrows']]
+
+    def column(self, name : str) -> np.ndarray:
+        return self.x[name]
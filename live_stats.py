@@ -0,0 +1,23 @@
+# Pruning of /get_live_game_stats. Of every player the digester only reads their identity, the
+# registered HllStat keys and the two weapon maps used for team detection, so only those are kept.
+from HLLStatsDigester import stat_rcron_names
+
+# Identity keys, see utilities.get_player_id
+PLAYER_ID_KEYS = ('player_id', 'steam_id_64', 'player')
+# Nested maps that are kept, for team detection
+PLAYER_MAP_KEYS = ('weapons', 'death_by_weapons')
+PLAYER_KEYS = (*PLAYER_ID_KEYS, *PLAYER_MAP_KEYS)
+
+
+def player_keys() -> frozenset:
+    return frozenset((*PLAYER_KEYS, *stat_rcron_names()))
+
+def compact_player(player : dict, keys : frozenset) -> dict:
+    return {key : value for key, value in player.items() if key in keys}
+
+# Prune a decoded /get_live_game_stats response down to what the digester reads
+def compact_live_game_stats(stats : dict) -> dict:
+    keys = player_keys()
+    players = [compact_player(player, keys) for player in stats['result']['stats']]
+
+    return {'failed' : stats.get('failed', False), 'result' : {'stats' : players}}
@@ -0,0 +1,92 @@
+# End to end load test of the bot's poll path against the local fake CRCON.
+#
+#   python loadtest.py --servers 300 --duration 120 --interval 5 --speed 60 --error-rate 0.02
+#
+# Starts a FakeCrcon with --servers servers in this process and points a PollScheduler running
+# steamrollbot.check_for_steamroll at every one of them. Discord is never contacted: messages pile
+# up in the bot's outbox, which isn't started. Reports tick throughput, tick latency percentiles,
+# failures and what the fake server saw, including the 5xx responses that were retried.
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+import numpy as np
+
+import steamrollbot
+from fake_crcon import Faults, FakeCrcon, Session, make_session
+from HllServer import HLLServer
+from scheduler import PollScheduler, ServerState
+
+
+async def run(args):
+    if args.session is not None:
+        sessions = [Session.load(path) for path in args.session]
+    else:
+        sessions = [make_session(seed=args.seed + idx, nplayers=args.players) for idx in range(args.sessions)]
+
+    faults = Faults(latency_s=args.latency, latency_jitter_s=args.latency_jitter,
+                    error_500_rate=args.error_rate / 2, error_502_rate=args.error_rate / 2,
+                    hang_rate=args.hang_rate, hang_s=args.hang)
+
+    tick_s = []
+
+    async with FakeCrcon(sessions, nservers=args.servers, speed=args.speed, faults=faults, port=0, seed=args.seed) as crcon:
+        async def poll(state : ServerState):
+            started = time.perf_counter()
+            await steamrollbot.check_for_steamroll(state)
+            tick_s.append(time.perf_counter() - started)
+
+        scheduler = PollScheduler(poll, max_concurrency=args.concurrency, timeout_s=args.timeout)
+        for idx, uri in enumerate(crcon.uris):
+            scheduler.add_server(ServerState(HLLServer(f'fake-{idx}', uri, max_connections=2), 0,
+                                             interval_s=args.interval, jitter_s=args.interval / 4))
+
+        # The bot prints a line or two every tick
+        with contextlib.redirect_stdout(io.StringIO()) if args.quiet else contextlib.nullcontext():
+            started = time.monotonic()
+            scheduler.start()
+            await asyncio.sleep(args.duration)
+            await scheduler.stop()
+            elapsed = time.monotonic() - started
+
+        npolls = sum(state.npolls for state in scheduler.states)
+        nfailures = sum(state.nfailures for state in scheduler.states)
+        ngames = sum(1 for state in scheduler.states if state.current_game is not None)
+        stats = crcon.stats()
+
+    print(f'{args.servers} servers for {elapsed:.1f}s: {npolls} polls ({npolls / elapsed:,.1f}/s), '
+          f'{nfailures} failed, {ngames} servers mid-game at the end')
+
+    if len(tick_s) > 0:
+        p50, p90, p99, p100 = np.percentile(np.array(tick_s), (50, 90, 99, 100)) * 1000
+        print(f'Successful tick latency: p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms, max {p100:.1f} ms')
+
+    nrequests = sum(stats['requests'].values())
+    nerrors = sum(count for status, count in stats['responses'].items() if status >= 500)
+    print(f'Fake CRCON: {nrequests} requests {stats["requests"]}, responses {stats["responses"]}, '
+          f'{stats["hangs"]} hangs, {nerrors} 5xx retried or failed')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the bot against a local fake CRCON')
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--interval', type=float, default=5.0, help='poll interval per server')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--speed', type=float, default=60.0, help='session seconds per real second')
+    parser.add_argument('--session', action='append', help='recorded session file, may be repeated')
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--hang-rate', type=float, default=0.0)
+    parser.add_argument('--hang', type=float, default=120.0)
+    parser.add_argument('--verbose', dest='quiet', action='store_false', help="show the bot's output")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
@@ -0,0 +1,328 @@
+# Prometheus style metrics for CRCON requests, polls and digestion, served as text on /metrics.
+#
+#   metrics.enable()
+#   await metrics.MetricsServer(port=9108).start()
+#
+# Everything is off until enable() is called. While off, labels() hands back one shared no-op
+# child and timed() functions go straight through, so instrumented code costs a flag check.
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+
+DEFAULT_PORT = 9108
+# Seconds, for HTTP requests and ticks
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Seconds, for digestion which is mostly well under a tick
+DIGEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_enabled = False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _NoopChild:
+    def inc(self, amount=1.0):
+        pass
+
+    def dec(self, amount=1.0):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+NOOP = _NoopChild()
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount=1.0):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = float(value)
+
+class _HistogramChild:
+    def __init__(self, buckets : Tuple[float, ...]):
+        self.buckets = buckets
+        # Per bucket, not cumulative; the last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names : Tuple[str, ...], values : Tuple, extra : str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+def _format_value(value : float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name : str, documentation : str, labelnames : Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children : Dict[Tuple, object] = {}
+        self.lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        if not _enabled:
+            return NOOP
+
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+
+        return lines
+
+    def _render_child(self, values : Tuple, child) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name : str, documentation : str, labelnames : Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, values : Tuple, child) -> List[str]:
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), counts):
+            cumulative += count
+            le = 'le="+Inf"' if bound == float('inf') else f'le="{_format_value(bound)}"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}')
+
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics : List[Metric] = []
+
+    def register(self, metric : Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+
+HTTP_REQUEST_SECONDS = Histogram('crcon_http_request_duration_seconds',
+                                 'CRCON request latency to response headers, per attempt', ('endpoint',))
+HTTP_REQUESTS = Counter('crcon_http_requests_total', 'CRCON request attempts by response status', ('endpoint', 'status'))
+HTTP_RETRIES = Counter('crcon_http_retries_total', 'CRCON request attempts after the first', ('endpoint',))
+HTTP_ERRORS = Counter('crcon_http_errors_total', 'CRCON request attempts that raised', ('endpoint', 'error'))
+HTTP_IN_FLIGHT = Gauge('crcon_http_requests_in_flight', 'CRCON requests waiting on a response', ('endpoint',))
+HTTP_RESPONSE_BYTES = Histogram('crcon_http_response_bytes', 'CRCON response body sizes', ('endpoint',),
+                                buckets=SIZE_BUCKETS)
+
+TICK_SECONDS = Histogram('bot_tick_duration_seconds', 'Time for one poll of a server', ('server',))
+TICK_FAILURES = Counter('bot_tick_failures_total', 'Polls that raised or timed out', ('server', 'reason'))
+
+DIGEST_SECONDS = Histogram('digest_duration_seconds', 'Time spent in digestion steps', ('step',),
+                           buckets=DIGEST_BUCKETS)
+
+ARCHIVE_RECORDS = Counter('archive_records_total', 'Raw CRCON responses offered to the archive', ('outcome',))
+ARCHIVE_BYTES = Counter('archive_uncompressed_bytes_total', 'Archive lines written, before compression')
+
+
+# Time a function into a histogram child, e.g. @timed(DIGEST_SECONDS, 'process_stats')
+def timed(histogram : Histogram, *labels) -> Callable:
+    def decorator(fn : Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.labels(*labels).observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def endpoint_of(url : httpx.URL) -> str:
+    segments = [segment for segment in url.path.split('/') if segment]
+    return segments[-1] if len(segments) > 0 else '/'
+
+# Counts the body as it is read and records its size once the response is closed
+class _CountingStream(httpx.AsyncByteStream):
+    def __init__(self, stream : httpx.AsyncByteStream, endpoint : str):
+        self.stream = stream
+        self.endpoint = endpoint
+        self.nbytes = 0
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            self.nbytes += len(chunk)
+            yield chunk
+
+    async def aclose(self):
+        HTTP_RESPONSE_BYTES.labels(self.endpoint).observe(self.nbytes)
+        await self.stream.aclose()
+
+# Sits under RetryTransport, so it sees every attempt. RetryTransport resends the same request
+# object, which is how attempts after the first are told apart.
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport : httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request : httpx.Request) -> httpx.Response:
+        endpoint = endpoint_of(request.url)
+
+        attempt = request.extensions.get('metrics_attempt', 0)
+        request.extensions['metrics_attempt'] = attempt + 1
+        if attempt > 0:
+            HTTP_RETRIES.labels(endpoint).inc()
+
+        in_flight = HTTP_IN_FLIGHT.labels(endpoint)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception as e:
+            HTTP_ERRORS.labels(endpoint, type(e).__name__).inc()
+            raise
+        finally:
+            in_flight.dec()
+            HTTP_REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
+        HTTP_REQUESTS.labels(endpoint, str(response.status_code)).inc()
+        response.stream = _CountingStream(response.stream, endpoint)
+
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+# Just enough HTTP to answer GET /metrics
+class MetricsServer:
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, registry : MetricsRegistry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server : asyncio.AbstractServer = None
+
+    # Discord fires on_ready again after a reconnect, so starting twice keeps the first server
+    async def start(self):
+        if self._server is not None:
+            return
+
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # Port 0 picks a free one
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
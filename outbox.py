@@ -0,0 +1,295 @@
+# Outbound Discord messages, delivered off the poll path.
+#
+# Polls only enqueue. Every channel has its own queue and worker, paced by a token bucket sized to
+# Discord's per-channel limit, so one busy or rate limited channel never holds up polling or any
+# other channel. Status updates carry a key (one per server): a newer update replaces a queued one
+# that hasn't gone out yet, and once one has been posted later updates edit that message in place.
+# Resetting a key starts a new generation of it. Updates from an older generation that are still
+# queued are dropped, and one already being sent doesn't become the message later updates edit.
+from collections import deque
+from dataclasses import dataclass, field
+import asyncio
+import time
+import traceback
+from typing import Callable, Deque, Dict
+
+import numpy as np
+
+try:
+    import discord
+except ImportError:
+    discord = None
+
+# Discord allows about 5 messages per 5 seconds per channel
+CHANNEL_RATE_PER_S = 1.0
+CHANNEL_BURST = 5
+MAX_ATTEMPTS = 3
+# How many recent send latencies the percentiles are taken over
+LATENCY_WINDOW = 1024
+
+
+class TokenBucket:
+    def __init__(self, rate_per_s=CHANNEL_RATE_PER_S, burst=CHANNEL_BURST):
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_s = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_s) * self.rate_per_s)
+        self.updated_s = now
+
+    async def acquire(self):
+        self._refill()
+        while self.tokens < 1.0:
+            await asyncio.sleep((1.0 - self.tokens) / self.rate_per_s)
+            self._refill()
+
+        self.tokens -= 1.0
+
+    # Discord told us to back off, so spend everything until it says we may go again
+    def drain(self, retry_after_s : float):
+        self.tokens = -retry_after_s * self.rate_per_s
+        self.updated_s = time.monotonic()
+
+
+@dataclass
+class OutboundMessage:
+    channel_id : int
+    content : str
+    # Status updates with the same key supersede each other
+    key : str = None
+    # The generation of key the update was posted in, see ChannelQueue.reset_status
+    generation : int = 0
+    enqueued_s : float = field(default_factory=time.monotonic)
+    attempts : int = 0
+
+
+class ChannelQueue:
+    def __init__(self, channel_id : int, rate_per_s=CHANNEL_RATE_PER_S, burst=CHANNEL_BURST):
+        self.channel_id = channel_id
+        self.bucket = TokenBucket(rate_per_s, burst)
+        self.messages : Deque[OutboundMessage] = deque()
+        # Queued, not yet delivered, status updates by key
+        self.pending_status : Dict[str, OutboundMessage] = {}
+        # The last posted message for each status key, edited by later updates
+        self.status_messages : Dict[str, 'discord.Message'] = {}
+        # Current generation of each status key
+        self.generations : Dict[str, int] = {}
+        self.nstale : int = 0
+        self.ready = asyncio.Event()
+        self.task : asyncio.Task = None
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def put(self, message : OutboundMessage) -> bool:
+        if message.key is not None:
+            pending = self.pending_status.get(message.key)
+            if pending is not None:
+                # Keep its place in the queue, and its enqueue time so latency counts the wait
+                pending.content = message.content
+                return False
+            self.pending_status[message.key] = message
+
+        self.messages.append(message)
+        self.ready.set()
+        return True
+
+    def generation(self, key : str) -> int:
+        return self.generations.get(key, 0)
+
+    def is_stale(self, message : OutboundMessage) -> bool:
+        return message.key is not None and message.generation != self.generation(message.key)
+
+    # Start a new generation of key. Its queued update stays in the queue until get skips it.
+    def reset_status(self, key : str):
+        self.generations[key] = self.generation(key) + 1
+        self.status_messages.pop(key, None)
+        self.pending_status.pop(key, None)
+
+    # Back to the front of the queue, unless a newer update for its key has been queued since or
+    # its key was reset
+    def retry(self, message : OutboundMessage):
+        if message.key is not None:
+            if message.key in self.pending_status:
+                return
+            if self.is_stale(message):
+                self.nstale += 1
+                return
+            self.pending_status[message.key] = message
+
+        self.messages.appendleft(message)
+        self.ready.set()
+
+    async def get(self) -> OutboundMessage:
+        while True:
+            while len(self.messages) == 0:
+                self.ready.clear()
+                await self.ready.wait()
+
+            message = self.messages.popleft()
+            if self.is_stale(message):
+                self.nstale += 1
+                continue
+
+            if message.key is not None:
+                self.pending_status.pop(message.key, None)
+
+            return message
+
+
+class Outbox:
+    def __init__(self, get_channel : Callable[[int], 'discord.abc.Messageable'],
+                 rate_per_s=CHANNEL_RATE_PER_S, burst=CHANNEL_BURST, max_attempts=MAX_ATTEMPTS,
+                 edit_status=True):
+        self.get_channel = get_channel
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.max_attempts = max_attempts
+        # Edit the last status message for a key rather than posting a new one
+        self.edit_status = edit_status
+
+        self.channels : Dict[int, ChannelQueue] = {}
+        self.running = False
+
+        self.nqueued : int = 0
+        self.nsent : int = 0
+        self.nedited : int = 0
+        self.ncoalesced : int = 0
+        self.nfailed : int = 0
+        self.nrate_limited : int = 0
+        self.latencies_s : Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def __str__(self) -> str:
+        return (f'<Outbox(Channels:{len(self.channels)}, Queued:{self.queued}, Sent:{self.nsent}, '
+                f'Edited:{self.nedited}, Coalesced:{self.ncoalesced}, Stale:{self.nstale}, Failed:{self.nfailed})>')
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.channels.values())
+
+    # Status updates dropped because their key was reset
+    @property
+    def nstale(self) -> int:
+        return sum(queue.nstale for queue in self.channels.values())
+
+    def _queue(self, channel_id : int) -> ChannelQueue:
+        queue = self.channels.get(channel_id)
+        if queue is None:
+            queue = ChannelQueue(channel_id, self.rate_per_s, self.burst)
+            self.channels[channel_id] = queue
+            if self.running:
+                self._start_queue(queue)
+
+        return queue
+
+    def _start_queue(self, queue : ChannelQueue):
+        queue.task = asyncio.create_task(self._deliver(queue), name=f'outbox-{queue.channel_id}')
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        for queue in self.channels.values():
+            self._start_queue(queue)
+
+    async def stop(self):
+        self.running = False
+
+        tasks = [queue.task for queue in self.channels.values() if queue.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for queue in self.channels.values():
+            queue.task = None
+
+    # Queue a message, returns straight away
+    def send(self, channel_id : int, content : str):
+        self.nqueued += 1
+        self._queue(channel_id).put(OutboundMessage(channel_id, content))
+
+    # Queue a status update that replaces any earlier one for the same key
+    def post_status(self, channel_id : int, key : str, content : str):
+        self.nqueued += 1
+        queue = self._queue(channel_id)
+        if not queue.put(OutboundMessage(channel_id, content, key=key, generation=queue.generation(key))):
+            self.ncoalesced += 1
+
+    # The next status for key starts a new message, e.g. once its game is over. Updates for key
+    # posted before this never go out, or edit what came after.
+    def reset_status(self, channel_id : int, key : str):
+        queue = self.channels.get(channel_id)
+        if queue is not None:
+            queue.reset_status(key)
+
+    async def _deliver(self, queue : ChannelQueue):
+        while True:
+            message = await queue.get()
+            await queue.bucket.acquire()
+
+            try:
+                await self._send(queue, message)
+            except Exception as e:
+                message.attempts += 1
+
+                retry_after_s = getattr(e, 'retry_after', None)
+                if discord is not None and isinstance(e, discord.HTTPException) and e.status == 429:
+                    self.nrate_limited += 1
+                    queue.bucket.drain(retry_after_s or 1.0)
+
+                if message.attempts < self.max_attempts:
+                    queue.retry(message)
+                    continue
+
+                self.nfailed += 1
+                print(f"ERROR: Giving up on a message to channel {queue.channel_id} after {message.attempts} attempts")
+                traceback.print_exc()
+                continue
+
+            self.latencies_s.append(time.monotonic() - message.enqueued_s)
+
+    async def _send(self, queue : ChannelQueue, message : OutboundMessage):
+        previous = queue.status_messages.get(message.key) if message.key is not None else None
+
+        if previous is not None and self.edit_status:
+            try:
+                await previous.edit(content=message.content)
+                self.nedited += 1
+                return
+            except Exception as e:
+                # The message was deleted, post a fresh one instead
+                if discord is None or not isinstance(e, discord.NotFound):
+                    raise
+
+        channel = self.get_channel(queue.channel_id)
+        if channel is None:
+            raise LookupError(f'Unknown channel {queue.channel_id}')
+
+        sent = await channel.send(message.content)
+        self.nsent += 1
+
+        # Reset while it was being sent, so it's left as the last word on its generation
+        if message.key is not None and not queue.is_stale(message):
+            queue.status_messages[message.key] = sent
+
+    # Enqueue to delivered (or edited), in seconds, over the last LATENCY_WINDOW messages
+    def latency_percentiles(self, percentiles=(50, 90, 99)) -> Dict[int, float]:
+        if len(self.latencies_s) == 0:
+            return {p : 0.0 for p in percentiles}
+
+        values = np.percentile(np.fromiter(self.latencies_s, dtype=np.float64), percentiles)
+        return dict(zip(percentiles, values.tolist()))
+
+    def stats(self) -> dict:
+        return {'queued' : self.queued,
+                'sent' : self.nsent,
+                'edited' : self.nedited,
+                'coalesced' : self.ncoalesced,
+                'stale' : self.nstale,
+                'failed' : self.nfailed,
+                'rate_limited' : self.nrate_limited,
+                'latency_s' : self.latency_percentiles()}
@@ -0,0 +1,269 @@
+# Live steamroll prediction. Features come from each new slice record as it is added to a game,
+# and a logistic model trained offline on the game store turns them into a probability.
+#
+#   python predictor.py train --store games --output steamroll_model.json
+#
+# Every feature is oriented to the side that's ahead, so a model doesn't have to learn the same
+# thing twice for allies and axis. Rates are per minute of game clock, taken from the change in
+# time remaining, so replaying stored slices gives exactly the features the bot saw live.
+import argparse
+import json
+import math
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+TIME_REMAINING = 'Time Reamining'
+# Length of a warfare game on the game clock
+GAME_LENGTH_S = 90 * 60
+# Weight of the newest rate in the running averages
+RATE_SMOOTHING = 0.3
+DEFAULT_L2 = 1.0
+DEFAULT_HOLDOUT = 0.2
+
+FEATURE_NAMES = ['elapsed',
+                 'score_lead',
+                 'score_rate_lead',
+                 'kill_rate_lead',
+                 'kill_share_lead',
+                 'kd_spread',
+                 'player_imbalance']
+
+
+def _side_value(record, side : str, name : str) -> float:
+    value = float(record[f'{side} {name}'])
+    return value if math.isfinite(value) else 0.0
+
+
+# Feature state for one game, updated one slice record at a time
+class SteamrollFeatures:
+    def __init__(self, smoothing=RATE_SMOOTHING):
+        self.smoothing = smoothing
+        self.nupdates : int = 0
+
+        self._time_remaining : float = None
+        self._score_diff : float = 0.0
+        self._kills = (0.0, 0.0)
+        # Allies minus axis, per minute, smoothed
+        self._score_rate : float = 0.0
+        self._kill_rate : float = 0.0
+
+    def _smooth(self, average : float, value : float) -> float:
+        if self.nupdates <= 1:
+            return value
+        return average + self.smoothing * (value - average)
+
+    # Feed the newest slice record, in slice_dtype, and return the features in FEATURE_NAMES order
+    def update(self, record) -> List[float]:
+        time_remaining = float(record[TIME_REMAINING])
+        allied_score = _side_value(record, 'ALLIES', 'Score')
+        axis_score = _side_value(record, 'AXIS', 'Score')
+        kills = (_side_value(record, 'ALLIES', 'Kills Total'), _side_value(record, 'AXIS', 'Kills Total'))
+        score_diff = allied_score - axis_score
+
+        self.nupdates += 1
+        if self._time_remaining is not None:
+            minutes = (self._time_remaining - time_remaining) / 60
+            # The clock doesn't always move between polls, and a reset means a new game
+            if minutes > 0:
+                self._score_rate = self._smooth(self._score_rate, (score_diff - self._score_diff) / minutes)
+                kill_diff = (kills[0] - self._kills[0]) - (kills[1] - self._kills[1])
+                self._kill_rate = self._smooth(self._kill_rate, kill_diff / minutes)
+
+        self._time_remaining = time_remaining
+        self._score_diff = score_diff
+        self._kills = kills
+
+        # Ahead on score, or on kills when level
+        lead = 1.0 if (score_diff > 0 or (score_diff == 0 and kills[0] >= kills[1])) else -1.0
+
+        total_kills = kills[0] + kills[1]
+        kill_share = (kills[0] / total_kills - 0.5) if total_kills > 0 else 0.0
+        kd_spread = _side_value(record, 'ALLIES', 'Kill Death Ratio Mean') - _side_value(record, 'AXIS', 'Kill Death Ratio Mean')
+
+        allied_players = _side_value(record, 'ALLIES', 'Players')
+        axis_players = _side_value(record, 'AXIS', 'Players')
+        total_players = allied_players + axis_players
+        imbalance = (allied_players - axis_players) / total_players if total_players > 0 else 0.0
+
+        return [min(max(1.0 - time_remaining / GAME_LENGTH_S, 0.0), 1.0),
+                lead * score_diff,
+                lead * self._score_rate,
+                lead * self._kill_rate,
+                lead * kill_share,
+                lead * kd_spread,
+                lead * imbalance]
+
+
+# Logistic regression over standardized features. The standardization is folded into the
+# weights when the model is built, so scoring a tick is one dot product and an exp.
+class SteamrollModel:
+    def __init__(self, weights : List[float], bias : float, mean : List[float], std : List[float],
+                 feature_names : List[str] = FEATURE_NAMES, meta : dict = None):
+        if list(feature_names) != FEATURE_NAMES:
+            raise ValueError(f'Model was trained on features {list(feature_names)}, expected {FEATURE_NAMES}')
+
+        self.weights = list(weights)
+        self.bias = bias
+        self.mean = list(mean)
+        self.std = list(std)
+        self.meta = meta if meta is not None else {}
+
+        self._weights = [w / s for w, s in zip(self.weights, self.std)]
+        self._bias = bias - sum(w * m for w, m in zip(self._weights, self.mean))
+
+    def __str__(self) -> str:
+        return f'<SteamrollModel({", ".join(f"{n}:{w:+.3f}" for n, w in zip(FEATURE_NAMES, self.weights))})>'
+
+    def probability(self, features : List[float]) -> float:
+        z = self._bias
+        for w, f in zip(self._weights, features):
+            z += w * f
+
+        # Both branches avoid overflowing exp
+        if z >= 0:
+            return 1.0 / (1.0 + math.exp(-z))
+        e = math.exp(z)
+        return e / (1.0 + e)
+
+    def predictor(self) -> 'SteamrollPredictor':
+        return SteamrollPredictor(self)
+
+    def save(self, path : str):
+        with open(path, 'w') as f:
+            json.dump({'feature_names' : FEATURE_NAMES,
+                       'weights' : self.weights,
+                       'bias' : self.bias,
+                       'mean' : self.mean,
+                       'std' : self.std,
+                       'meta' : self.meta}, f, indent=2)
+
+    @staticmethod
+    def load(path : str) -> 'SteamrollModel':
+        with open(path) as f:
+            model = json.load(f)
+
+        return SteamrollModel(model['weights'], model['bias'], model['mean'], model['std'],
+                              feature_names=model['feature_names'], meta=model.get('meta'))
+
+# One game's features and the model scoring them
+class SteamrollPredictor:
+    def __init__(self, model : SteamrollModel):
+        self.model = model
+        self.features = SteamrollFeatures()
+        self.probability : float = None
+
+    def update(self, record) -> float:
+        self.probability = self.model.probability(self.features.update(record))
+        return self.probability
+
+
+# Every slice of every game in the store as a feature row, labelled with whether its game turned
+# out to be a steamroll. Rows are weighted so each game counts the same however long it ran.
+def game_store_dataset(reader) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    features = []
+    labels = []
+    weights = []
+    games = []
+
+    for idx in range(len(reader)):
+        x, y = reader[idx]
+        if len(x) == 0:
+            continue
+
+        tracker = SteamrollFeatures()
+        for record in x:
+            features.append(tracker.update(record))
+        labels.extend([float(y['WAS STEAMROLL'])] * len(x))
+        weights.extend([1.0 / len(x)] * len(x))
+        games.extend([idx] * len(x))
+
+    return (np.array(features, dtype=np.float64).reshape(-1, len(FEATURE_NAMES)), np.array(labels),
+            np.array(weights), np.array(games))
+
+def _sigmoid(z : np.ndarray) -> np.ndarray:
+    return 0.5 * (1.0 + np.tanh(0.5 * z))
+
+# Weighted, L2 regularized logistic regression by Newton's method. The features are few and the
+# rows many, so each step is a small solve.
+def fit_logistic(x : np.ndarray, y : np.ndarray, weights : np.ndarray = None, l2=DEFAULT_L2,
+                 max_iter=50, tol=1e-8) -> SteamrollModel:
+    if weights is None:
+        weights = np.ones(len(y))
+
+    mean = x.mean(axis=0)
+    std = x.std(axis=0)
+    std[std == 0] = 1.0
+
+    z = np.hstack(((x - mean) / std, np.ones((len(x), 1))))
+    # The bias isn't regularized
+    penalty = np.full(z.shape[1], l2)
+    penalty[-1] = 0.0
+
+    coef = np.zeros(z.shape[1])
+    for _ in range(max_iter):
+        p = _sigmoid(z @ coef)
+        gradient = z.T @ (weights * (p - y)) + penalty * coef
+        hessian = (z * (weights * p * (1 - p))[:, None]).T @ z + np.diag(penalty) + 1e-9 * np.eye(len(coef))
+        step = np.linalg.solve(hessian, gradient)
+        coef -= step
+
+        if np.max(np.abs(step)) < tol:
+            break
+
+    return SteamrollModel(coef[:-1].tolist(), float(coef[-1]), mean.tolist(), std.tolist())
+
+def log_loss(model : SteamrollModel, x : np.ndarray, y : np.ndarray, weights : np.ndarray) -> Tuple[float, float]:
+    p = np.clip(np.array([model.probability(row) for row in x]), 1e-12, 1 - 1e-12)
+    loss = -np.sum(weights * (y * np.log(p) + (1 - y) * np.log(1 - p))) / np.sum(weights)
+    accuracy = np.sum(weights * ((p >= 0.5) == (y >= 0.5))) / np.sum(weights)
+
+    return float(loss), float(accuracy)
+
+def train(store_path : str, l2=DEFAULT_L2, holdout=DEFAULT_HOLDOUT, seed=0) -> SteamrollModel:
+    from gamestore import HllGameStoreReader
+
+    x, y, weights, games = game_store_dataset(HllGameStoreReader(store_path))
+    if len(x) == 0:
+        raise ValueError(f"No slices in the game store at '{store_path}'")
+
+    # Hold whole games out, slices of one game are far from independent
+    game_ids = np.unique(games)
+    rng = np.random.default_rng(seed)
+    held_out = rng.choice(game_ids, size=int(len(game_ids) * holdout), replace=False)
+    test = np.isin(games, held_out)
+
+    model = fit_logistic(x[~test], y[~test], weights[~test], l2=l2)
+    print(f'Trained on {len(game_ids) - len(held_out)} games ({np.sum(~test)} slices), '
+          f'{np.sum(y[~test] * weights[~test]):.0f} steamrolls')
+    print(f'Train: log loss {log_loss(model, x[~test], y[~test], weights[~test])[0]:.4f}')
+
+    if np.any(test):
+        loss, accuracy = log_loss(model, x[test], y[test], weights[test])
+        print(f'Held out {len(held_out)} games: log loss {loss:.4f}, accuracy {accuracy:.3f}')
+
+    # What gets deployed is fit on everything
+    model = fit_logistic(x, y, weights, l2=l2)
+    model.meta = {'store' : store_path, 'ngames' : int(len(game_ids)), 'nslices' : int(len(x)), 'l2' : l2,
+                  'trained' : time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train the live steamroll model from a game store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train')
+    train_parser.add_argument('--store', required=True, help='game store path, without .dat/.idx')
+    train_parser.add_argument('--output', default='steamroll_model.json')
+    train_parser.add_argument('--l2', type=float, default=DEFAULT_L2)
+    train_parser.add_argument('--holdout', type=float, default=DEFAULT_HOLDOUT, help='fraction of games to evaluate on')
+    train_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    model = train(args.store, l2=args.l2, holdout=args.holdout, seed=args.seed)
+    model.save(args.output)
+    print(model)
@@ -0,0 +1,228 @@
+# Polls many CRCON servers concurrently from one asyncio loop
+from dataclasses import dataclass, field
+import asyncio
+import random
+import traceback
+from typing import Awaitable, Callable, Dict, List
+
+from HllServer import HLLServer
+import metrics
+from HLLStatsDigester import GameState, HllGame
+from utilities import Team
+
+DEFAULT_INTERVAL_S = 120.0
+DEFAULT_JITTER_S = 10.0
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_POLL_TIMEOUT_S = 90.0
+
+# Adaptive polling, see AdaptiveInterval
+DEFAULT_FLOOR_S = 20.0
+DEFAULT_CEILING_S = 900.0
+IDLE_INTERVAL_S = 300.0
+SEEDING_INTERVAL_S = 240.0
+# How close to the end, in seconds of game time, polls tighten to the floor
+ENDGAME_WINDOW_S = 300.0
+# A side holding this many of the 5 sectors is one capture from ending the game
+DOMINANT_SECTORS = 4
+DOMINANT_INTERVAL_S = 45.0
+
+
+@dataclass
+class ServerState:
+    server : HLLServer
+    channel_id : int
+    interval_s : float = DEFAULT_INTERVAL_S
+    jitter_s : float = DEFAULT_JITTER_S
+    current_game : HllGame = None
+    last_tick_s : float = 0.0
+    npolls : int = 0
+    nfailures : int = 0
+    # Polls in a row that found the server empty, for the idle back off
+    nidle : int = 0
+    # What the last tick picked, before jitter
+    next_interval_s : float = DEFAULT_INTERVAL_S
+    # Whether a log stream is connected for this server, see events.attach_event_stream
+    streaming : bool = False
+    # When the current game was first seen over without its result in the game history yet
+    result_wait_started_s : float = None
+    # Set to cut the current sleep short and poll now
+    wake : asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def name(self) -> str:
+        return self.server.server_name
+
+
+# Picks the next poll interval from what the last poll saw of the game. An empty server backs off
+# exponentially from idle_s up to the ceiling, a seeding one is polled every seeding_s, and a live
+# game is polled every interval_s, tightening when a side holds DOMINANT_SECTORS and down to the
+# floor once the game is within ENDGAME_WINDOW_S of its end, so game-over is noticed quickly.
+@dataclass
+class AdaptiveInterval:
+    floor_s : float = DEFAULT_FLOOR_S
+    ceiling_s : float = DEFAULT_CEILING_S
+    idle_s : float = IDLE_INTERVAL_S
+    seeding_s : float = SEEDING_INTERVAL_S
+    endgame_window_s : float = ENDGAME_WINDOW_S
+    dominant_sectors : int = DOMINANT_SECTORS
+    dominant_s : float = DOMINANT_INTERVAL_S
+
+    def clamp(self, interval_s : float) -> float:
+        return min(self.ceiling_s, max(self.floor_s, interval_s))
+
+    def __call__(self, state : ServerState) -> float:
+        game = state.current_game
+
+        # Between games, or the last poll didn't get far enough to know
+        if game is None:
+            return self.clamp(state.interval_s)
+
+        if game.state == GameState.EMPTY:
+            return self.clamp(self.idle_s * 2 ** max(0, state.nidle - 1))
+
+        if game.state == GameState.SEEDING:
+            return self.clamp(self.seeding_s)
+
+        if game.state != GameState.PLAYING:
+            return self.floor_s
+
+        # The log stream wakes the poll when the match ends, so there's no need to poll faster
+        if state.streaming:
+            return self.clamp(state.interval_s)
+
+        time_remaining = game.time_remaining
+        if time_remaining <= self.endgame_window_s:
+            return self.floor_s
+
+        interval_s = state.interval_s
+        if max(game.score[Team.ALLIES], game.score[Team.AXIS]) >= self.dominant_sectors:
+            interval_s = min(interval_s, self.dominant_s)
+
+        # Never sleep past the point the endgame window starts
+        interval_s = min(interval_s, time_remaining - self.endgame_window_s)
+
+        return self.clamp(interval_s)
+
+
+class PollScheduler:
+    def __init__(self,
+                 poll : Callable[[ServerState], Awaitable[None]],
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 timeout_s=DEFAULT_POLL_TIMEOUT_S,
+                 interval : Callable[[ServerState], float] = None):
+        self.poll = poll
+        self.max_concurrency = max_concurrency
+        self.timeout_s = timeout_s
+        # Picks each server's next interval after a tick, every server uses its fixed interval_s if None
+        self.interval = interval
+
+        self.states : List[ServerState] = []
+        # Anything with start() and async stop() run alongside the polls, e.g. log streams
+        self.streams : list = []
+        self._tasks : Dict[str, asyncio.Task] = {}
+        self._semaphore : asyncio.Semaphore = None
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    @property
+    def running(self) -> bool:
+        return len(self._tasks) > 0
+
+    def add_server(self, state : ServerState):
+        self.states.append(state)
+
+        if self.running:
+            self._start_state(state)
+
+    def start(self):
+        if self.running:
+            return
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        for state in self.states:
+            self._start_state(state)
+        for stream in self.streams:
+            stream.start()
+
+    def add_stream(self, stream):
+        self.streams.append(stream)
+
+        if self.running:
+            stream.start()
+
+    # Poll a server now rather than when its interval runs out
+    def poke(self, state : ServerState):
+        state.wake.set()
+
+    async def stop(self):
+        for stream in self.streams:
+            await stream.stop()
+
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for state in self.states:
+            await state.server.aclose()
+
+    def _start_state(self, state : ServerState):
+        self._tasks[state.name] = asyncio.create_task(self._run(state), name=f'poll-{state.name}')
+
+    def next_delay(self, state : ServerState) -> float:
+        # Keep the jitter small next to short intervals
+        jitter_s = min(state.jitter_s, state.next_interval_s / 4)
+        delay = state.next_interval_s + random.uniform(-jitter_s, jitter_s)
+        return max(0.0, delay - state.last_tick_s)
+
+    async def tick(self, state : ServerState):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        # A slow or hung CRCON only holds its own slot, and only until the timeout
+        async with self._semaphore:
+            try:
+                await asyncio.wait_for(self.poll(state), self.timeout_s)
+            except asyncio.TimeoutError:
+                state.nfailures += 1
+                metrics.TICK_FAILURES.labels(state.name, 'timeout').inc()
+                print(f"ERROR: Polling '{state.name}' timed out after {self.timeout_s} seconds")
+            except Exception as e:
+                state.nfailures += 1
+                metrics.TICK_FAILURES.labels(state.name, type(e).__name__).inc()
+                print(f"ERROR: Polling '{state.name}' failed")
+                traceback.print_exc()
+
+        state.npolls += 1
+        state.last_tick_s = loop.time() - started
+        metrics.TICK_SECONDS.labels(state.name).observe(state.last_tick_s)
+
+        game = state.current_game
+        if game is not None and game.state == GameState.EMPTY:
+            state.nidle += 1
+        else:
+            state.nidle = 0
+
+        state.next_interval_s = self.interval(state) if self.interval is not None else state.interval_s
+
+    async def _run(self, state : ServerState):
+        # Spread the first polls out so every server doesn't fire at once
+        await asyncio.sleep(random.uniform(0, state.jitter_s))
+
+        # stop() drops our task before cancelling it. wait_for in tick() can swallow a cancel that
+        # lands just as the poll finishes, so don't rely on the cancel alone to end the loop.
+        while state.name in self._tasks:
+            state.wake.clear()
+            await self.tick(state)
+            await self._sleep(state, self.next_delay(state))
+
+    # Not wait_for, which has the same problem with a cancel that lands as the timeout fires
+    async def _sleep(self, state : ServerState, delay : float):
+        waiter = asyncio.ensure_future(state.wake.wait())
+        try:
+            await asyncio.wait((waiter,), timeout=delay)
+        finally:
+            waiter.cancel()
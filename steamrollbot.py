@@ -4,33 +4,67 @@ from dataclasses import dataclass
 import datetime
 
 import asyncio
+import time
 import discord 
-from discord.ext import tasks
 
-from HllServer import HLLServer
+from HllServer import HLLServer, is_server_empty, is_server_seeding
 from HLLStatsDigester import GameState
+from scheduler import AdaptiveInterval, PollScheduler, ServerState
+from digest_pool import DigestExecutor, EXECUTOR_THREAD
+from events import attach_event_stream, websockets
+from outbox import Outbox
+from archive import PayloadArchive
+from predictor import SteamrollModel
+import metrics
 
 CHANNEL_ID = 1380967531673682020
 
-with open('.token', 'r') as file:
-    token = file.read()
-
 intents = discord.Intents.default()
 intents.message_content = True
 
 client = discord.Client(intents=intents)
 
-server = HLLServer('Glow\'s East', 'https://scoreboard-us-east-1.glows.gg/')
-#server = HLLServer('soul one', 'https://soul-one-stats.hlladmin.com/')
-current_game = None
+# Every server we watch, and the channel its updates go to
+SERVERS = [
+    ('Glow\'s East', 'https://scoreboard-us-east-1.glows.gg/', CHANNEL_ID),
+    #('soul one', 'https://soul-one-stats.hlladmin.com/', CHANNEL_ID),
+]
+POLL_INTERVAL_S = 120
+POLL_JITTER_S = 10
+# Bounds on the adaptive poll interval: tightest near a game's end, loosest on an empty server
+POLL_FLOOR_S = 20
+POLL_CEILING_S = 900
+MAX_CONCURRENT_POLLS = 16
+# CRCON API keys by server name. Servers with a key also follow the CRCON log stream, which wakes
+# their poll as soon as a match starts or ends.
+LOG_STREAM_API_KEYS = {}
+# Where slice digestion runs: 'thread' or 'process'
+DIGEST_EXECUTOR = EXECUTOR_THREAD
+DIGEST_WORKERS = 4
+# Serve Prometheus metrics on this port, None leaves them off
+METRICS_PORT = None
+# Keep every raw CRCON response in this directory so games can be digested again later, see
+# archive.py. None keeps nothing.
+ARCHIVE_DIR = None
+# Model from 'python predictor.py train', used to call steamrolls before the game ends. None
+# only reports them once it has.
+STEAMROLL_MODEL_PATH = None
+STEAMROLL_ALERT_PROBABILITY = 0.8
+# Pages of game history indexed at startup, older games are paged back to when they're looked up
+HISTORY_PAGES = 4
+# CRCON writes a game to its history some time after the map changes. A finished game is looked up
+# again on later ticks for this long before it's given up on.
+GAME_RESULT_WAIT_S = 15 * 60
 
 
 @client.event
 async def on_ready():
-    channel = client.get_channel(CHANNEL_ID)
-    await check_for_steamroll.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+    outbox.start()
+    scheduler.start()
     print(f"We have logged in as {client.user}")
-    await channel.send("We are running!")
+    outbox.send(CHANNEL_ID, "We are running!")
 
 
 @client.event
@@ -41,52 +75,41 @@ async def on_message(message):
     if message.content.startswith('$hello'):
         await message.channel.send('Hello, world!')
 
-def is_server_empty(public_info) -> bool:
-    if public_info['result']['player_count'] == 0:
-        return True
-    
-    return False
-
-def is_server_seeding(public_info) -> bool:
-    nallies = public_info['result']['player_count_by_team']['allied']
-    naxies = public_info['result']['player_count_by_team']['axis']
-    
-    if nallies < 25 and naxies < 25:
-        return True
-    
-    return False
+async def check_for_steamroll(state : ServerState):
+    print(f"We are checking for a steamroll on {state.name}...")
+    server = state.server
+    channel_id = state.channel_id
+    # Status updates for a game edit one message rather than posting a new one every tick
+    status_key = state.name
 
-@tasks.loop(minutes=2)
-async def check_for_steamroll():
-    print("We are checking for a steamroll...")
-    global server
-    global current_game
+    game_id, stats, public_info = await server.poll()
 
-    channel = client.get_channel(CHANNEL_ID)
+    if state.current_game == None:
+        state.current_game = server.new_game(game_id)
 
-    game = await server.get_current_game()
-
-    if current_game == None:
-        current_game = game
+    current_game = state.current_game
 
     # Game is not over
-    if current_game.map == game.map and current_game.start_time_s == game.start_time_s:
-        stats, public_info = await server.get_current_game_stats()
-
+    if current_game.game_id == game_id:
         if is_server_empty(public_info):
-            print("The server is empty!")
+            print(f"The server {state.name} is empty!")
             current_game.state = GameState.EMPTY
-            #await channel.send(f"The server is empty!")
+            #outbox.post_status(channel_id, status_key, f"The server is empty!")
         elif is_server_seeding(public_info):
-            print(f"The server is seeding! Number of players: {len(stats['result']['stats'])}")
+            print(f"The server {state.name} is seeding! Number of players: {public_info['result']['player_count']}")
             current_game.state = GameState.SEEDING
-            #await channel.send(f"The server is seeding! Number of players: {len(stats['result']['stats'])}")
+            #outbox.post_status(channel_id, status_key, f"The server is seeding! Number of players: {public_info['result']['player_count']}")
         else:
-            await current_game.add_stat_slice(stats, public_info)
-            print(f"Game is still on {current_game.map}... Time Left: {current_game.time_remaining/60} - Score: {current_game.score}")
-            await channel.send(f"Game is still on {current_game.map}... Time Left: {current_game.time_remaining/60}  - Score: {current_game.score}")
-            
-        current_game = game
+            await digest_pool.add_stat_slice(current_game, stats, public_info)
+            print(f"Game is still on {current_game.map}... Time Left: {current_game.time_remaining/60} - Score: {current_game.score} - Kills: {current_game.kills}")
+            outbox.post_status(channel_id, status_key, f"Game is still on {current_game.map}... Time Left: {current_game.time_remaining/60}  - Score: {current_game.score} - Kills: {current_game.kills}")
+
+            probability = current_game.steamroll_probability
+            if probability is not None and probability >= STEAMROLL_ALERT_PROBABILITY and not current_game.steamroll_alerted:
+                current_game.steamroll_alerted = True
+                print(f"Game on {current_game.map} looks like a steamroll: {probability:.0%} - Score: {current_game.score}")
+                outbox.send(channel_id, f"Game on {current_game.map} looks like a steamroll! Chance: {probability:.0%} - Time Left: {current_game.time_remaining/60} - Score: {current_game.score} - Kills: {current_game.kills}")
+
         return
 
     # Check if the game is actually over
@@ -95,21 +118,66 @@ async def check_for_steamroll():
         return
 
     game_result = await server.get_game(current_game)
-    await channel.send(f"game is over on {current_game.map}!")
+    if game_result is None:
+        now = time.monotonic()
+        if state.result_wait_started_s is None:
+            state.result_wait_started_s = now
+
+        waited_s = now - state.result_wait_started_s
+        if waited_s < GAME_RESULT_WAIT_S:
+            print(f"Game on {current_game.map} is over but isn't in the game history yet, waited {waited_s:.0f}s")
+            return
+
+        print(f"ERROR: Game on {current_game.map} started at {current_game.start_time_s} never showed up in "
+              f"the game history of {state.name} after {waited_s:.0f}s, dropping it")
+        outbox.reset_status(channel_id, status_key)
+        state.result_wait_started_s = None
+        state.current_game = None
+        return
+
+    state.result_wait_started_s = None
+
+    outbox.reset_status(channel_id, status_key)
+    outbox.send(channel_id, f"game is over on {current_game.map}!")
     print(f"Game is over on {current_game.map}!")
     print("Result:", game_result)
 
     current_game.process_game_result(game_result)
 
     if current_game.was_steamroll():
-        print(f"Steam roll for current_game {current_game.map} was a steamroll! {current_game.result['steamroll_reason']} Winner: {current_game.winner} Loser: {current_game.loser}")
-        await channel.send(f"Steam roll for current_game {current_game.map} was a steamroll! {current_game.result['steamroll_reason']} Winner: {current_game.winner} Loser: {current_game.loser}")
+        print(f"Steam roll for current_game {current_game.map} was a steamroll! {current_game.steamroll_reason} Winner: {current_game.winner} Loser: {current_game.loser}")
+        outbox.send(channel_id, f"Steam roll for current_game {current_game.map} was a steamroll! {current_game.steamroll_reason} Winner: {current_game.winner} Loser: {current_game.loser}")
     else:
-        print(f"Game on {current_game.map} was not a steamroll. Reason: {current_game.result['steamroll_raeson']} - Score: {current_game.score}")
-        await channel.send(f"Game on {current_game.map} was not a steamroll. Reason: {current_game.result['steamroll_raeson']} - Score: {current_game.score}")
+        print(f"Game on {current_game.map} was not a steamroll. Reason: {current_game.steamroll_reason} - Score: {current_game.score}")
+        outbox.send(channel_id, f"Game on {current_game.map} was not a steamroll. Reason: {current_game.steamroll_reason} - Score: {current_game.score}")
+
 
+    state.current_game = None
 
-    current_game = None
+
+metrics_server = None
+if METRICS_PORT is not None:
+    metrics.enable()
+    metrics_server = metrics.MetricsServer(port=METRICS_PORT)
+
+archive = PayloadArchive(ARCHIVE_DIR) if ARCHIVE_DIR is not None else None
+steamroll_model = SteamrollModel.load(STEAMROLL_MODEL_PATH) if STEAMROLL_MODEL_PATH is not None else None
+outbox = Outbox(client.get_channel)
+digest_pool = DigestExecutor(DIGEST_EXECUTOR, max_workers=DIGEST_WORKERS)
+scheduler = PollScheduler(check_for_steamroll, max_concurrency=MAX_CONCURRENT_POLLS,
+                          interval=AdaptiveInterval(floor_s=POLL_FLOOR_S, ceiling_s=POLL_CEILING_S))
+for name, uri, channel_id in SERVERS:
+    state = ServerState(HLLServer(name, uri, api_key=LOG_STREAM_API_KEYS.get(name), archive=archive,
+                                  steamroll_model=steamroll_model, history_pages=HISTORY_PAGES), channel_id,
+                        interval_s=POLL_INTERVAL_S,
+                        jitter_s=POLL_JITTER_S)
+    scheduler.add_server(state)
+
+    if state.server.api_key is not None and websockets is not None:
+        attach_event_stream(scheduler, state)
 
 if __name__ == "__main__":
+    with open('.token', 'r') as file:
+        token = file.read()
+
     client.run(token)
\ No newline at end of file
@@ -0,0 +1,191 @@
+# Seeded generators of CRCON payloads, shaped like what /get_live_game_stats, /get_public_info and
+# /get_scoreboard_maps return, for benchmarks and local runs without a live server. The same seed
+# always gives the same payloads.
+import asyncio
+import copy
+import json
+import random
+from typing import List
+
+import httpx
+
+from HllServer import (CURRENT_MAP, GAME_HISTORY_EP, HISTORY_PAGE_SIZE, LIVE_GAME_STATS,
+                       EST_TO_GMT, RCRON_TIME_STR_FORMAT, convert_rcron_time_str_to_datetime,
+                       convert_s_to_datetime)
+from utilities import AXIS_WEAPONS, US_WEAPONS, Team
+
+# (map id, pretty name, game mode)
+MAPS = [
+    ('carentan_warfare', 'Carentan Warfare', 'warfare'),
+    ('foy_warfare', 'Foy Warfare', 'warfare'),
+    ('hurtgenforest_warfare_V2', 'Hürtgen Forest Warfare', 'warfare'),
+    ('omahabeach_offensive_us', 'Omaha Beach Offensive', 'offensive'),
+    ('PHL_L_1944_OffensiveUS', 'Purple Heart Lane Offensive', 'offensive'),
+    ('stmariedumont_warfare', 'St. Marie Du Mont Warfare', 'warfare'),
+    ('utahbeach_warfare', 'Utah Beach Warfare', 'warfare'),
+]
+GAME_LENGTH_S = 90 * 60
+# Fixed so generated histories don't depend on when they're generated
+EPOCH_S = 1750000000
+
+
+def make_player(rng : random.Random, player_id : int, side : Team) -> dict:
+    own_weapons = list(AXIS_WEAPONS.keys() if side == Team.AXIS else US_WEAPONS.keys())
+    enemy_weapons = list(US_WEAPONS.keys() if side == Team.AXIS else AXIS_WEAPONS.keys())
+
+    kills = rng.randint(0, 60)
+    deaths = rng.randint(0, 40)
+    minutes = rng.uniform(1, 90)
+
+    weapons = {}
+    for _ in range(kills):
+        weapon = rng.choice(own_weapons)
+        weapons[weapon] = weapons.get(weapon, 0) + 1
+
+    death_by_weapons = {}
+    for _ in range(deaths):
+        weapon = rng.choice(enemy_weapons)
+        death_by_weapons[weapon] = death_by_weapons.get(weapon, 0) + 1
+
+    return {
+        'player_id' : f'{76561190000000000 + player_id}',
+        'player' : f'Player {player_id}',
+        'kills' : kills,
+        'kills_streak' : rng.randint(0, 10),
+        'deaths' : deaths,
+        'deaths_without_kill_streak' : rng.randint(0, 10),
+        'teamkills' : rng.randint(0, 2),
+        'teamkills_streak' : rng.randint(0, 1),
+        'time_seconds' : int(minutes * 60),
+        'kills_per_minute' : round(kills / minutes, 2),
+        'deaths_per_minute' : round(deaths / minutes, 2),
+        'kill_death_ratio' : round(kills / max(deaths, 1), 2),
+        'longest_life_secs' : rng.randint(60, 1800),
+        'shortest_life_secs' : rng.randint(1, 60),
+        'combat' : rng.randint(0, 300),
+        'offense' : rng.randint(0, 200),
+        'defense' : rng.randint(0, 200),
+        'support' : rng.randint(0, 500),
+        'most_killed' : {},
+        'death_by' : {},
+        'weapons' : weapons,
+        'death_by_weapons' : death_by_weapons,
+    }
+
+def make_live_game_stats(rng : random.Random, nplayers : int) -> dict:
+    players = [make_player(rng, idx, Team.AXIS if idx % 2 else Team.ALLIES) for idx in range(nplayers)]
+    return {'failed' : False, 'result' : {'stats' : players}}
+
+def make_public_info(rng : random.Random, nplayers : int, map_idx : int = 0, start_time_s : int = EPOCH_S) -> dict:
+    map_id, pretty_name, game_mode = MAPS[map_idx % len(MAPS)]
+    return {'failed' : False,
+            'result' : {'time_remaining' : rng.randint(0, 5400),
+                        'player_count' : nplayers,
+                        'player_count_by_team' : {'axis' : nplayers // 2, 'allied' : nplayers - nplayers // 2},
+                        'score' : {'axis' : rng.randint(0, 5), 'allied' : rng.randint(0, 5)},
+                        'current_map' : {'map' : {'id' : map_id, 'pretty_name' : pretty_name, 'game_mode' : game_mode},
+                                         'start' : start_time_s}}}
+
+# Successive cumulative snapshots where only a few players' numbers move each tick
+def make_snapshots(rng : random.Random, nplayers : int, nsnapshots : int, nchanged : int) -> list:
+    stats = make_live_game_stats(rng, nplayers)
+    snapshots = [stats]
+
+    for _ in range(nsnapshots - 1):
+        stats = copy.deepcopy(stats)
+        for player in rng.sample(stats['result']['stats'], nchanged):
+            player['kills'] += 1
+            player['combat'] += rng.randint(1, 10)
+        snapshots.append(stats)
+
+    return snapshots
+
+def rcron_time_str(seconds : int) -> str:
+    return convert_s_to_datetime(seconds).strftime(RCRON_TIME_STR_FORMAT)
+
+# The inverse of rcron_time_str, i.e. the start_time_s HllGame would have for a history entry
+def rcron_time_str_to_s(text : str) -> int:
+    return int((convert_rcron_time_str_to_datetime(text) - EST_TO_GMT).timestamp())
+
+def make_scoreboard_map(rng : random.Random, game_id : int, start_time_s : int, map_idx : int) -> dict:
+    map_id, pretty_name, game_mode = MAPS[map_idx % len(MAPS)]
+
+    # Most games go the distance, some end early on a 5 - 0
+    winner_sectors, loser_sectors = (5, 0) if rng.random() < 0.2 else (rng.randint(3, 4), rng.randint(0, 2))
+    allied, axis = (winner_sectors, loser_sectors) if rng.random() < 0.5 else (loser_sectors, winner_sectors)
+    duration_s = rng.randint(20 * 60, GAME_LENGTH_S) if winner_sectors == 5 else GAME_LENGTH_S
+
+    return {'id' : game_id,
+            'creation_time' : rcron_time_str(start_time_s),
+            'start' : rcron_time_str(start_time_s),
+            'end' : rcron_time_str(start_time_s + duration_s),
+            'server_number' : 1,
+            'map' : {'id' : map_id, 'pretty_name' : pretty_name, 'game_mode' : game_mode},
+            'result' : {'allied' : allied, 'axis' : axis},
+            'player_stats' : []}
+
+# Back to back games, newest first like /get_scoreboard_maps. The newest ended before end_time_s.
+def make_scoreboard_maps(rng : random.Random, ngames : int, end_time_s : int = EPOCH_S) -> List[dict]:
+    games = []
+    start_time_s = end_time_s - GAME_LENGTH_S - 60
+    for idx in range(ngames):
+        games.append(make_scoreboard_map(rng, ngames - idx, start_time_s, rng.randrange(len(MAPS))))
+        start_time_s -= GAME_LENGTH_S + rng.randint(60, 300)
+
+    return games
+
+def scoreboard_page(games : List[dict], page=1, limit=HISTORY_PAGE_SIZE) -> dict:
+    start = (page - 1) * limit
+    return {'failed' : False,
+            'result' : {'page' : page, 'page_size' : limit, 'total' : len(games), 'maps' : games[start:start + limit]}}
+
+
+# One synthetic server: a game in progress plus its history, served to HLLServer over an
+# httpx.MockTransport. Bodies are encoded once up front so requests cost what a real client sees.
+# latency_s delays every response, to count the round trips a tick makes.
+class SyntheticCrcon:
+    def __init__(self, seed=0, nplayers=100, nhistory=1000, start_time_s=EPOCH_S, latency_s=0.0):
+        rng = random.Random(seed)
+        self.latency_s = latency_s
+
+        self.map_idx = rng.randrange(len(MAPS))
+        self.start_time_s = start_time_s
+        self.history = make_scoreboard_maps(rng, nhistory, end_time_s=start_time_s)
+        self.set_game(make_live_game_stats(rng, nplayers), make_public_info(rng, nplayers, self.map_idx, start_time_s))
+
+        self.nrequests : int = 0
+
+    def set_game(self, stats : dict, public_info : dict):
+        self.stats = stats
+        self.public_info = public_info
+        self.stats_body = json.dumps(stats).encode()
+        self.public_info_body = json.dumps(public_info).encode()
+
+    def handler(self, request : httpx.Request) -> httpx.Response:
+        self.nrequests += 1
+        path = request.url.path.rstrip('/')
+
+        if path.endswith(LIVE_GAME_STATS):
+            return httpx.Response(200, content=self.stats_body)
+        if path.endswith(CURRENT_MAP):
+            return httpx.Response(200, content=self.public_info_body)
+        if path.endswith(GAME_HISTORY_EP):
+            page = int(request.url.params.get('page', 1))
+            limit = int(request.url.params.get('limit', HISTORY_PAGE_SIZE))
+            return httpx.Response(200, json=scoreboard_page(self.history, page, limit))
+
+        return httpx.Response(404, json={'failed' : True, 'error' : f'Unknown endpoint {path}'})
+
+    async def slow_handler(self, request : httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.latency_s)
+        return self.handler(request)
+
+    @property
+    def transport(self) -> httpx.MockTransport:
+        if self.latency_s > 0:
+            return httpx.MockTransport(self.slow_handler)
+        return httpx.MockTransport(self.handler)
+
+    @property
+    def uri(self) -> str:
+        return 'http://synthetic'
@@ -7,7 +7,12 @@ import numpy as np
 np.set_printoptions(precision=3, suppress=True)
 
 from HllServer import HLLServer
-from HLLStatsDigester import HllGame, HllGameStatsSlice, HllSideStats
+from HLLStatsDigester import GameState, HllGame, HllGameStatsSlice, HllSideStats
+from events import MATCH_ENDED, MATCH_START, attach_event_stream
+from fake_crcon import FakeLogServer, make_match_logs
+from gamestore import HllGameStore, HllGameStoreReader
+from scheduler import AdaptiveInterval, PollScheduler, ServerState
+from utilities import Team
 
 
 async def main():
@@ -27,7 +32,7 @@ async def main():
     hllgame = runner.process_game(server, game)
     runner.was_steamroll(hllgame)
 
-    current, info = await server.get_current_game_stats()
+    current, info = await server.get_current_game_stats(skip_if_idle=False)
 
     stats = process_stats(current)
 
@@ -53,7 +58,7 @@ async def test_hllStatsDigester():
 
     hllGame = HllGameStats()
 
-    stats, public = await server.get_current_game_stats()
+    stats, public = await server.get_current_game_stats(skip_if_idle=False)
 
     hllGame.process_stats(stats, public)
     
@@ -75,21 +80,84 @@ async def test_stats_to_numpy():
     server = HLLServer('glows east', 'https://scoreboard-us-central-1.glows.gg/')
 
     current_game = await server.get_current_game()
-    stats, public_info = await server.get_current_game_stats()
+    stats, public_info = await server.get_current_game_stats(skip_if_idle=False)
     current_game.add_stat_slice(stats, public_info)
 
     time.sleep(5)
 
-    stats, public_info = await server.get_current_game_stats()
+    stats, public_info = await server.get_current_game_stats(skip_if_idle=False)
     current_game.add_stat_slice(stats, public_info)
 
-    current_game.to_numpy()
-    current_game.save_stat_slice('foo.csv')
-
-    current_game.save_y('foo.csv')
-
-
-
-
-asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    x = current_game.to_numpy()
+    assert current_game.y is None and current_game.state == GameState.PLAYING
+    print(f"Slices: {len(x)} Score: {current_game.score}")
+
+    # Only a finished game has the y-vector the store needs
+    game_result = await server.get_game(current_game)
+    if game_result is None:
+        print(f"Game on {current_game.map} is still on, not storing it")
+        return
+
+    current_game.process_game_result(game_result)
+    store = HllGameStore('games')
+    store.append_game(current_game)
+
+    reader = HllGameStoreReader('games')
+    print(f"Stored games: {len(reader)} Rows: {len(reader.x)}")
+
+
+# A match streamed from a FakeLogServer that drops the connection halfway through. The stream
+# should wake the poll on MATCH START and MATCH ENDED, count the kills, let the scheduler go back
+# to its polling intervals while it's down, and pick up after the last log it saw.
+async def test_event_stream():
+    async def poll(state):
+        pass
+
+    async with FakeLogServer(make_match_logs(allied=1, axis=4), port=0, drop_after=3) as log_server:
+        server = HLLServer('fake', log_server.uri)
+        game = HllGame(server=server)
+        game.state = GameState.PLAYING
+        game.time_remaining = 60
+        state = ServerState(server, channel_id=0, current_game=game)
+        interval = AdaptiveInterval()
+
+        scheduler = PollScheduler(poll, interval=interval)
+        stream = attach_event_stream(scheduler, state, reconnect_min_s=0.05, reconnect_max_s=0.1)
+
+        woken = []
+        on_event = stream.on_event
+        async def record_event(event):
+            await on_event(event)
+            if state.wake.is_set():
+                woken.append(event.action)
+                state.wake.clear()
+        stream.on_event = record_event
+
+        statuses = []
+        on_status = stream.on_status
+        def record_status(connected):
+            on_status(connected)
+            statuses.append((connected, interval(state)))
+        stream.on_status = record_status
+
+        stream.start()
+        for _ in range(100):
+            if MATCH_ENDED in woken:
+                break
+            await asyncio.sleep(0.05)
+        await stream.stop()
+        await server.aclose()
+
+    print(stream, 'Woken by:', woken, 'Connected, interval:', statuses)
+    assert woken == [MATCH_START, MATCH_ENDED]
+    assert log_server.nconnections == 2 and stream.nreconnects >= 1
+    # Connected the interval relaxes, dropped it tightens again for the endgame
+    assert statuses[:3] == [(True, interval.clamp(state.interval_s)), (False, interval.floor_s),
+                            (True, interval.clamp(state.interval_s))]
+    assert game.kills == {Team.ALLIES : 1, Team.AXIS : 3}
+    assert game.score == {Team.ALLIES : 1, Team.AXIS : 4}
+
+
+if sys.platform == 'win32':
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 asyncio.run(test_stats_to_numpy())
\ No newline at end of file
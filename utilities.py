@@ -1,5 +1,8 @@
 from enum import Enum
-from typing import Tuple, TypedDict
+from itertools import chain
+from typing import List, Tuple, TypedDict
+
+import numpy as np
 
 class Team(str, Enum):
     ALLIES = "allies"
@@ -262,6 +265,30 @@ for w in AXIS_WEAPONS.keys():
         continue
     WEAPON_SIDE_MAP[w] = Team.AXIS
 
+# Weapon names interned to integer ids, with the side of each id kept in a parallel vector so
+# a whole slice's weapons can be classified with one fancy index. Both are built once at import
+# and never change, so worker threads can share them. Weapons we've never heard of all map to one
+# extra id with no side, the same as WEAPON_SIDE_MAP.get returning None.
+SIDE_NONE = 0
+SIDE_ALLIES = 1
+SIDE_AXIS = 2
+
+WEAPON_IDS : dict[str, int] = {}
+_weapon_sides : List[int] = []
+
+for w in ALL_WEAPONS.keys():
+    WEAPON_IDS[w] = len(_weapon_sides)
+    side = WEAPON_SIDE_MAP.get(w)
+    _weapon_sides.append(SIDE_ALLIES if side == Team.ALLIES else SIDE_AXIS if side == Team.AXIS else SIDE_NONE)
+
+UNKNOWN_WEAPON_ID = len(_weapon_sides)
+_weapon_sides.append(SIDE_NONE)
+
+WEAPON_SIDE_VECTOR = np.array(_weapon_sides, dtype=np.int8)
+
+def intern_weapons(names) -> np.ndarray:
+    return np.fromiter((WEAPON_IDS.get(name, UNKNOWN_WEAPON_ID) for name in names), dtype=np.int64, count=len(names))
+
 class PlayerTeamConfidence(Enum):
     STRONG = "strong"
     MIXED = "mixed"
@@ -321,3 +348,168 @@ def detect_team(player) -> Tuple[Team, PlayerTeamAssociation]:
         )
     assoc['confidence'] = PlayerTeamConfidence.STRONG if assoc['ratio'] > 85 else PlayerTeamConfidence.MIXED
     return assoc['side'], assoc
+
+
+def _weapon_side_counts(weapon_maps, nplayers : int) -> Tuple[np.ndarray, np.ndarray]:
+    lengths = np.fromiter(map(len, weapon_maps), dtype=np.int64, count=nplayers)
+    player_idx = np.repeat(np.arange(nplayers), lengths)
+    weapon_ids = intern_weapons(list(chain.from_iterable(weapon_maps)))
+    sides = WEAPON_SIDE_VECTOR[weapon_ids]
+    counts = np.fromiter(chain.from_iterable(w.values() for w in weapon_maps), dtype=np.float64, count=len(player_idx))
+
+    allies = np.bincount(player_idx, weights=counts * (sides == SIDE_ALLIES), minlength=nplayers)
+    axis = np.bincount(player_idx, weights=counts * (sides == SIDE_AXIS), minlength=nplayers)
+
+    return allies.astype(np.int64), axis.astype(np.int64)
+
+# Allies and axis evidence counts for every player, as two lists of ints
+def team_counts(players) -> Tuple[List[int], List[int]]:
+    nplayers = len(players)
+    if nplayers == 0:
+        return [], []
+
+    kills_allies, kills_axis = _weapon_side_counts([player['weapons'] for player in players], nplayers)
+    deaths_allies, deaths_axis = _weapon_side_counts([player['death_by_weapons'] for player in players], nplayers)
+
+    # Being killed by an allied weapon is evidence for axis, and the other way around
+    allies_counts = (kills_allies + deaths_axis).tolist()
+    axis_counts = (kills_axis + deaths_allies).tolist()
+
+    return allies_counts, axis_counts
+
+def associate_team(allies_count : int, axis_count : int) -> Tuple[Team, PlayerTeamAssociation]:
+    if axis_count == 0 and allies_count == 0:
+        return Team.UNKNOWN, PlayerTeamAssociation(side=Team.UNKNOWN, confidence=PlayerTeamConfidence.STRONG, ratio=0)
+    elif axis_count > allies_count:
+        side = Team.AXIS
+        ratio = round(axis_count / (axis_count + allies_count) * 100, 2)
+    elif allies_count > axis_count:
+        side = Team.ALLIES
+        ratio = round(allies_count / (axis_count + allies_count) * 100, 2)
+    else:
+        side = Team.UNKNOWN
+        ratio = 50
+
+    confidence = PlayerTeamConfidence.STRONG if ratio > 85 else PlayerTeamConfidence.MIXED
+    return side, PlayerTeamAssociation(side=side, confidence=confidence, ratio=ratio)
+
+# detect_team for a whole slice at once. The weapon counts of every player are gathered into flat
+# arrays and summed per player with bincount; only building the associations is done per player.
+def detect_teams(players) -> List[Tuple[Team, PlayerTeamAssociation]]:
+    allies_counts, axis_counts = team_counts(players)
+    return [associate_team(allies, axis) for allies, axis in zip(allies_counts, axis_counts)]
+
+def get_player_id(player) -> str:
+    for key in ('player_id', 'steam_id_64', 'player'):
+        if player.get(key) is not None:
+            return player[key]
+
+    return None
+
+# Every kill and death CRCON adds to a player's weapon counts also moves their kill, teamkill or
+# death total, so those totals stand in for the weapon counts without summing them
+def evidence_totals(player) -> tuple:
+    kills = player.get('kills')
+    deaths = player.get('deaths')
+    if kills is None or deaths is None:
+        return (sum(player['weapons'].values()), sum(player['death_by_weapons'].values()))
+
+    return (kills, player.get('teamkills', 0), deaths)
+
+# Remembers each player's team between slices of one game. CRCON's weapon counts are cumulative,
+# so unchanged totals mean unchanged evidence and the cached association is reused as is. Players
+# whose totals moved are recounted together. New evidence only for the side a STRONG entry already
+# has can't move the player or weaken it, so the entry is kept with its ratio brought up to date.
+# Otherwise the entry is revalidated if the side and confidence hold, and invalidated and replaced
+# if not (a team switch, STRONG -> MIXED, ...).
+class TeamAssignmentCache:
+    def __init__(self):
+        # player id -> (weapon totals, allies count, axis count, team, association)
+        self.entries : dict[str, Tuple[tuple, int, int, Team, PlayerTeamAssociation]] = {}
+
+        self.hits : int = 0
+        self.misses : int = 0
+        self.revalidations : int = 0
+        self.invalidations : int = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __str__(self) -> str:
+        return (f'<TeamAssignmentCache(Players:{len(self)}, Hits:{self.hits}, Misses:{self.misses}, '
+                f'Revalidated:{self.revalidations}, Invalidated:{self.invalidations})>')
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses + self.revalidations + self.invalidations
+
+    @property
+    def hit_rate(self) -> float:
+        if self.lookups == 0:
+            return 0.0
+
+        return self.hits / self.lookups
+
+    # Hits plus entries that only needed their counts refreshed
+    @property
+    def reuse_rate(self) -> float:
+        if self.lookups == 0:
+            return 0.0
+
+        return (self.hits + self.revalidations) / self.lookups
+
+    def clear(self):
+        self.entries.clear()
+
+    @staticmethod
+    def _agrees(entry : tuple, allies : int, axis : int) -> bool:
+        _, cached_allies, cached_axis, team, assoc = entry
+        if assoc['confidence'] != PlayerTeamConfidence.STRONG:
+            return False
+
+        if team == Team.ALLIES:
+            return axis == cached_axis and allies >= cached_allies
+        if team == Team.AXIS:
+            return allies == cached_allies and axis >= cached_axis
+
+        return False
+
+    def detect_teams(self, players) -> List[Tuple[Team, PlayerTeamAssociation]]:
+        teams = [None] * len(players)
+        stale = []
+
+        for idx, player in enumerate(players):
+            player_id = get_player_id(player)
+            totals = evidence_totals(player)
+
+            entry = self.entries.get(player_id)
+            if entry is not None and entry[0] == totals:
+                self.hits += 1
+                teams[idx] = (entry[3], entry[4])
+                continue
+
+            stale.append((idx, player_id, totals, entry))
+
+        allies_counts, axis_counts = team_counts([players[idx] for idx, _, _, _ in stale])
+        for (idx, player_id, totals, entry), allies, axis in zip(stale, allies_counts, axis_counts):
+            if entry is not None and self._agrees(entry, allies, axis):
+                self.revalidations += 1
+                team = entry[3]
+                assoc = PlayerTeamAssociation(entry[4], ratio=round(max(allies, axis) / (allies + axis) * 100, 2))
+                self.entries[player_id] = (totals, allies, axis, team, assoc)
+                teams[idx] = (team, assoc)
+                continue
+
+            team, assoc = associate_team(allies, axis)
+
+            if entry is None:
+                self.misses += 1
+            elif entry[3] == team and entry[4]['confidence'] == assoc['confidence']:
+                self.revalidations += 1
+            else:
+                self.invalidations += 1
+
+            self.entries[player_id] = (totals, allies, axis, team, assoc)
+            teams[idx] = (team, assoc)
+
+        return teams